@@ -1,31 +1,31 @@
+import asyncio
+import functools
 import io
 import os
 import ssl
-from contextlib import closing
+import threading
 from typing import Optional, Tuple
 import datetime
 
+import aiohttp
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 import gradio as gr
-import requests
-import time
-
-
-#  UNCOMMENT TO USE WHISPER
-# import warnings
-# import whisper
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi.staticfiles import StaticFiles
+import uuid
+import queue
 
 from langchain import ConversationChain, LLMChain
 
 from langchain.agents import load_tools, initialize_agent, AgentType
+from langchain.agents.conversational.prompt import SUFFIX as AGENT_SUFFIX
 from langchain.chains.conversation.memory import ConversationBufferMemory
 from langchain.llms import OpenAI
 from langchain.chat_models import ChatOpenAI
-from threading import Lock
 
-# Console to variable
-from io import StringIO
-import sys
 import re
 
 from openai.error import AuthenticationError, InvalidRequestError, RateLimitError
@@ -35,13 +35,28 @@ from langchain.prompts import PromptTemplate
 
 from polly_utils import PollyVoiceData, NEURAL_ENGINE
 from azure_utils import AzureVoiceData
+from concurrency_utils import SessionExecutor, PER_SESSION_MODE, GLOBAL_LOCK_MODE
+from trace_utils import TraceCallbackHandler, format_trace
+from streaming_utils import AnswerStreamHandler, iter_partial_results, AGENT_ANSWER_PREFIX
+from language_utils import is_in_language
+from metrics_utils import Counters
+from tts_utils import TTSCache, PipelinedSpeaker, SpeechStreams, open_speech, start_speech_warmup
+from media_utils import MediaJanitor, new_output_path, media_url, AUDIO_OUTPUT_DIR, VIDEO_OUTPUT_DIR, MEDIA_URL_PATH
+from whisper_utils import RunPodWhisperClient, WhisperJobError, inline_audio
+from s3_utils import S3AudioStore
+from local_whisper_utils import LocalWhisperEngine
+from audio_utils import shrink_recording
+from http_utils import get_session
+from openai_utils import with_api_key
 
 # Pertains to question answering functionality
 from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores.faiss import FAISS
 from langchain.docstore.document import Document
 from langchain.chains.question_answering import load_qa_chain
+from embedding_utils import EmbeddingCache, CachedEmbeddings
+from faiss_utils import FaissIndexStore, build_vector_store
+from splitter_utils import split_text
+from retrieval_utils import AnswerCache, answer_question
 
 from dotenv import load_dotenv
 
@@ -83,97 +98,151 @@ PROMPT_TEMPLATE = PromptTemplate(
 )
 
 FORCE_TRANSLATE_DEFAULT = True  # TODO: Change back to True?
+# Put the Express-inator instructions into the agent's request instead of restating its answer
+FUSE_EXPRESS_DEFAULT = False
+EXPRESS_METRICS = Counters("Express-inator")
 USE_GPT4_DEFAULT = False
 
 POLLY_VOICE_DATA = PollyVoiceData()
 AZURE_VOICE_DATA = AzureVoiceData()
 
+# Pertains to text-to-speech functionality
+TTS_CACHE = TTSCache()
+TTS_SPEAKER = PipelinedSpeaker(functools.partial(open_speech, cache=TTS_CACHE))
+
+# Stream spoken replies to the browser while Polly synthesizes them, instead of writing a file first
+STREAM_AUDIO_DEFAULT = True
+SPEECH_STREAMS = SpeechStreams(TTS_SPEAKER)
+SPEECH_STREAM_PATH = "/tts/stream/"
+SERVER_PORT = int(os.environ.get("GRADIO_SERVER_PORT", "7860"))
+
+# The reply to an empty question, and translations of canned replies, which transform_text uses
+# instead of asking the LLM, so that they are always spoken the same way
+# The agent's prompt follows the user's input with the turn's instructions for the answer, e.g. its
+# language level or the fused Express-inator instructions. The memory keeps only the input, so the
+# instructions aren't stored in the conversation history and re-sent with every later turn.
+AGENT_PROMPT_SUFFIX = AGENT_SUFFIX.replace("{input}", "{input}{instructions}")
+AGENT_INPUT_VARIABLES = ["input", "instructions", "chat_history", "agent_scratchpad"]
+
+EMPTY_QUESTION_REPLY = "What's on your mind?"
+KNOWN_TRANSLATIONS = {
+    (EMPTY_QUESTION_REPLY, "Russian"): "Что у вас на уме?",
+}
+
+# At startup, connect to Polly and synthesize common phrases in the default languages' voices
+# on a background thread, as they are spoken after transform_text. Set SPEECH_WARMUP=false to skip it.
+SPEECH_WARMUP = os.environ.get("SPEECH_WARMUP", "true").lower() == "true"
+SPEECH_WARMUP_LANGUAGES = [TRANSLATE_TO_DEFAULT]
+SPEECH_WARMUP_PHRASES = [EMPTY_QUESTION_REPLY]
+
+# Each reply's audio and video goes to its own file, the janitor deletes them when old
+MEDIA_JANITOR = MediaJanitor([AUDIO_OUTPUT_DIR, VIDEO_OUTPUT_DIR])
+MEDIA_JANITOR.start()
+
+# Pertains to concurrent chat sessions
+# PER_SESSION_MODE runs each session's turns in order on a shared pool of MAX_CHAT_WORKERS threads,
+# GLOBAL_LOCK_MODE runs one turn at a time across all sessions.
+CONCURRENCY_MODE = os.environ.get("CONCURRENCY_MODE", PER_SESSION_MODE)
+MAX_CHAT_WORKERS = int(os.environ.get("MAX_CHAT_WORKERS", "8"))
+
+# Show the answer in the chatbot token by token while the agent and Express-inator generate it
+STREAM_OUTPUT_DEFAULT = True
+
+# Pertains to question answering functionality
+# Embeddings of document chunks are cached on disk, so a re-submitted document only embeds what changed
+EMBEDDING_CACHE = EmbeddingCache()
+# Indexes saved by name in the Embeddings tab, memory-mapped and shared by all sessions that load them
+FAISS_INDEX_STORE = FaissIndexStore()
+# Answers to questions about the same document are reused when the question is asked again
+ANSWER_CACHE = AnswerCache()
+
 # Pertains to WHISPER functionality
 WHISPER_DETECT_LANG = "Russian"
-WHISPER_URL = "https://api.runpod.ai/v2/faster-whisper/runsync"
+WHISPER_URL = "https://api.runpod.ai/v2/faster-whisper"
 AWS_DEFAULT_REGION = os.environ["AWS_DEFAULT_REGION"]
 BUCKET_NAME = 'langchain57'
 
-s3 = boto3.client('s3')
-
-
-# UNCOMMENT TO USE WHISPER
-# warnings.filterwarnings("ignore")
-# WHISPER_MODEL = whisper.load_model("tiny")
-# print("WHISPER_MODEL", WHISPER_MODEL)
-
-
-# UNCOMMENT TO USE LOCAL WHISPER
-# def transcribe(aud_inp, whisper_lang):
-#     if aud_inp is None:
-#         return ""
-#     aud = whisper.load_audio(aud_inp)
-#     aud = whisper.pad_or_trim(aud)
-#     mel = whisper.log_mel_spectrogram(aud).to(WHISPER_MODEL.device)
-#     _, probs = WHISPER_MODEL.detect_language(mel)
-#     options = whisper.DecodingOptions()
-#     if whisper_lang != WHISPER_DETECT_LANG:
-#         whisper_lang_code = POLLY_VOICE_DATA.get_whisper_lang_code(whisper_lang)
-#         options = whisper.DecodingOptions(language=whisper_lang_code)
-#     result = whisper.decode(WHISPER_MODEL, mel, options)
-#     print("result.text", result.text)
-#     result_text = ""
-#     if result and result.text:
-#         result_text = result.text
-#     return result_text
+s3 = boto3.client('s3', region_name=AWS_DEFAULT_REGION)
+# Recordings too large to send inline are uploaded here, and deleted once transcribed
+AUDIO_STORE = S3AudioStore(s3, BUCKET_NAME)
+# Only warns if recordings left behind don't expire, on a background thread so that it never delays startup
+threading.Thread(target=AUDIO_STORE.check_lifecycle, name="s3-lifecycle-check", daemon=True).start()
 
-# SERVERLESS WHISPER
-def transcribe(aud_inp, whisper_lang):
+# Clips are transcribed as jobs on the serverless endpoint, polled on Gradio's event loop, or
+# with "local" on the CPU, by a model that is loaded on the first clip
+RUNPOD_WHISPER_BACKEND = "runpod"
+LOCAL_WHISPER_BACKEND = "local"
+WHISPER_BACKEND = os.environ.get("WHISPER_BACKEND", RUNPOD_WHISPER_BACKEND)
+WHISPER_CLIENT = RunPodWhisperClient(WHISPER_API_KEY, url=WHISPER_URL)
+LOCAL_WHISPER_ENGINE = LocalWhisperEngine()
+
+
+# LOCAL WHISPER
+async def transcribe_locally(aud_inp, whisper_lang):
+    language = None
+    if whisper_lang != WHISPER_DETECT_LANG:
+        language = POLLY_VOICE_DATA.get_whisper_lang_code(whisper_lang)
+    try:
+        text = await LOCAL_WHISPER_ENGINE.transcribe(aud_inp, language)
+    except Exception as e:
+        print("Local whisper transcription failed:", repr(e))
+        return ""
+    print("whisper.text:", text, LOCAL_WHISPER_ENGINE.metrics)
+    return text
+
+
+async def transcribe(aud_inp, whisper_lang):
     if aud_inp is None:
         return ""
-    
-    audio_url = share_url(aud_inp)
+
+    # Downmixed, resampled, without the silence around the speech and compressed, so that it's
+    # faster to send and to transcribe
+    audio_path = await asyncio.to_thread(shrink_recording, aud_inp)
+    try:
+        if WHISPER_BACKEND == LOCAL_WHISPER_BACKEND:
+            return await transcribe_locally(audio_path, whisper_lang)
+        return await transcribe_serverless(audio_path, whisper_lang)
+    finally:
+        if audio_path != aud_inp:
+            os.remove(audio_path)
+
+
+# SERVERLESS WHISPER
+async def transcribe_serverless(aud_inp, whisper_lang):
+    # Reading and uploading block, so they run on a thread rather than on the event loop
+    try:
+        audio, uploaded_key = await asyncio.to_thread(share_audio, aud_inp)
+    except (BotoCoreError, ClientError) as e:
+        print("Uploading the recording failed:", repr(e))
+        return ""
 
     if whisper_lang == "Russian":
         lang = "ru"
     else:
         lang = ""
-    
-    payload = {"input": {
-            "audio": audio_url,
-            "model": "base",
-            "transcription": "plain text",
-            "translate": False,
-            "language": lang,
-            "temperature": 0,
-            "best_of": 5,
-            "beam_size": 5,
-            "suppress_tokens": "-1",
-            "condition_on_previous_text": False,
-            "temperature_increment_on_fallback": 0.2,
-            "compression_ratio_threshold": 2.4,
-            "logprob_threshold": -1,
-            "no_speech_threshold": 0.6
-        }}
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "Authorization": "Bearer " + WHISPER_API_KEY
-    }
 
-    response = requests.post(WHISPER_URL, json=payload, headers=headers)
-
-    print(response.text)
-    # data = response.json()
-    # if data['status'] == 'IN_QUEUE':
-    #     job_id = data['id']
-    #     url = "https://api.runpod.ai/v2/faster-whisper/status/" + job_id
-    #     while data['status'] == 'IN_QUEUE':
-    #         response = requests.get(url, headers=headers)
-    #         data = response.json()
-    #         print(data)
-    #     return data['output']['transcription']
-    # else:
-    #     return ""
-
-    data = response.json()
-    segment = data['output']['segments'][0]
-    text = segment['text']
+    try:
+        text = await WHISPER_CLIENT.transcribe(
+            audio,
+            model="base",
+            transcription="plain text",
+            translate=False,
+            language=lang,
+            temperature=0,
+            best_of=5,
+            beam_size=5,
+            suppress_tokens="-1",
+            condition_on_previous_text=False,
+            temperature_increment_on_fallback=0.2,
+            compression_ratio_threshold=2.4,
+            logprob_threshold=-1,
+            no_speech_threshold=0.6)
+    except (WhisperJobError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("Whisper transcription failed:", repr(e))
+        return ""
+    finally:
+        if uploaded_key:
+            await asyncio.to_thread(AUDIO_STORE.delete, uploaded_key)
 
     print("whisper.text:", text)
 
@@ -184,23 +253,17 @@ def transcribe(aud_inp, whisper_lang):
 ssl._create_default_https_context = ssl._create_unverified_context
 
 # AWS AUDIO FILE URL
-def share_url(aud_inp):
-    unix_time = int(time.time())
-    dest_key = f"{unix_time}_aud.mp3"
-
-    # upload file to aws
-    s3.upload_file(aud_inp, BUCKET_NAME, dest_key)
-
-    # set permission
-    response_acl = s3.put_object_acl(
-        Bucket=BUCKET_NAME,
-        Key=dest_key,
-        ACL='public-read',
-    )
-
-    url = "https://" + BUCKET_NAME + ".s3." + AWS_DEFAULT_REGION + ".amazonaws.com/" + dest_key
+def share_audio(aud_inp):
+    """Return the audio of a Whisper job's input for the recording at aud_inp, and the key it was
+    uploaded to, or None if it's sent inline.
+    """
+    audio = inline_audio(aud_inp)
+    if audio is not None:
+        return audio, None
 
-    return url    
+    # upload file to aws, the endpoint downloads it with a presigned url
+    key, url = AUDIO_STORE.upload(aud_inp)
+    return {"audio": url}, key
 
 
 # TEMPORARY FOR TESTING
@@ -223,10 +286,13 @@ def transcribe_dummy(aud_inp_tb, whisper_lang):
 
 
 # Pertains to Express-inator functionality
-def transform_text(desc, express_chain, num_words, formality,
-                   anticipation_level, joy_level, trust_level,
-                   fear_level, surprise_level, sadness_level, disgust_level, anger_level,
-                   lang_level, translate_to, literary_style, force_translate):
+def build_express_instructions(num_words, formality,
+                               anticipation_level, joy_level, trust_level,
+                               fear_level, surprise_level, sadness_level, disgust_level, anger_level,
+                               lang_level, translate_to, literary_style, force_translate):
+    """Return the instruction fragments of PROMPT_TEMPLATE, keyed by its input variables
+    other than original_words. Empty fragments mean no instruction.
+    """
     num_words_prompt = ""
     if num_words and int(num_words) != 0:
         num_words_prompt = "using up to " + str(num_words) + " words, "
@@ -320,25 +386,41 @@ def transform_text(desc, express_chain, num_words, formality,
         elif literary_style == "FAQ":
             literary_style_str = "as a FAQ with several questions and answers, "
 
-    formatted_prompt = PROMPT_TEMPLATE.format(
-        original_words=desc,
-        num_words=num_words_prompt,
-        formality=formality_str,
-        emotions=emotions_str,
-        lang_level=lang_level_str,
-        translate_to=translate_to_str,
-        literary_style=literary_style_str
-    )
+    return {'num_words': num_words_prompt, 'formality': formality_str, 'emotions': emotions_str,
+            'lang_level': lang_level_str, 'translate_to': translate_to_str, 'literary_style': literary_style_str}
+
+
+def record_saved_round_trip(reason):
+    EXPRESS_METRICS.increment(reason)
+    EXPRESS_METRICS.increment("saved_round_trips")
+    print("Saved an Express-inator LLM round-trip this turn (" + reason + "). " + str(EXPRESS_METRICS))
+
+
+def transform_text(desc, express_chain, num_words, formality,
+                   anticipation_level, joy_level, trust_level,
+                   fear_level, surprise_level, sadness_level, disgust_level, anger_level,
+                   lang_level, translate_to, literary_style, force_translate, callbacks=None):
+    instructions = build_express_instructions(num_words, formality, anticipation_level, joy_level, trust_level,
+                                              fear_level, surprise_level, sadness_level, disgust_level,
+                                              anger_level, lang_level, translate_to, literary_style,
+                                              force_translate)
+    formatted_prompt = PROMPT_TEMPLATE.format(original_words=desc, **instructions)
 
-    trans_instr = num_words_prompt + formality_str + emotions_str + lang_level_str + translate_to_str + literary_style_str
+    trans_instr = "".join(instructions.values())
 
     print("trans_instr: " + trans_instr)
-    
-    if express_chain and len(trans_instr.strip()) > 0:
-        generated_text = express_chain.run(
-            {'original_words': desc, 'num_words': num_words_prompt, 'formality': formality_str,
-             'emotions': emotions_str, 'lang_level': lang_level_str, 'translate_to': translate_to_str,
-             'literary_style': literary_style_str}).strip()
+
+    # Restating text that is already in the output language, with no other instructions, changes nothing
+    only_translate = trans_instr == "translated to " + translate_to + ", "
+    if express_chain and only_translate and is_in_language(desc, translate_to):
+        record_saved_round_trip("already_in_language")
+        generated_text = desc
+    elif express_chain and only_translate and (desc, translate_to) in KNOWN_TRANSLATIONS:
+        record_saved_round_trip("known_translation")
+        generated_text = KNOWN_TRANSLATIONS[(desc, translate_to)]
+    elif express_chain and len(trans_instr.strip()) > 0:
+        EXPRESS_METRICS.increment("restatements")
+        generated_text = express_chain.run(dict(original_words=desc, **instructions), callbacks=callbacks).strip()
     else:
         print("Not transforming text")
         generated_text = desc
@@ -363,10 +445,11 @@ def load_chain(tools_list, llm):
         tool_names = tools_list
         tools = load_tools(tool_names, llm=llm, news_api_key=news_api_key, tmdb_bearer_token=tmdb_bearer_token)
 
-        memory = ConversationBufferMemory(memory_key="chat_history")
+        memory = ConversationBufferMemory(memory_key="chat_history", input_key="input")
 
         chain = initialize_agent(tools, llm, agent=AgentType.CONVERSATIONAL_REACT_DESCRIPTION, verbose=True,
-                                 memory=memory)
+                                 memory=memory, agent_kwargs={"suffix": AGENT_PROMPT_SUFFIX,
+                                                              "input_variables": AGENT_INPUT_VARIABLES})
         express_chain = LLMChain(llm=llm, prompt=PROMPT_TEMPLATE, verbose=True)
     return chain, express_chain, memory
 
@@ -382,26 +465,35 @@ def set_openai_api_key(api_key, use_gpt4):
             len(os.environ["OPENAI_API_KEY"])))
 
         if use_gpt4:
-            llm = ChatOpenAI(temperature=0, max_tokens=MAX_TOKENS, model_name="gpt-4")
+            llm = ChatOpenAI(temperature=0, max_tokens=MAX_TOKENS, model_name="gpt-4", streaming=True,
+                             openai_api_key=api_key)
             print("Trying to use llm ChatOpenAI with gpt-4")
         else:
             print("Trying to use llm ChatOpenAI with gpt-3.5-turbo")
             # llm = ChatOpenAI(temperature=0, max_tokens=MAX_TOKENS, model_name="gpt-3.5-turbo")
-            llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo")
+            llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo", streaming=True, openai_api_key=api_key)
 
         print(str(datetime.datetime.now()) + ": After OpenAI, OPENAI_API_KEY length: " + str(
             len(os.environ["OPENAI_API_KEY"])))
+        # Sessions' turns run at the same time, so each model sends its session's key with every
+        # request instead of relying on the global openai.api_key
+        llm = with_api_key(llm, api_key)
         chain, express_chain, memory = load_chain(TOOLS_DEFAULT_LIST, llm)
 
         # Pertains to question answering functionality
-        embeddings = OpenAIEmbeddings()
+        # CachedEmbeddings sends the chunks in parallel batches and retries them with backoff itself,
+        # questions are embedded with OpenAIEmbeddings' own retries
+        embeddings = CachedEmbeddings(with_api_key(OpenAIEmbeddings(max_retries=1, openai_api_key=api_key), api_key),
+                                      EMBEDDING_CACHE,
+                                      query_embeddings=with_api_key(OpenAIEmbeddings(openai_api_key=api_key), api_key))
 
         if use_gpt4:
-            qa_chain = load_qa_chain(ChatOpenAI(temperature=0, model_name="gpt-4"), chain_type="stuff")
+            qa_llm = ChatOpenAI(temperature=0, model_name="gpt-4", streaming=True, openai_api_key=api_key)
             print("Trying to use qa_chain ChatOpenAI with gpt-4")
         else:
             print("Trying to use qa_chain ChatOpenAI with gpt-3.5-turbo")
-            qa_chain = load_qa_chain(ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo"), chain_type="stuff")
+            qa_llm = ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo", streaming=True, openai_api_key=api_key)
+        qa_chain = load_qa_chain(with_api_key(qa_llm, api_key), chain_type="stuff")
 
         print(str(datetime.datetime.now()) + ": After load_chain, OPENAI_API_KEY length: " + str(
             len(os.environ["OPENAI_API_KEY"])))
@@ -412,17 +504,15 @@ def set_openai_api_key(api_key, use_gpt4):
 chain, express_chain, llm, embeddings, qa_chain, memory, use_gpt4 = set_openai_api_key(OPENAI_API_KEY, USE_GPT4_DEFAULT)
 
 
-def run_chain(chain, inp, capture_hidden_text):
+def run_chain(chain, inp, capture_hidden_text, callbacks=None, instructions=""):
     output = ""
     hidden_text = None
     if capture_hidden_text:
         error_msg = None
-        tmp = sys.stdout
-        hidden_text_io = StringIO()
-        sys.stdout = hidden_text_io
+        trace_handler = TraceCallbackHandler()
 
         try:
-            output = chain.run(input=inp)
+            output = chain.run(input=inp, instructions=instructions, callbacks=[trace_handler] + (callbacks or []))
         except AuthenticationError as ae:
             error_msg = AUTH_ERR_MSG + str(datetime.datetime.now()) + ". " + str(ae)
             print("error_msg", error_msg)
@@ -441,24 +531,8 @@ def run_chain(chain, inp, capture_hidden_text):
             else:
                 error_msg = "\n\n" + BUG_FOUND_MSG + ":\n\n" + str(e)
 
-        sys.stdout = tmp
-        hidden_text = hidden_text_io.getvalue()
-
-        # remove escape characters from hidden_text
-        hidden_text = re.sub(r'\x1b[^m]*m', '', hidden_text)
-
-        # remove "Entering new AgentExecutor chain..." from hidden_text
-        hidden_text = re.sub(r"Entering new AgentExecutor chain...\n", "", hidden_text)
-
-        # remove "Finished chain." from hidden_text
-        hidden_text = re.sub(r"Finished chain.", "", hidden_text)
-
         # Add newline after "Thought:" "Action:" "Observation:" "Input:" and "AI:"
-        hidden_text = re.sub(r"Thought:", "\n\nThought:", hidden_text)
-        hidden_text = re.sub(r"Action:", "\n\nAction:", hidden_text)
-        hidden_text = re.sub(r"Observation:", "\n\nObservation:", hidden_text)
-        hidden_text = re.sub(r"Input:", "\n\nInput:", hidden_text)
-        hidden_text = re.sub(r"AI:", "\n\nAI:", hidden_text)
+        hidden_text = format_trace(trace_handler.get_text())
 
         if error_msg:
             hidden_text += error_msg
@@ -466,7 +540,7 @@ def run_chain(chain, inp, capture_hidden_text):
         print("hidden_text: ", hidden_text)
     else:
         try:
-            output = chain.run(input=inp)
+            output = chain.run(input=inp, instructions=instructions, callbacks=callbacks)
         except AuthenticationError as ae:
             output = AUTH_ERR_MSG + str(datetime.datetime.now()) + ". " + str(ae)
             print("output", output)
@@ -495,18 +569,65 @@ def reset_memory(history, memory):
 
 class ChatWrapper:
 
-    def __init__(self):
-        self.lock = Lock()
-
-    def __call__(
+    def __init__(self, concurrency_mode=CONCURRENCY_MODE, max_workers=MAX_CHAT_WORKERS):
+        self.concurrency_mode = concurrency_mode
+        self.executor = SessionExecutor(max_workers)
+
+    def __call__(self, *inputs):
+        """Execute the chat functionality.
+        The last input is the session id, which is created on the first turn of a session
+        and returned as the last output so that Gradio keeps it in the session state.
+        """
+        *chat_inputs, session_id = inputs
+        if not session_id:
+            session_id = uuid.uuid4().hex
+
+        outputs = self.executor.run(self.executor_key(session_id), self.run_turn, *chat_inputs)
+        return outputs + (session_id,)
+
+    def stream(self, *inputs):
+        """Execute the chat functionality, yielding the chatbot with the partial answer
+        while it is generated and the complete outputs at the end.
+        """
+        *chat_inputs, session_id = inputs
+        if not session_id:
+            session_id = uuid.uuid4().hex
+        inp = chat_inputs[1]
+        history = chat_inputs[2] = chat_inputs[2] or []
+
+        # The turn appends its row to history on the worker thread, partial results are shown
+        # on top of the history before the turn, or the last row could appear twice
+        history_before = list(history)
+        updates = queue.Queue()
+        future = self.executor.submit(self.executor_key(session_id), self.run_turn, *chat_inputs,
+                                      on_partial=updates.put)
+        for partial_output in iter_partial_results(future, updates):
+            # Chatbot, history, file, audio html, audio file, message, session id
+            yield (history_before + [(inp, partial_output)], list(history_before), gr.update(), gr.update(),
+                   gr.update(), "", session_id)
+        yield future.result() + (session_id,)
+
+    def executor_key(self, session_id):
+        # All sessions share one key, and so run one turn at a time, when using the global lock
+        if self.concurrency_mode == GLOBAL_LOCK_MODE:
+            return GLOBAL_LOCK_MODE
+        return session_id
+
+    def run_turn(
             self, api_key: str, inp: str, history: Optional[Tuple[str, str]], chain: Optional[ConversationChain],
             trace_chain: bool, speak_text: bool, talking_head: bool, monologue: bool, express_chain: Optional[LLMChain],
             num_words, formality, anticipation_level, joy_level, trust_level,
             fear_level, surprise_level, sadness_level, disgust_level, anger_level,
-            lang_level, translate_to, literary_style, qa_chain, docsearch, use_embeddings, force_translate
+            lang_level, translate_to, literary_style, qa_chain, docsearch, use_embeddings, force_translate,
+            fuse_express, on_partial=None
     ):
-        """Execute the chat functionality."""
-        self.lock.acquire()
+        """Run a single chat turn.
+        If on_partial is given, it is called with the answer generated so far while the LLMs stream it.
+        """
+        agent_callbacks, answer_callbacks = None, None
+        if on_partial:
+            agent_callbacks = [AnswerStreamHandler(on_partial, answer_prefix=AGENT_ANSWER_PREFIX)]
+            answer_callbacks = [AnswerStreamHandler(on_partial)]
         try:
             print("\n==== date/time: " + str(datetime.datetime.now()) + " ====")
             print("inp: " + inp)
@@ -515,26 +636,25 @@ class ChatWrapper:
             print("talking_head: ", talking_head)
             print("monologue: ", monologue)
             history = history or []
+            EXPRESS_METRICS.increment("turns")
             # If chain is None, that is because no API key was provided.
             output = "Please paste your OpenAI key from openai.com to use this app. " + str(datetime.datetime.now())
             hidden_text = output
 
             # if chain:
-            # Set OpenAI key
-            import openai
-            openai.api_key = api_key
+            # The chains send the key they were created with, see set_openai_api_key
             if not monologue:
                 if use_embeddings:
                     if inp and inp.strip() != "":
                         if docsearch:
-                            docs = docsearch.similarity_search(inp)
-                            output = str(qa_chain.run(input_documents=docs, question=inp))
+                            output = str(answer_question(qa_chain, docsearch, inp, callbacks=answer_callbacks,
+                                                         cache=ANSWER_CACHE))
                         else:
                             output, hidden_text = "Please supply some text in the the Embeddings tab.", None
                     else:
-                        output, hidden_text = "What's on your mind?", None
+                        output, hidden_text = EMPTY_QUESTION_REPLY, None
                 else:
-                    complete_inp = inp
+                    instructions = ""
                     # If the user has selected an N1-N5 language level and an output language,
                     # then put that in the request so that the response is at that level of language proficiency.
                     if lang_level and lang_level != LANG_LEVEL_DEFAULT \
@@ -554,12 +674,25 @@ class ChatWrapper:
                             elif jlpt_level == "N4":
                                 jlpt_range = "N4 and N"
 
-                            complete_inp = inp + " Your response should be short, and in " + \
+                            instructions = " Your response should be short, and in " + \
                                             translate_to + " using only vocabulary and grammar equivalent to that found in JLPT level " + \
                                             jlpt_range + ". Don't translate anything back into English."
 
-                    print("complete_inp to run_chain", complete_inp)
-                    output, hidden_text = run_chain(chain, inp=complete_inp, capture_hidden_text=trace_chain)
+                    if fuse_express:
+                        # Have the agent apply the Express-inator instructions to its answer,
+                        # so that the answer needn't be restated by a second LLM call
+                        trans_instr = "".join(build_express_instructions(
+                            num_words, formality, anticipation_level, joy_level, trust_level, fear_level,
+                            surprise_level, sadness_level, disgust_level, anger_level, lang_level, translate_to,
+                            literary_style, force_translate).values()).strip()
+                        if trans_instr:
+                            instructions += " State your response " + trans_instr.rstrip(",") + "."
+                            record_saved_round_trip("fused")
+                        express_chain = None
+
+                    print("instructions to run_chain", instructions)
+                    output, hidden_text = run_chain(chain, inp=inp, capture_hidden_text=trace_chain,
+                                                    callbacks=agent_callbacks, instructions=instructions)
             else:
                 output, hidden_text = inp, None
 
@@ -568,14 +701,15 @@ class ChatWrapper:
             output = transform_text(output, express_chain, num_words, formality, anticipation_level, joy_level,
                                     trust_level,
                                     fear_level, surprise_level, sadness_level, disgust_level, anger_level,
-                                    lang_level, translate_to, literary_style, force_translate)
+                                    lang_level, translate_to, literary_style, force_translate,
+                                    callbacks=answer_callbacks)
 
             text_to_display = output
             if trace_chain:
                 text_to_display = hidden_text + "\n\n" + output
             history.append((inp, text_to_display))
 
-            html_video, temp_file, html_audio, temp_aud_file = None, None, None, None
+            temp_file, html_audio, temp_aud_file = None, None, None
             if speak_text:
                 # if talking_head:
                 #     if len(output) <= MAX_TALKING_HEAD_TEXT_LENGTH:
@@ -597,21 +731,14 @@ class ChatWrapper:
 
         except Exception as e:
             raise e
-        finally:
-            self.lock.release()
-        return history, history, html_video, temp_file, html_audio, temp_aud_file, ""
-        # return history, history, html_audio, temp_aud_file, ""
+        # return history, history, html_video, temp_file, html_audio, temp_aud_file, ""
+        return history, history, temp_file, html_audio, temp_aud_file, ""
 
 chat = ChatWrapper()
+chat_fn = chat.stream if STREAM_OUTPUT_DEFAULT else chat
 
 
-def do_html_audio_speak(words_to_speak, polly_language):
-    polly_client = boto3.Session(
-        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
-        region_name=os.environ["AWS_DEFAULT_REGION"]
-    ).client('polly')
-
+def get_speech_voice(polly_language):
     # voice_id, language_code, engine = POLLY_VOICE_DATA.get_voice(polly_language, "Female")
     voice_id, language_code, engine = POLLY_VOICE_DATA.get_voice(polly_language, "Male")
     if not voice_id:
@@ -619,38 +746,41 @@ def do_html_audio_speak(words_to_speak, polly_language):
         voice_id = "Matthew"
         language_code = "en-US"
         engine = NEURAL_ENGINE
-    response = polly_client.synthesize_speech(
-        Text=words_to_speak,
-        OutputFormat='mp3',
-        VoiceId=voice_id,
-        LanguageCode=language_code,
-        Engine=engine
-    )
+    return voice_id, language_code, engine
 
-    html_audio = '<pre>no audio</pre>'
 
-    # Save the audio stream returned by Amazon Polly on Lambda's temp directory
-    if "AudioStream" in response:
-        with closing(response["AudioStream"]) as stream:
-            # output = os.path.join("/tmp/", "speech.mp3")
-
-            try:
-                with open('audios/tempfile.mp3', 'wb') as f:
-                    f.write(stream.read())
-                temp_aud_file = gr.File("audios/tempfile.mp3")
-                # temp_aud_file_url = "/file=" + temp_aud_file.value['name']
-                temp_aud_file_url = temp_aud_file.value['name']
-                html_audio = f'<audio autoplay><source src={temp_aud_file_url} type="audio/mp3"></audio>'
-            except IOError as error:
-                # Could not write to file, exit gracefully
-                print(error)
-                return None, None
-    else:
-        # The response didn't contain audio data, exit gracefully
+def do_html_audio_speak(words_to_speak, polly_language):
+    voice_id, language_code, engine = get_speech_voice(polly_language)
+
+    if STREAM_AUDIO_DEFAULT:
+        # The audio is synthesized when the browser requests it from stream_speech
+        stream_id = SPEECH_STREAMS.register(words_to_speak, voice_id, language_code, engine)
+        html_audio = f'<audio autoplay><source src={SPEECH_STREAM_PATH}{stream_id} type="audio/mpeg"></audio>'
+        return html_audio, None
+
+    # Long replies are synthesized sentence by sentence in parallel, each piece cached on its own
+    audio = b"".join(TTS_SPEAKER.iter_audio(words_to_speak, voice_id, language_code, engine))
+    print(TTS_CACHE.metrics)
+    if not audio:
+        # The responses didn't contain audio data, exit gracefully
         print("Could not stream audio")
         return None, None
 
-    return html_audio, "audios/tempfile.mp3"
+    html_audio = '<pre>no audio</pre>'
+
+    # Save the audio returned by Amazon Polly or the cache so that it can be served. It is served
+    # from AUDIO_OUTPUT_DIR, the janitor deletes it there
+    aud_file = new_output_path(AUDIO_OUTPUT_DIR, ".mp3")
+    try:
+        with open(aud_file, 'wb') as f:
+            f.write(audio)
+        html_audio = f'<audio autoplay><source src={media_url(aud_file)} type="audio/mp3"></audio>'
+    except IOError as error:
+        # Could not write to file, exit gracefully
+        print(error)
+        return None, None
+
+    return html_audio, None
 
 
 def create_html_video(file_name, width):
@@ -673,22 +803,21 @@ def do_html_video_speak(words_to_speak, azure_language):
         'animation_pipeline': 'high_speed',
     }
     api_endpoint = "https://api.exh.ai/animations/v1/generate_lipsync"
-    res = requests.post(api_endpoint, json=body, headers=headers)
+    res = get_session().post(api_endpoint, json=body, headers=headers)
     print("res.status_code: ", res.status_code)
 
     html_video = '<pre>no video</pre>'
+    video_file = new_output_path(VIDEO_OUTPUT_DIR, ".mp4")
     if isinstance(res.content, bytes):
         response_stream = io.BytesIO(res.content)
         print("len(res.content)): ", len(res.content))
 
-        with open('videos/tempfile.mp4', 'wb') as f:
+        with open(video_file, 'wb') as f:
             f.write(response_stream.read())
-        temp_file = gr.File("videos/tempfile.mp4")
-        temp_file_url = "/file=" + temp_file.value['name']
-        html_video = f'<video width={TALKING_HEAD_WIDTH} height={TALKING_HEAD_WIDTH} autoplay><source src={temp_file_url} type="video/mp4" poster="Masahiro.png"></video>'
+        html_video = f'<video width={TALKING_HEAD_WIDTH} height={TALKING_HEAD_WIDTH} autoplay><source src={media_url(video_file)} type="video/mp4" poster="Masahiro.png"></video>'
     else:
         print('video url unknown')
-    return html_video, "videos/tempfile.mp4"
+    return html_video, None
 
 
 def update_selected_tools(widget, state, llm):
@@ -716,16 +845,51 @@ def update_foo(widget, state):
 
 
 # Pertains to question answering functionality
-def update_embeddings(embeddings_text, embeddings, qa_chain):
+def update_embeddings(embeddings_text, embeddings, qa_chain, progress=gr.Progress()):
     if embeddings_text:
-        text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-        texts = text_splitter.split_text(embeddings_text)
-
-        docsearch = FAISS.from_texts(texts, embeddings)
-        print("Embeddings updated")
+        # Chunks are embedded as they are split off the text, and only the ones that aren't
+        # in the embedding cache yet are sent to OpenAI
+        texts, vectors = embeddings.embed_chunks(
+            split_text(embeddings_text),
+            on_progress=lambda num_done, num_chunks: progress((num_done, num_chunks), desc="Embedding",
+                                                              unit="chunks"))
+        # Big documents get an approximate nearest neighbor index, so questions don't get slower
+        docsearch = build_vector_store(texts, vectors, embeddings)
+        print("Embeddings updated.", EMBEDDING_CACHE.metrics)
         return docsearch
 
 
+def save_embeddings_index(index_name, docsearch):
+    if index_name and docsearch:
+        try:
+            FAISS_INDEX_STORE.save(index_name, docsearch)
+        except ValueError as e:
+            # An invalid name, shown in the UI
+            raise gr.Error(str(e))
+        except (OSError, RuntimeError) as e:
+            print("Saving the embeddings index failed:", repr(e))
+            raise gr.Error(f"Saving the embeddings index {index_name} failed: {e}")
+        print("Embeddings index saved:", index_name)
+    return gr.update(choices=FAISS_INDEX_STORE.names())
+
+
+def load_embeddings_index(index_name, embeddings, docsearch):
+    if index_name and embeddings:
+        try:
+            loaded_docsearch = FAISS_INDEX_STORE.load(index_name, embeddings)
+        except ValueError as e:
+            raise gr.Error(str(e))
+        except (OSError, RuntimeError) as e:
+            # E.g. a damaged index file
+            print("Loading the embeddings index failed:", repr(e))
+            raise gr.Error(f"Loading the embeddings index {index_name} failed: {e}")
+        if loaded_docsearch:
+            print("Embeddings index loaded:", index_name)
+            return loaded_docsearch
+        print("No embeddings index named", index_name)
+    return docsearch
+
+
 # Pertains to question answering functionality
 def update_use_embeddings(widget, state):
     if widget:
@@ -744,7 +908,9 @@ with gr.Blocks(css=".gradio-container {background-color: lightgray}") as block:
     talking_head_state = gr.State(False)
     monologue_state = gr.State(False)  # Takes the input and repeats it back to the user, optionally transforming it.
     force_translate_state = gr.State(FORCE_TRANSLATE_DEFAULT)  #
+    fuse_express_state = gr.State(FUSE_EXPRESS_DEFAULT)
     memory_state = gr.State()
+    session_id_state = gr.State()  # Set on the first chat turn, keeps a session's turns in order
 
     # Pertains to Express-inator functionality
     num_words_state = gr.State(NUM_WORDS_DEFAULT)
@@ -879,6 +1045,12 @@ with gr.Blocks(css=".gradio-container {background-color: lightgray}") as block:
         force_translate_cb.change(update_foo, inputs=[force_translate_cb, force_translate_state],
                                   outputs=[force_translate_state])
 
+        fuse_express_cb = gr.Checkbox(label="Have the agent apply output language and style directly "
+                                            "(faster, skips restating its answer)",
+                                      value=FUSE_EXPRESS_DEFAULT)
+        fuse_express_cb.change(update_foo, inputs=[fuse_express_cb, fuse_express_state],
+                               outputs=[fuse_express_state])
+
         speak_text_cb = gr.Checkbox(label="Speak text from agent", value=False)
         speak_text_cb.change(update_foo, inputs=[speak_text_cb, speak_text_state],
                              outputs=[speak_text_state])
@@ -1041,34 +1213,47 @@ with gr.Blocks(css=".gradio-container {background-color: lightgray}") as block:
                                          inputs=[embeddings_text_box, embeddings_state, qa_chain_state],
                                          outputs=[docsearch_state])
 
+        with gr.Row():
+            embeddings_index_name = gr.Dropdown(FAISS_INDEX_STORE.names(), label="Index name",
+                                                allow_custom_value=True)
+
+            embeddings_index_save = gr.Button(value="Save index", variant="secondary").style(full_width=False)
+            embeddings_index_save.click(save_embeddings_index, inputs=[embeddings_index_name, docsearch_state],
+                                        outputs=[embeddings_index_name])
+
+            embeddings_index_load = gr.Button(value="Load index", variant="secondary").style(full_width=False)
+            embeddings_index_load.click(load_embeddings_index,
+                                        inputs=[embeddings_index_name, embeddings_state, docsearch_state],
+                                        outputs=[docsearch_state])
+
     gr.HTML("""<center>
         Powered by <a href='https://github.com/hwchase17/langchain'>LangChain 🦜️🔗</a>
         </center>""")
 
-    message.submit(chat, inputs=[openai_api_key_textbox, message, history_state, chain_state, trace_chain_state,
+    message.submit(chat_fn, inputs=[openai_api_key_textbox, message, history_state, chain_state, trace_chain_state,
                                  speak_text_state, talking_head_state, monologue_state,
                                  express_chain_state, num_words_state, formality_state,
                                  anticipation_level_state, joy_level_state, trust_level_state, fear_level_state,
                                  surprise_level_state, sadness_level_state, disgust_level_state, anger_level_state,
                                  lang_level_state, translate_to_state, literary_style_state,
                                  qa_chain_state, docsearch_state, use_embeddings_state,
-                                 force_translate_state],
+                                 force_translate_state, fuse_express_state, session_id_state],
                     # outputs=[chatbot, history_state, audio_html, tmp_aud_file, message])
                     # outputs=[chatbot, history_state, video_html, my_file, audio_html, tmp_aud_file, message])
-                    outputs=[chatbot, history_state, my_file, audio_html, tmp_aud_file, message])
+                    outputs=[chatbot, history_state, my_file, audio_html, tmp_aud_file, message, session_id_state])
                 #    outputs=[chatbot, history_state, message])
 
-    submit.click(chat, inputs=[openai_api_key_textbox, message, history_state, chain_state, trace_chain_state,
+    submit.click(chat_fn, inputs=[openai_api_key_textbox, message, history_state, chain_state, trace_chain_state,
                                speak_text_state, talking_head_state, monologue_state,
                                express_chain_state, num_words_state, formality_state,
                                anticipation_level_state, joy_level_state, trust_level_state, fear_level_state,
                                surprise_level_state, sadness_level_state, disgust_level_state, anger_level_state,
                                lang_level_state, translate_to_state, literary_style_state,
                                qa_chain_state, docsearch_state, use_embeddings_state,
-                               force_translate_state],
+                               force_translate_state, fuse_express_state, session_id_state],
                 #  outputs=[chatbot, history_state, audio_html, tmp_aud_file, message])
                 #  outputs=[chatbot, history_state, video_html, my_file, audio_html, tmp_aud_file, message])
-                 outputs=[chatbot, history_state, my_file, audio_html, tmp_aud_file, message])
+                 outputs=[chatbot, history_state, my_file, audio_html, tmp_aud_file, message, session_id_state])
                 #  outputs=[chatbot, history_state, message])
 
     openai_api_key_textbox.change(set_openai_api_key,
@@ -1080,5 +1265,36 @@ with gr.Blocks(css=".gradio-container {background-color: lightgray}") as block:
                                   outputs=[chain_state, express_chain_state, llm_state, embeddings_state,
                                            qa_chain_state, memory_state, use_gpt4_state])
 
+# Streaming partial answers to the chatbot requires the queue
+block.queue(concurrency_count=MAX_CHAT_WORKERS)
+
+# Serve the Gradio app together with the endpoint spoken replies are streamed from
+app = FastAPI()
+
+
+@app.get(SPEECH_STREAM_PATH + "{stream_id}")
+def stream_speech(stream_id: str):
+    audio_blocks = SPEECH_STREAMS.open(stream_id)
+    if audio_blocks is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired audio stream")
+    return StreamingResponse(audio_blocks, media_type="audio/mpeg")
+
+
+# Replies' audio and video files, served from where they are written so that Gradio doesn't copy them
+for output_dir in [AUDIO_OUTPUT_DIR, VIDEO_OUTPUT_DIR]:
+    os.makedirs(output_dir, exist_ok=True)
+    app.mount(MEDIA_URL_PATH + output_dir, StaticFiles(directory=output_dir), name=output_dir)
+
+
+app = gr.mount_gradio_app(app, block, path="/")
+
+if SPEECH_WARMUP:
+    # The voices are looked up on the warmup thread as well. Each phrase is warmed up as it is
+    # spoken in the language, which is the phrase itself unless it has a known translation
+    start_speech_warmup(((get_speech_voice(language),
+                          [KNOWN_TRANSLATIONS.get((phrase, language), phrase) for phrase in SPEECH_WARMUP_PHRASES])
+                         for language in SPEECH_WARMUP_LANGUAGES), TTS_CACHE)
+
 # block.launch(debug=True, share=True)
-block.launch(debug=True, server_name="0.0.0.0")
+# block.launch(debug=True, server_name="0.0.0.0")
+uvicorn.run(app, host="0.0.0.0", port=SERVER_PORT)
@@ -0,0 +1,220 @@
+# This module shrinks microphone recordings before they are transcribed. The browser's
+# recordings are uncompressed, often 48 kHz and stereo, and start and end with silence, while
+# Whisper only needs 16 kHz mono speech. preprocess_recording pipes a recording through ffmpeg,
+# which decodes it to 16 kHz mono samples, drops the silence at its start and end and shortens
+# long pauses, and pipes what is left to a second ffmpeg, which encodes it as Opus. The samples
+# are handled a block at a time, so the whole waveform is never held in memory, and the Opus
+# file is small enough to be sent to the Whisper endpoint inline instead of being uploaded.
+
+import os
+import subprocess
+import tempfile
+from collections import deque
+
+import numpy as np
+
+from metrics_utils import Counters
+
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+
+# Whisper's sample rate, and Opus at a bitrate meant for speech
+SAMPLE_RATE = 16000
+OPUS_BITRATE = os.environ.get("OPUS_BITRATE", "24k")
+PREPROCESSED_EXTENSION = ".ogg"
+
+# Samples are read from the decoder 64 KB (2 s) at a time, and sorted into 30 ms frames. Like
+# local_whisper_utils.speech_chunks, a frame is silence unless it's louder than both this (about
+# -54 dBFS) and a few times the quietest tenth of the frames so far, i.e. the background noise,
+# or than a quarter of the loudest tenth, for recordings with hardly any pauses
+READ_BYTES = 64 * 1024
+FRAME_SECONDS = 0.03
+SILENCE_MIN_RMS = 0.002
+SILENCE_NOISE_FACTOR = 3
+SILENCE_LOUD_FACTOR = 0.25
+# The noise and loudness are those of the last 30 s
+SILENCE_LEVEL_SECONDS = 30
+# Silence kept after and before speech, so that pauses are at most twice as long
+SILENCE_PAD_SECONDS = 0.5
+
+PREPROCESSING_METRICS = Counters("Audio preprocessing")
+
+
+class SilenceTrimmer:
+    """Drops the silence at the start and end of a stream of 16 bit samples, and shortens
+    pauses, holding at most SILENCE_PAD_SECONDS of samples.
+    """
+
+    def feed(self, data):
+        """Return the bytes of data that are kept, the rest of a frame is kept until the next call."""
+        data = self.remainder + data
+        num_frames = len(data) // self.frame_bytes
+        self.remainder = data[num_frames * self.frame_bytes:]
+        if num_frames == 0:
+            return b""
+        samples = np.frombuffer(data, dtype=np.int16, count=num_frames * self.frame_bytes // 2)
+        rms = np.sqrt(np.mean(np.square(samples.reshape(num_frames, -1) / 32768.0), axis=1))
+        self.levels = np.concatenate((self.levels, rms))[-self.level_frames:]
+        noise, loud = np.percentile(self.levels, [10, 90])
+        threshold = max(SILENCE_MIN_RMS, min(SILENCE_NOISE_FACTOR * noise, SILENCE_LOUD_FACTOR * loud))
+        kept = []
+        for i, is_speech in enumerate(rms > threshold):
+            frame = data[i * self.frame_bytes:(i + 1) * self.frame_bytes]
+            if is_speech:
+                kept.extend(self.pause)
+                self.pause.clear()
+                kept.append(frame)
+                self.silent_frames = 0
+                self.has_speech = True
+            else:
+                self.silent_frames += 1
+                if self.has_speech and self.silent_frames <= self.pad_frames:
+                    kept.append(frame)
+                else:
+                    # Kept only if speech follows
+                    self.pause.append(frame)
+        self.kept_frames += len(kept)
+        return b"".join(kept)
+
+    def kept_seconds(self):
+        return self.kept_frames * FRAME_SECONDS
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.frame_bytes = int(FRAME_SECONDS * sample_rate) * 2
+        self.pad_frames = int(SILENCE_PAD_SECONDS / FRAME_SECONDS)
+        self.pause = deque(maxlen=self.pad_frames)
+        self.level_frames = int(SILENCE_LEVEL_SECONDS / FRAME_SECONDS)
+        self.levels = np.empty(0)
+        self.remainder = b""
+        self.silent_frames = 0
+        self.has_speech = False
+        self.kept_frames = 0
+
+
+def preprocess_recording(path, output_path, ffmpeg=FFMPEG_BINARY):
+    """Write the recording at path to output_path as 16 kHz mono Opus without the silence around
+    it. Returns the seconds of audio written, 0 if the recording is all silence, in which case
+    nothing is written. Raises OSError if ffmpeg can't be run, and
+    subprocess.CalledProcessError if it fails.
+    """
+    decoder = subprocess.Popen([ffmpeg, "-nostdin", "-loglevel", "error", "-i", path,
+                                "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    encoder = None
+    trimmer = SilenceTrimmer()
+    try:
+        while True:
+            data = decoder.stdout.read(READ_BYTES)
+            if not data:
+                break
+            data = trimmer.feed(data)
+            if not data:
+                continue
+            if encoder is None:
+                # Started at the first speech, so that nothing is written for silence
+                encoder = subprocess.Popen([ffmpeg, "-nostdin", "-loglevel", "error", "-y",
+                                            "-f", "s16le", "-ar", str(SAMPLE_RATE), "-ac", "1", "-i", "-",
+                                            "-c:a", "libopus", "-b:a", OPUS_BITRATE, "-application", "voip",
+                                            output_path],
+                                           stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            encoder.stdin.write(data)
+    finally:
+        decoder.stdout.close()
+        decoder_errors = decoder.stderr.read()
+        decoder.wait()
+        if encoder is not None:
+            encoder.stdin.close()
+            encoder_errors = encoder.stderr.read()
+            encoder.wait()
+    if decoder.returncode:
+        raise subprocess.CalledProcessError(decoder.returncode, ffmpeg, stderr=decoder_errors)
+    if encoder is None:
+        return 0
+    if encoder.returncode:
+        raise subprocess.CalledProcessError(encoder.returncode, ffmpeg, stderr=encoder_errors)
+
+    PREPROCESSING_METRICS.increment("recordings")
+    PREPROCESSING_METRICS.increment("input_bytes", os.path.getsize(path))
+    PREPROCESSING_METRICS.increment("output_bytes", os.path.getsize(output_path))
+    return trimmer.kept_seconds()
+
+
+def shrink_recording(path):
+    """Return the path of a temporary file with the recording at path preprocessed, which the
+    caller deletes. If ffmpeg fails or nothing is louder than silence, e.g. very quiet speech,
+    path is returned, for Whisper to judge.
+    """
+    fd, output_path = tempfile.mkstemp(suffix=PREPROCESSED_EXTENSION)
+    os.close(fd)
+    try:
+        seconds = preprocess_recording(path, output_path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        os.remove(output_path)
+        print("Preprocessing the recording failed, it is sent as it is:", repr(e))
+        return path
+    if seconds == 0:
+        os.remove(output_path)
+        print("The recording is all silence after preprocessing, it is sent as it is")
+        return path
+    return output_path
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import math
+    import time
+    import tracemalloc
+    import wave
+
+    from whisper_utils import WHISPER_INLINE_MAX_BYTES
+
+    # A 2 minute recording as the browser makes it, 48 kHz stereo, with tones standing in for
+    # speech between pauses of 0.3 to 4 s, after 10 s and before 20 s of background noise
+    BROWSER_SAMPLE_RATE = 48000
+    # Upload speed to S3 assumed for the upload times below
+    UPLINK_MBITS_PER_SECOND = 10
+    rng = np.random.default_rng(0)
+    parts = [("pause", 10)]
+    while sum(seconds for _, seconds in parts) < 100:
+        parts += [("speech", rng.uniform(2, 8)), ("pause", rng.uniform(0.3, 4))]
+    parts.append(("pause", 20))
+
+    recording = tempfile.NamedTemporaryFile(suffix=".wav", delete=False).name
+    with wave.open(recording, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(BROWSER_SAMPLE_RATE)
+        for kind, seconds in parts:
+            t = np.arange(int(seconds * BROWSER_SAMPLE_RATE)) / BROWSER_SAMPLE_RATE
+            if kind == "speech":
+                samples = 0.2 * np.sin(2 * np.pi * 220 * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t))
+            else:
+                samples = 0.001 * rng.standard_normal(len(t))
+            f.writeframes((np.repeat(samples, 2) * 32767).astype(np.int16).tobytes())
+    input_seconds = sum(seconds for _, seconds in parts)
+    input_bytes = os.path.getsize(recording)
+
+    output_path = tempfile.NamedTemporaryFile(suffix=PREPROCESSED_EXTENSION, delete=False).name
+    start = time.perf_counter()
+    output_seconds = preprocess_recording(recording, output_path)
+    elapsed = time.perf_counter() - start
+    output_bytes = os.path.getsize(output_path)
+
+    # Measured separately, tracemalloc slows down allocations
+    tracemalloc.start()
+    preprocess_recording(recording, output_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    for label, num_bytes, seconds in [("recording", input_bytes, input_seconds),
+                                      ("preprocessed", output_bytes, output_seconds)]:
+        if num_bytes <= WHISPER_INLINE_MAX_BYTES:
+            upload = "sent inline"
+        else:
+            upload = f"{num_bytes * 8 / UPLINK_MBITS_PER_SECOND / 1e6:.1f} s to upload"
+        print(f"{label:12s} {num_bytes / 1e6:6.2f} MB, {seconds:5.1f} s of audio, "
+              f"{math.ceil(seconds / 30)} Whisper windows, {upload}")
+    print(f"sent to Whisper after {input_bytes * 8 / UPLINK_MBITS_PER_SECOND / 1e6:.1f} s as it is, after "
+          f"{elapsed:.1f} s preprocessed, with a peak {peak / 1e6:.2f} MB in memory, "
+          f"the decoded recording is {input_seconds * SAMPLE_RATE * 2 / 1e6:.1f} MB")
+    os.remove(recording)
+    os.remove(output_path)
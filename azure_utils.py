@@ -1,129 +1,90 @@
 # This class stores Azure voice data. Specifically, the class stores several records containing
 # language, lang_code, gender, voice_id and engine. The class also has a method to return the
-# voice_id, lang_code and engine given a language and gender.
+# voice_id, lang_code and engine given a language and gender. The records are kept in
+# azure_voices.csv, which is read and validated on the first lookup. The records and the
+# lookup index are built once per process and shared by all instances.
+
+import csv
+import os
+import re
+import sys
+import threading
+import time
+from types import MappingProxyType
 
 NEURAL_ENGINE = "neural"
 STANDARD_ENGINE = "standard"
 
+AZURE_VOICES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "azure_voices.csv")
+AZURE_VOICE_FIELDS = ['language', 'azure_voice', 'gender']
+AZURE_GENDERS = {'Female', 'Male'}
+
+# Azure voice names look like ar-EG-ShakirNeural or zh-CN-henan-YundengNeural
+AZURE_VOICE_PATTERN = re.compile(r"[a-z]{2,3}-[A-Z]{2}(-[a-z]+)?-[A-Za-z]+Neural")
+
+
+class AzureVoice:
+    """One row of azure_voices.csv"""
+    __slots__ = AZURE_VOICE_FIELDS
+
+    def __init__(self, language, azure_voice, gender):
+        self.language = language
+        self.azure_voice = azure_voice
+        self.gender = gender
+
+
+def load_azure_voices(path=AZURE_VOICES_FILE):
+    """Read and validate the voice catalog and return a tuple of AzureVoice records.
+    Raises ValueError naming the first bad line.
+    """
+    voices = []
+    seen = set()
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header != AZURE_VOICE_FIELDS:
+            raise ValueError(f"{path}: expected columns {AZURE_VOICE_FIELDS}, got {header}")
+        for row in reader:
+            where = f"{path}:{reader.line_num}"
+            if len(row) != len(AZURE_VOICE_FIELDS):
+                raise ValueError(f"{where}: expected {len(AZURE_VOICE_FIELDS)} columns, got {len(row)}")
+            for field, value in zip(AZURE_VOICE_FIELDS, row):
+                if not value or value != value.strip():
+                    raise ValueError(f"{where}: bad {field} {value!r}")
+            language, azure_voice, gender = row
+            if not AZURE_VOICE_PATTERN.fullmatch(azure_voice):
+                raise ValueError(f"{where}: bad azure_voice {azure_voice!r}")
+            if gender not in AZURE_GENDERS:
+                raise ValueError(f"{where}: unknown gender {gender!r}")
+            if (language, gender) in seen:
+                raise ValueError(f"{where}: more than one voice for {language}, {gender}")
+            seen.add((language, gender))
+            voices.append(AzureVoice(sys.intern(language), azure_voice, sys.intern(gender)))
+    return tuple(voices)
+
 
 class AzureVoiceData:
+    # Voice records and lookup table, shared by all instances and loaded once per process
+    # on the first lookup
+    _tables = None
+    _tables_lock = threading.Lock()
+
     def get_voice(self, language, gender):
-        for voice in self.voice_data:
-            if voice['language'] == language and voice['gender'] == gender:
-                return voice['azure_voice']
-        return None
+        return self._get_tables()[1].get((language, gender))
 
-    def __init__(self):
-        self.voice_data = [
-            {'language': 'Arabic',
-             'azure_voice': 'ar-EG-ShakirNeural',
-             'gender': 'Male'},
-            {'language': 'Arabic (Gulf)',
-             'azure_voice': 'ar-KW-FahedNeural',
-             'gender': 'Male'},
-            {'language': 'Catalan',
-             'azure_voice': 'ca-ES-EnricNeural',
-             'gender': 'Male'},
-            {'language': 'Chinese (Cantonese)',
-             'azure_voice': 'yue-CN-YunSongNeural',
-             'gender': 'Male'},
-            {'language': 'Chinese (Mandarin)',
-             'azure_voice': 'zh-CN-YunxiNeural',
-             'gender': 'Male'},
-            {'language': 'Danish',
-             'azure_voice': 'da-DK-JeppeNeural',
-             'gender': 'Male'},
-            {'language': 'Dutch',
-             'azure_voice': 'nl-NL-MaartenNeural',
-             'gender': 'Male'},
-            {'language': 'English (Australian)',
-             'azure_voice': 'en-AU-KenNeural',
-             'gender': 'Male'},
-            {'language': 'English (British)',
-             'azure_voice': 'en-GB-RyanNeural',
-             'gender': 'Male'},
-            {'language': 'English (Indian)',
-             'azure_voice': 'en-IN-PrabhatNeural',
-             'gender': 'Male'},
-            {'language': 'English (New Zealand)',
-             'azure_voice': 'en-NZ-MitchellNeural',
-             'gender': 'Male'},
-            {'language': 'English (South African)',
-             'azure_voice': 'en-ZA-LukeNeural',
-             'gender': 'Male'},
-            {'language': 'English (US)',
-             'azure_voice': 'en-US-ChristopherNeural',
-             'gender': 'Male'},
-            {'language': 'English (Welsh)',
-             'azure_voice': 'cy-GB-AledNeural',
-             'gender': 'Male'},
-            {'language': 'Finnish',
-             'azure_voice': 'fi-FI-HarriNeural',
-             'gender': 'Male'},
-            {'language': 'French',
-             'azure_voice': 'fr-FR-HenriNeural',
-             'gender': 'Male'},
-            {'language': 'French (Canadian)',
-             'azure_voice': 'fr-CA-AntoineNeural',
-             'gender': 'Male'},
-            {'language': 'German',
-             'azure_voice': 'de-DE-KlausNeural',
-             'gender': 'Male'},
-            {'language': 'German (Austrian)',
-             'azure_voice': 'de-AT-JonasNeural',
-             'gender': 'Male'},
-            {'language': 'Hindi',
-             'azure_voice': 'hi-IN-MadhurNeural',
-             'gender': 'Male'},
-            {'language': 'Icelandic',
-             'azure_voice': 'is-IS-GunnarNeural',
-             'gender': 'Male'},
-            {'language': 'Italian',
-             'azure_voice': 'it-IT-GianniNeural',
-             'gender': 'Male'},
-            {'language': 'Japanese',
-             'azure_voice': 'ja-JP-KeitaNeural',
-             'gender': 'Male'},
-            {'language': 'Korean',
-             'azure_voice': 'ko-KR-GookMinNeural',
-             'gender': 'Male'},
-            {'language': 'Norwegian',
-             'azure_voice': 'nb-NO-FinnNeural',
-             'gender': 'Male'},
-            {'language': 'Polish',
-             'azure_voice': 'pl-PL-MarekNeural',
-             'gender': 'Male'},
-            {'language': 'Portuguese (Brazilian)',
-             'azure_voice': 'pt-BR-NicolauNeural',
-             'gender': 'Male'},
-            {'language': 'Portuguese (European)',
-             'azure_voice': 'pt-PT-DuarteNeural',
-             'gender': 'Male'},
-            {'language': 'Romanian',
-             'azure_voice': 'ro-RO-EmilNeural',
-             'gender': 'Male'},
-            {'language': 'Russian',
-             'azure_voice': 'ru-RU-DmitryNeural',
-             'gender': 'Male'},
-            {'language': 'Spanish (European)',
-             'azure_voice': 'es-ES-TeoNeural',
-             'gender': 'Male'},
-            {'language': 'Spanish (Mexican)',
-             'azure_voice': 'es-MX-LibertoNeural',
-             'gender': 'Male'},
-            {'language': 'Spanish (US)',
-             'azure_voice': 'es-US-AlonsoNeural"',
-             'gender': 'Male'},
-            {'language': 'Swedish',
-             'azure_voice': 'sv-SE-MattiasNeural',
-             'gender': 'Male'},
-            {'language': 'Turkish',
-             'azure_voice': 'tr-TR-AhmetNeural',
-             'gender': 'Male'},
-            {'language': 'Welsh',
-             'azure_voice': 'cy-GB-AledNeural',
-             'gender': 'Male'},
-        ]
+    @property
+    def voice_data(self):
+        return self._get_tables()[0]
+
+    @classmethod
+    def _get_tables(cls):
+        if cls._tables is None:
+            with cls._tables_lock:
+                if cls._tables is None:
+                    voices = load_azure_voices()
+                    voice_index = {(voice.language, voice.gender): voice.azure_voice for voice in voices}
+                    cls._tables = voices, MappingProxyType(voice_index)
+        return cls._tables
 
 
 # Run from the command-line
@@ -153,3 +114,37 @@ if __name__ == '__main__':
 
     azure_voice = azure_voice_data.get_voice('Hindi', 'Male')
     print('Hindi', 'Male', azure_voice)
+
+    # Benchmark the indexed lookup against scanning the list of voices, as get_voice used to
+    def linear_get_voice(voices, language, gender):
+        for voice in voices:
+            if voice.language == language and voice.gender == gender:
+                return voice.azure_voice
+        return None
+
+    voices = azure_voice_data.voice_data
+    keys = sorted({(voice.language, gender) for voice in voices for gender in ['Male', 'Female']})
+    for key in keys:
+        assert azure_voice_data.get_voice(*key) == linear_get_voice(voices, *key), key
+
+    num_rounds = 200
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        for key in keys:
+            linear_get_voice(voices, *key)
+    linear_us = (time.perf_counter() - start) / (num_rounds * len(keys)) * 1e6
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        for key in keys:
+            azure_voice_data.get_voice(*key)
+    indexed_us = (time.perf_counter() - start) / (num_rounds * len(keys)) * 1e6
+    print(f"get_voice over {len(keys)} keys: linear scan {linear_us:.2f} us, indexed {indexed_us:.2f} us")
+
+    # Time and memory for loading the catalog
+    import tracemalloc
+    tracemalloc.start()
+    start = time.perf_counter()
+    voices = load_azure_voices()
+    load_ms = (time.perf_counter() - start) * 1000
+    print(f"load_azure_voices: {len(voices)} voices in {load_ms:.2f} ms, "
+          f"{tracemalloc.get_traced_memory()[0] / 1024:.1f} KB")
@@ -0,0 +1,130 @@
+# This module holds DiskLRUCache, the size-bounded on-disk cache that TTSCache keeps synthesized
+# speech in and EmbeddingCache keeps embedding vectors in. Each entry is a file named by its
+# key in the cache directory. The keys and sizes of the entries are kept in memory in least
+# recently used order, and the least recently used files are deleted once the cache grows past
+# its size. Files are touched when used, so the order survives restarts.
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from metrics_utils import Counters
+
+# Temporary files this old are left over from an interrupted write. Younger ones may be another
+# process's write in progress, worker processes can share a cache directory
+STALE_TEMP_SECONDS = 60 * 60
+
+
+class DiskLRUCache:
+    """Size-bounded, least recently used on-disk cache of bytes, keyed by strings that are valid
+    file names, e.g. hex digests.
+    """
+
+    def get_path(self, key):
+        """Return the path of the cached file, or None if it isn't cached."""
+        path = self._use(key)
+        if path is None:
+            self.metrics.increment("misses")
+            return None
+        try:
+            # Remember the use across restarts, the cache is reloaded in modification time order
+            os.utime(path)
+        except OSError:
+            pass
+        self.metrics.increment("hits")
+        return path
+
+    def get_bytes(self, key):
+        """Return the cached bytes, or None if they aren't cached."""
+        path = self._use(key)
+        try:
+            if path is None:
+                raise FileNotFoundError(key)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            # Not cached, or evicted in the meantime
+            self.metrics.increment("misses")
+            return None
+        self.metrics.increment("hits")
+        return data
+
+    def put_bytes(self, key, data):
+        """Store data and return the path of the cached file, or None if it is larger than the
+        whole cache.
+        """
+        if len(data) > self.max_bytes:
+            return None
+        path = self._path(key)
+
+        # Write to a unique temporary name first, so readers never see a partial file
+        temp_path = path + "." + uuid.uuid4().hex + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.size += len(data)
+            self._evict()
+        return path
+
+    def hit_ratio(self):
+        return self.metrics.ratio("hits", "misses")
+
+    def _use(self, key):
+        # The path of a cached entry, marked as the most recently used
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+        return self._path(key)
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.metrics.increment("evictions")
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.extension)
+
+    def _load(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                try:
+                    if time.time() - os.stat(path).st_mtime > STALE_TEMP_SECONDS:
+                        os.remove(path)
+                except OSError:
+                    # Renamed into place by its writer in the meantime
+                    pass
+            elif name.endswith(self.extension):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name[:-len(self.extension)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        self._evict()
+
+    def __init__(self, cache_dir, max_bytes, extension, name):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.metrics = Counters(name)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load()
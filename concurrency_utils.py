@@ -0,0 +1,141 @@
+# This module runs chat turns on a shared, bounded worker pool. Turns that belong to the
+# same Gradio session run one at a time in the order they were submitted, so a session's
+# agent memory is never touched by two turns at once, while turns from different sessions
+# run concurrently.
+
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+PER_SESSION_MODE = "per_session"
+GLOBAL_LOCK_MODE = "global_lock"
+
+
+class SessionExecutor:
+    def submit(self, session_id, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) behind any earlier work of the same session.
+        Returns a concurrent.futures.Future for the result.
+        """
+        future = Future()
+        with self.lock:
+            waiting = self.waiting.get(session_id)
+            if waiting is None:
+                # Nothing running for this session, so the task can start right away
+                self.waiting[session_id] = deque()
+                start_now = True
+            else:
+                waiting.append((future, fn, args, kwargs))
+                start_now = False
+        if start_now:
+            self.executor.submit(self._run, session_id, future, fn, args, kwargs)
+        return future
+
+    def run(self, session_id, fn, *args, **kwargs):
+        """Submit fn for the session and block until its result is available."""
+        return self.submit(session_id, fn, *args, **kwargs).result()
+
+    def active_sessions(self):
+        with self.lock:
+            return len(self.waiting)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def _run(self, session_id, future, fn, args, kwargs):
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        with self.lock:
+            waiting = self.waiting[session_id]
+            if waiting:
+                next_task = waiting.popleft()
+            else:
+                del self.waiting[session_id]
+                next_task = None
+
+        # Hand the next turn of this session back to the pool instead of running it here,
+        # so that other sessions waiting for a worker get their fair share.
+        if next_task:
+            self.executor.submit(self._run, session_id, *next_task)
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-worker")
+        self.lock = threading.Lock()
+        # session_id -> deque of turns waiting behind the one currently running
+        self.waiting = {}
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import time
+
+    # Stubbed backends that sleep roughly like a (scaled down) agent turn would
+    AGENT_LATENCY = 0.05  # LLM plus a tool call (Wolfram, Google search, ...)
+    EXPRESS_LATENCY = 0.02  # Express-inator restatement
+    POLLY_LATENCY = 0.01  # speech synthesis
+
+    NUM_SESSIONS = 16
+    TURNS_PER_SESSION = 3
+
+    def stub_turn(session_id, turn, log, log_lock):
+        time.sleep(AGENT_LATENCY)
+        time.sleep(EXPRESS_LATENCY)
+        time.sleep(POLLY_LATENCY)
+        with log_lock:
+            log.append((session_id, turn))
+        return turn
+
+    def run_global_lock():
+        lock = threading.Lock()
+        log, log_lock = [], threading.Lock()
+
+        def locked_turn(session_id, turn):
+            with lock:
+                return stub_turn(session_id, turn, log, log_lock)
+
+        threads = [threading.Thread(target=locked_turn, args=(s, t))
+                   for s in range(NUM_SESSIONS) for t in range(TURNS_PER_SESSION)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start, log
+
+    def run_per_session(max_workers):
+        session_executor = SessionExecutor(max_workers)
+        log, log_lock = [], threading.Lock()
+        start = time.perf_counter()
+        futures = [session_executor.submit(s, stub_turn, s, t, log, log_lock)
+                   for t in range(TURNS_PER_SESSION) for s in range(NUM_SESSIONS)]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        session_executor.shutdown()
+        return elapsed, log
+
+    def in_session_order(log):
+        last_turn = {}
+        for session_id, turn in log:
+            if turn != last_turn.get(session_id, -1) + 1:
+                return False
+            last_turn[session_id] = turn
+        return True
+
+    num_turns = NUM_SESSIONS * TURNS_PER_SESSION
+    print(f"{NUM_SESSIONS} sessions x {TURNS_PER_SESSION} turns, "
+          f"{(AGENT_LATENCY + EXPRESS_LATENCY + POLLY_LATENCY) * 1000:.0f} ms per stubbed turn")
+
+    elapsed, log = run_global_lock()
+    print(f"{GLOBAL_LOCK_MODE:>12} {'':>10} {num_turns / elapsed:7.1f} turns/s")
+
+    for workers in (1, 2, 4, 8, 16):
+        elapsed, log = run_per_session(workers)
+        print(f"{PER_SESSION_MODE:>12} workers={workers:<2} {num_turns / elapsed:7.1f} turns/s"
+              f"  in session order: {in_session_order(log)}")
@@ -0,0 +1,292 @@
+# This module caches the embeddings of document chunks on disk. CachedEmbeddings wraps an
+# embeddings model such as OpenAIEmbeddings and looks every chunk up in an EmbeddingCache, keyed
+# by a hash of the model and the chunk's text, before sending it to the model. Re-submitting the
+# same or a slightly edited document in the Embeddings tab then only embeds (and pays for) the
+# chunks that are new or changed, and the FAISS index is rebuilt from the cached vectors.
+# The chunks that do need embedding are sent by embed_in_batches, in batches of a few at a time
+# in parallel, backing off and retrying when the rate limit is hit and reporting progress.
+# Chunks can be given as a generator, e.g. of splitter_utils.split_text, and are then embedded
+# while the rest of the document is still being split.
+
+import hashlib
+import itertools
+import os
+import random
+import threading
+import time
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List
+
+from langchain.embeddings.base import Embeddings
+from openai.error import APIConnectionError, APIError, RateLimitError, ServiceUnavailableError, Timeout
+
+from cache_utils import DiskLRUCache
+
+EMBEDDING_CACHE_DIR = "embedding_cache"
+EMBEDDING_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Vectors are stored as float32, the precision FAISS keeps them in anyway
+EMBEDDING_FILE_EXTENSION = ".f32"
+
+# Chunks per embedding request, and requests in flight at the same time
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "100"))
+EMBEDDING_MAX_WORKERS = int(os.environ.get("EMBEDDING_MAX_WORKERS", "4"))
+# A batch that hits the rate limit or a transient error is retried after 1, 2, 4, ... seconds,
+# at most 60, with jitter
+EMBEDDING_RETRY_ERRORS = (RateLimitError, Timeout, APIError, APIConnectionError, ServiceUnavailableError)
+EMBEDDING_MAX_RETRIES = 6
+EMBEDDING_RETRY_BASE_SECONDS = 1
+EMBEDDING_RETRY_MAX_SECONDS = 60
+
+
+def embed_in_batches(embeddings, texts, batch_size=EMBEDDING_BATCH_SIZE, max_workers=EMBEDDING_MAX_WORKERS,
+                     on_batch=None, max_retries=EMBEDDING_MAX_RETRIES):
+    """Embed texts with embeddings.embed_documents in batches of batch_size, max_workers batches
+    at a time, and return their vectors in the order of texts. texts may be any iterable, e.g. a
+    generator of chunks, and is only read as far as the batches in flight. Batches that hit the
+    rate limit or a transient error are retried with exponential backoff. on_batch(batch_texts,
+    batch_vectors) is called on this thread as each batch is done, in the order they finish.
+    """
+    batch_vectors = []
+    # future -> (index, texts) of the batches in flight
+    running = {}
+
+    def finish(futures):
+        for future in futures:
+            i, batch = running.pop(future)
+            batch_vectors[i] = future.result()
+            if on_batch:
+                on_batch(batch, batch_vectors[i])
+
+    texts = iter(texts)
+    with ThreadPoolExecutor(max_workers) as executor:
+        # Once a batch fails, the ones in flight are finished but no more are sent
+        for i, batch in enumerate(iter(lambda: list(itertools.islice(texts, batch_size)), [])):
+            if len(running) >= max_workers:
+                finish(wait(running, return_when=FIRST_COMPLETED).done)
+            batch_vectors.append(None)
+            running[executor.submit(_embed_batch, embeddings, batch, max_retries)] = (i, batch)
+        while running:
+            finish(wait(running, return_when=FIRST_COMPLETED).done)
+    return [vector for vectors in batch_vectors for vector in vectors]
+
+
+def _embed_batch(embeddings, texts, max_retries):
+    for attempt in itertools.count():
+        try:
+            return embeddings.embed_documents(texts)
+        except EMBEDDING_RETRY_ERRORS as error:
+            if attempt >= max_retries:
+                raise
+            delay = min(EMBEDDING_RETRY_MAX_SECONDS, EMBEDDING_RETRY_BASE_SECONDS * 2 ** attempt)
+            # Jitter keeps the parallel batches from retrying in lockstep
+            delay *= random.uniform(0.5, 1)
+            print(f"Embedding failed ({type(error).__name__}), retrying {len(texts)} chunks in {delay:.1f} s: {error}")
+            time.sleep(delay)
+
+
+class EmbeddingCache(DiskLRUCache):
+    """Size-bounded, least recently used on-disk cache of embedding vectors."""
+
+    @staticmethod
+    def key(model, text):
+        data = "\0".join([model, text])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, model, text):
+        """Return the cached vector as a list of floats, or None if it isn't cached."""
+        data = self.get_bytes(self.key(model, text))
+        if data is None:
+            return None
+        vector = array("f")
+        vector.frombytes(data)
+        return vector.tolist()
+
+    def put(self, model, text, vector):
+        self.put_bytes(self.key(model, text), array("f", vector).tobytes())
+
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes, EMBEDDING_FILE_EXTENSION, "Embedding cache")
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that only asks the wrapped model for document chunks missing from the cache."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_chunks(texts)[1]
+
+    def embed_chunks(self, chunks, on_progress=None):
+        """Return the texts of chunks, any iterable of strings such as a generator of them, and
+        their vectors. Each chunk is looked up in the cache as it is produced, and the missing ones
+        are embedded in batches while the rest are still being produced. on_progress(num_done,
+        num_chunks) is called as chunks are done, with num_chunks None until all are produced.
+        """
+        texts, vectors = [], []
+        # Each missing chunk is embedded once, even if it occurs several times in the document
+        missing = {}
+        num_done = 0
+
+        def missing_texts():
+            nonlocal num_done
+            for text in chunks:
+                vector = self.cache.get(self.model, text)
+                texts.append(text)
+                vectors.append(vector)
+                if vector is None and text not in missing:
+                    missing[text] = None
+                    yield text
+                else:
+                    num_done += 1
+
+        def cache_batch(batch_texts, batch_vectors):
+            # Cached as soon as they arrive, so that a failed run can be resumed
+            nonlocal num_done
+            for text, vector in zip(batch_texts, batch_vectors):
+                try:
+                    self.cache.put(self.model, text, vector)
+                except IOError as error:
+                    # Not being able to cache the vector doesn't keep it from being used
+                    print(error)
+            num_done += len(batch_texts)
+            if on_progress:
+                on_progress(num_done, None)
+
+        new_vectors = embed_in_batches(self.embeddings, missing_texts(), self.batch_size, self.max_workers,
+                                       cache_batch)
+        new_vectors = dict(zip(missing, new_vectors))
+        if on_progress:
+            on_progress(len(texts), len(texts))
+        return texts, [new_vectors[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Questions seldom repeat word for word, so they go straight to the model
+        return self.query_embeddings.embed_query(text)
+
+    def __init__(self, embeddings, cache, model=None, batch_size=EMBEDDING_BATCH_SIZE,
+                 max_workers=EMBEDDING_MAX_WORKERS, query_embeddings=None):
+        self.embeddings = embeddings
+        # Questions can be embedded by a differently configured model, e.g. one that retries on
+        # its own, while embed_in_batches retries the chunks' batches itself
+        self.query_embeddings = query_embeddings or embeddings
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        # Vectors of different models don't mix, so the model is part of the cache key
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    from splitter_utils import split_text
+
+    # Stands in for OpenAIEmbeddings, with a fixed latency per request and a smaller one per chunk
+    class FakeEmbeddings(Embeddings):
+        def embed_documents(self, texts):
+            self.num_embedded += len(texts)
+            time.sleep(0.2 + 0.002 * len(texts))
+            return [self.embed_query(text) for text in texts]
+
+        def embed_query(self, text):
+            digest = hashlib.sha256(text.encode("utf-8")).digest()
+            return [byte / 255 for byte in digest] * 48  # 1536 dimensions, like ada-002
+
+        def __init__(self):
+            self.model = "fake-embedding"
+            self.num_embedded = 0
+
+    paragraphs = [f"Paragraph {i}. " + "Canada is the second largest country in the world by total area. " * 12
+                  for i in range(400)]
+    edited_paragraphs = list(paragraphs)
+    edited_paragraphs[200] = "Paragraph 200 was rewritten. Ottawa is the capital of Canada. " * 12
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        fake_embeddings = FakeEmbeddings()
+        cached_embeddings = CachedEmbeddings(fake_embeddings, EmbeddingCache(cache_dir))
+        for label, document in [("first submission", paragraphs), ("same document", paragraphs),
+                                ("one paragraph edited", edited_paragraphs)]:
+            num_embedded_before = fake_embeddings.num_embedded
+            start = time.perf_counter()
+            texts, _ = cached_embeddings.embed_chunks(split_text("\n\n".join(document)))
+            print(f"{label:21s} {len(texts)} chunks, {fake_embeddings.num_embedded - num_embedded_before:3d} "
+                  f"embedded, {(time.perf_counter() - start) * 1000:6.0f} ms")
+        print(cached_embeddings.cache.metrics, f"hit_ratio={cached_embeddings.cache.hit_ratio():.2f}")
+
+    # Throughput of embed_in_batches with the openai client against a local stand-in for OpenAI's
+    # embeddings endpoint, which takes 100 ms per request plus 1 ms per chunk and answers
+    # 429 Too Many Requests while more than 4 requests are in flight
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import openai
+
+    # Like OpenAIEmbeddings without its tokenizing and retrying, so that this runs offline
+    class OpenAIClientEmbeddings(Embeddings):
+        def embed_documents(self, texts):
+            response = openai.Embedding.create(input=texts, model="text-embedding-ada-002", api_key="fake",
+                                               api_base=self.api_base)
+            return [item["embedding"] for item in response["data"]]
+
+        def embed_query(self, text):
+            return self.embed_documents([text])[0]
+
+        def __init__(self, api_base):
+            self.api_base = api_base
+
+    requests_in_flight = 0
+    requests_lock = threading.Lock()
+    # Short, so that the time goes to waiting for the endpoint rather than to JSON
+    fake_vector = [random.random() for _ in range(64)]
+
+    class FakeEmbeddingHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            global requests_in_flight
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with requests_lock:
+                requests_in_flight += 1
+                rate_limited = requests_in_flight > 4
+            try:
+                if rate_limited:
+                    self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests"}})
+                    return
+                time.sleep(0.1 + 0.001 * len(request["input"]))
+                data = [{"object": "embedding", "index": i, "embedding": fake_vector}
+                        for i in range(len(request["input"]))]
+                self.send_json(200, {"object": "list", "data": data, "model": request["model"],
+                                     "usage": {"prompt_tokens": 0, "total_tokens": 0}})
+            finally:
+                with requests_lock:
+                    requests_in_flight -= 1
+
+        def send_json(self, status, body):
+            body = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEmbeddingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    openai_embeddings = OpenAIClientEmbeddings(f"http://127.0.0.1:{server.server_port}/v1")
+
+    texts = [f"Chunk {i}. " + "Canada is the second largest country in the world by total area. " * 4
+             for i in range(2000)]
+    start = time.perf_counter()
+    openai_embeddings.embed_documents(texts)
+    elapsed = time.perf_counter() - start
+    print(f"one request:                  {len(texts) / elapsed:6.0f} chunks/s")
+    for batch_size, max_workers in [(100, 1), (100, 4), (50, 4), (100, 8)]:
+        start = time.perf_counter()
+        embed_in_batches(openai_embeddings, texts, batch_size, max_workers)
+        elapsed = time.perf_counter() - start
+        print(f"batches of {batch_size:3d}, {max_workers} workers: {len(texts) / elapsed:6.0f} chunks/s")
+    server.shutdown()
@@ -0,0 +1,439 @@
+# This module keeps the FAISS indexes built in the Embeddings tab on disk under a name, so that
+# they survive restarts and can be opened from any session. FaissIndexStore.save writes the index
+# and its documents to a new version directory and then switches the name over to it. load
+# memory-maps the index and the documents read-only, so that even a large corpus opens in
+# milliseconds and is kept once in the OS page cache, shared by all sessions and worker processes.
+# Documents are only decoded when a search returns them.
+# build_vector_store builds the index that a question is searched in. A flat index compares the
+# question with every chunk, which gets slow for big documents, so larger corpora get an
+# approximate nearest neighbor index instead: HNSW, a graph of the chunks' nearest neighbors, or
+# IVF, which only searches the clusters closest to the question. IVF with product quantization
+# also compresses the vectors, at a cost in recall, and is only used when asked for.
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from array import array
+from collections.abc import Mapping
+
+import faiss
+import numpy as np
+from langchain.docstore.base import Docstore
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores.faiss import FAISS
+
+FAISS_INDEX_DIR = "faiss_indexes"
+INDEX_FILE = "index.faiss"
+# The documents as one JSON object per line, in the order of their vectors in the index,
+# and the offsets of the lines as unsigned 64 bit integers
+DOCUMENTS_FILE = "documents.jsonl"
+DOCUMENT_OFFSETS_FILE = "documents.offsets"
+# Names the version directory that an index name currently refers to
+CURRENT_FILE = "CURRENT"
+# The fingerprint of the vector store's contents, see build_vector_store
+FINGERPRINT_FILE = "fingerprint"
+# Locked by saves of an index name while they switch CURRENT and remove old versions, in all
+# processes
+LOCK_FILE = "LOCK"
+# Written into a version directory when it is made current, versions without it may still be
+# being written by another save
+PUBLISHED_FILE = "PUBLISHED"
+# Version directories and CURRENT temporary files this old without having been published are
+# left over from a save that crashed, no save takes this long
+FAISS_STALE_SECONDS = 60 * 60
+
+# Index names are used as directory names
+INDEX_NAME_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]{0,63}")
+
+# IO_FLAG_MMAP_IFC (faiss 1.11 and later) maps the vectors of flat and IVF indexes,
+# IO_FLAG_MMAP only the inverted lists of IVF indexes
+FAISS_MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+# flat, hnsw, ivf or ivfpq, or auto to choose by the number of chunks
+FAISS_INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "auto")
+FAISS_INDEX_TYPES = ["flat", "hnsw", "ivf", "ivfpq"]
+# auto uses a flat index up to FAISS_FLAT_MAX_VECTORS chunks, where searching all of them takes
+# about 10 ms, HNSW up to FAISS_HNSW_MAX_VECTORS, and IVF above, where the HNSW graph and vectors
+# no longer fit in memory but IVF's memory-mapped clusters do
+FAISS_FLAT_MAX_VECTORS = int(os.environ.get("FAISS_FLAT_MAX_VECTORS", "20000"))
+FAISS_HNSW_MAX_VECTORS = int(os.environ.get("FAISS_HNSW_MAX_VECTORS", "1000000"))
+# Neighbors per chunk in the HNSW graph, and candidates kept while building and searching it.
+# More find more of the nearest chunks, but take longer
+FAISS_HNSW_M = int(os.environ.get("FAISS_HNSW_M", "32"))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.environ.get("FAISS_HNSW_EF_CONSTRUCTION", "64"))
+FAISS_HNSW_EF_SEARCH = int(os.environ.get("FAISS_HNSW_EF_SEARCH", "64"))
+# Clusters the questions are compared with. More find more of the nearest chunks, but take longer
+FAISS_IVF_NPROBE = int(os.environ.get("FAISS_IVF_NPROBE", "32"))
+# Each vector is compressed to this many bytes, e.g. 1536 float32s (6 KB) to 96 bytes
+FAISS_PQ_BYTES = int(os.environ.get("FAISS_PQ_BYTES", "96"))
+# IVF clusters are trained on at most this many vectors per cluster
+FAISS_TRAIN_VECTORS_PER_CLUSTER = 64
+# k-means wants at least 39 vectors per centroid. IVF needs two clusters' worth, with one it's
+# a flat index, and product quantization trains 256 centroids per byte
+FAISS_MIN_VECTORS_PER_CENTROID = 39
+FAISS_IVF_MIN_VECTORS = 2 * FAISS_MIN_VECTORS_PER_CENTROID
+FAISS_PQ_MIN_VECTORS = 256 * FAISS_MIN_VECTORS_PER_CENTROID
+
+
+def choose_index_type(num_vectors, index_type="auto"):
+    """Return the type of index to build for num_vectors, index_type unless too few vectors
+    to train it, then the closest one that can be, or the one auto chooses by size.
+    """
+    if index_type == "auto":
+        if num_vectors <= FAISS_FLAT_MAX_VECTORS:
+            return "flat"
+        if num_vectors <= FAISS_HNSW_MAX_VECTORS:
+            return "hnsw"
+        return "ivf"
+    if index_type == "ivfpq" and num_vectors < FAISS_PQ_MIN_VECTORS:
+        index_type = "ivf"
+    if index_type == "ivf" and num_vectors < FAISS_IVF_MIN_VECTORS:
+        index_type = "flat"
+    return index_type
+
+
+def build_index(vectors, index_type=FAISS_INDEX_TYPE):
+    """Return a FAISS index of vectors, a float32 numpy array with one row per chunk, of
+    index_type, one of FAISS_INDEX_TYPES or auto. Distances are L2, like langchain's flat index.
+    """
+    num_vectors, dimensions = vectors.shape
+    if index_type != "auto" and index_type not in FAISS_INDEX_TYPES:
+        raise ValueError(f"Unknown FAISS index type {index_type!r}, use one of {FAISS_INDEX_TYPES} or auto")
+    chosen_type = choose_index_type(num_vectors, index_type)
+    if chosen_type != index_type and index_type != "auto":
+        print(f"{num_vectors} chunks are too few to train {index_type}, building {chosen_type} instead")
+    index_type = chosen_type
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dimensions)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimensions, FAISS_HNSW_M)
+        index.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+    elif index_type in ("ivf", "ivfpq"):
+        # About sqrt(n) clusters, each with enough vectors to train it
+        num_clusters = max(1, min(int(num_vectors ** 0.5), num_vectors // FAISS_MIN_VECTORS_PER_CENTROID))
+        quantizer = faiss.IndexFlatL2(dimensions)
+        if index_type == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dimensions, num_clusters)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimensions, num_clusters, _pq_subquantizers(dimensions), 8)
+        num_train = max(num_clusters * FAISS_TRAIN_VECTORS_PER_CLUSTER, FAISS_PQ_MIN_VECTORS if index_type == "ivfpq" else 0)
+        if num_train < num_vectors:
+            index.train(vectors[np.sort(np.random.default_rng(0).choice(num_vectors, num_train, replace=False))])
+        else:
+            index.train(vectors)
+    index.add(vectors)
+    if index_type in ("ivf", "ivfpq"):
+        # Lets langchain reconstruct vectors by position, e.g. for max marginal relevance search
+        index.make_direct_map()
+    set_search_params(index)
+    return index
+
+
+def _pq_subquantizers(dimensions):
+    # The largest number of bytes up to FAISS_PQ_BYTES that divides the dimensions
+    return next(m for m in range(min(FAISS_PQ_BYTES, dimensions), 0, -1) if dimensions % m == 0)
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Set how many IVF clusters or HNSW candidates searches in index look at, by default
+    FAISS_IVF_NPROBE and FAISS_HNSW_EF_SEARCH. Flat indexes have nothing to set.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = nprobe or FAISS_IVF_NPROBE
+    elif hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search or FAISS_HNSW_EF_SEARCH
+
+
+def build_vector_store(texts, vectors, embeddings, index_type=FAISS_INDEX_TYPE):
+    """Like langchain's FAISS.from_embeddings, but with an index of index_type. The vector store's
+    fingerprint attribute is a hash of the embeddings model and the texts, the same whenever
+    the same text is embedded again, e.g. to find answers cached for it.
+    """
+    index = build_index(np.array(vectors, dtype=np.float32), index_type)
+    ids = [str(uuid.uuid4()) for _ in texts]
+    docstore = InMemoryDocstore({id_: Document(page_content=text) for id_, text in zip(ids, texts)})
+    print(f"Built {type(index).__name__} of {len(texts)} chunks")
+    docsearch = FAISS(embeddings.embed_query, index, docstore, dict(enumerate(ids)))
+    docsearch.fingerprint = texts_fingerprint(getattr(embeddings, "model", type(embeddings).__name__), texts)
+    return docsearch
+
+
+def texts_fingerprint(model, texts):
+    digest = hashlib.sha256(model.encode("utf-8"))
+    for text in texts:
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class MappedDocstore(Docstore):
+    """Read-only docstore of the documents in a memory-mapped documents file. A document's id
+    is its position in the index, as a string.
+    """
+
+    def search(self, search):
+        position = int(search)
+        if not 0 <= position < len(self):
+            return f"ID {search} not found."
+        record = json.loads(self.documents[self.offsets[position]:self.offsets[position + 1]])
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __init__(self, documents_path, offsets_path):
+        self.documents = _map_file(documents_path)
+        self.offsets = memoryview(_map_file(offsets_path)).cast("Q")
+
+
+class PositionIds(Mapping):
+    """index_to_docstore_id of a MappedDocstore, mapping each position in the index to itself."""
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.size:
+            raise KeyError(position)
+        return str(position)
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __len__(self):
+        return self.size
+
+    def __init__(self, size):
+        self.size = size
+
+
+def _map_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        # The mapping stays valid after the file is closed
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class FaissIndexStore:
+    """Named FAISS indexes on disk, loaded memory-mapped and shared read-only."""
+
+    def names(self):
+        if not os.path.isdir(self.root_dir):
+            return []
+        return sorted(name for name in os.listdir(self.root_dir)
+                      if os.path.isfile(os.path.join(self.root_dir, name, CURRENT_FILE)))
+
+    def save(self, name, docsearch):
+        """Save the index and documents of docsearch, a langchain FAISS vector store, under name,
+        replacing what was saved under it before. Returns the new version.
+        """
+        directory = self._directory(name)
+        version = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        version_dir = os.path.join(directory, version)
+        os.makedirs(version_dir)
+        faiss.write_index(docsearch.index, os.path.join(version_dir, INDEX_FILE))
+        offsets = array("Q", [0])
+        with open(os.path.join(version_dir, DOCUMENTS_FILE), "wb") as f:
+            for position in range(docsearch.index.ntotal):
+                doc = docsearch.docstore.search(docsearch.index_to_docstore_id[position])
+                line = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata}) + "\n"
+                f.write(line.encode("utf-8"))
+                offsets.append(f.tell())
+        with open(os.path.join(version_dir, DOCUMENT_OFFSETS_FILE), "wb") as f:
+            offsets.tofile(f)
+        with open(os.path.join(version_dir, FINGERPRINT_FILE), "w") as f:
+            f.write(getattr(docsearch, "fingerprint", None) or f"{name}/{version}")
+
+        # Other saves of the name, in this or other processes, wait while this one switches
+        # CURRENT and removes old versions, but may be writing their own versions meanwhile
+        with open(os.path.join(directory, LOCK_FILE), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Switch to the complete new version at once, so loaders never see a partial one
+                previous = self._current_version(directory)
+                open(os.path.join(version_dir, PUBLISHED_FILE), "w").close()
+                temp_path = os.path.join(directory, CURRENT_FILE + "." + uuid.uuid4().hex + ".tmp")
+                with open(temp_path, "w") as f:
+                    f.write(version)
+                os.replace(temp_path, os.path.join(directory, CURRENT_FILE))
+                self._remove_old_versions(directory, (version, previous))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return version
+
+    def load(self, name, embeddings):
+        """Return a langchain FAISS vector store for the index saved under name, which embeds
+        questions with embeddings, or None if there is no such index. The index and documents
+        are mapped once per process and version, and can't be modified.
+        """
+        directory = self._directory(name)
+        version = self._current_version(directory)
+        if version is None:
+            return None
+
+        with self.lock:
+            shared = self.loaded.get(name)
+            while shared is None or shared[0] != version:
+                try:
+                    shared = self._map_version(name, os.path.join(directory, version), version)
+                except (RuntimeError, FileNotFoundError):
+                    # Removed by saves since CURRENT was read, the current version is there
+                    latest = self._current_version(directory)
+                    if latest == version or latest is None:
+                        raise
+                    version = latest
+                    continue
+                self.loaded[name] = shared
+
+        # Each caller gets its own vector store around the shared index and docstore
+        _, index, docstore, index_to_docstore_id, fingerprint = shared
+        docsearch = FAISS(embeddings.embed_query, index, docstore, index_to_docstore_id)
+        docsearch.fingerprint = fingerprint
+        return docsearch
+
+    def _remove_old_versions(self, directory, kept_versions):
+        # The previous version is kept until the next save, for loaders that read CURRENT just
+        # before the switch. Processes that have mapped an older version keep reading it until
+        # they load a new one. Versions that were never published are other saves' that are
+        # still being written, unless they are stale
+        for other in os.listdir(directory):
+            if other in kept_versions or other in (CURRENT_FILE, LOCK_FILE):
+                continue
+            path = os.path.join(directory, other)
+            try:
+                if os.path.exists(os.path.join(path, PUBLISHED_FILE)):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif time.time() - os.stat(path).st_mtime > FAISS_STALE_SECONDS:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+            except OSError:
+                pass
+
+    def _map_version(self, name, version_dir, version):
+        index = faiss.read_index(os.path.join(version_dir, INDEX_FILE), FAISS_MMAP_FLAGS)
+        # The search parameters may have been tuned since the index was saved
+        set_search_params(index)
+        docstore = MappedDocstore(os.path.join(version_dir, DOCUMENTS_FILE),
+                                  os.path.join(version_dir, DOCUMENT_OFFSETS_FILE))
+        try:
+            with open(os.path.join(version_dir, FINGERPRINT_FILE)) as f:
+                fingerprint = f.read()
+        except FileNotFoundError:
+            # Saved before fingerprints were
+            fingerprint = f"{name}/{version}"
+        return version, index, docstore, PositionIds(len(docstore)), fingerprint
+
+    @staticmethod
+    def _current_version(directory):
+        try:
+            with open(os.path.join(directory, CURRENT_FILE)) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _directory(self, name):
+        if not name or not INDEX_NAME_PATTERN.fullmatch(name):
+            raise ValueError(f"Invalid index name {name!r}, use letters, digits, '_', '-' and '.'")
+        return os.path.join(self.root_dir, name)
+
+    def __init__(self, root_dir=FAISS_INDEX_DIR):
+        self.root_dir = root_dir
+        self.lock = threading.Lock()
+        # name -> (version, index, docstore, index_to_docstore_id, fingerprint) of the indexes loaded so far
+        self.loaded = {}
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import tempfile
+
+    import numpy as np
+    import psutil
+    from langchain.docstore.in_memory import InMemoryDocstore
+    from langchain.embeddings.fake import FakeEmbeddings
+
+    # A corpus of 50,000 chunks with 1536 dimensional vectors, like OpenAI's ada-002 embeddings
+    num_chunks, dimensions = 50000, 1536
+    vectors = np.random.default_rng(0).random((num_chunks, dimensions), dtype=np.float32)
+    index = faiss.IndexFlatL2(dimensions)
+    index.add(vectors)
+    ids = [str(uuid.uuid4()) for _ in range(num_chunks)]
+    docstore = InMemoryDocstore({id_: Document(page_content=f"Chunk {i}") for i, id_ in enumerate(ids)})
+    docsearch = FAISS(FakeEmbeddings(size=dimensions).embed_query, index, docstore, dict(enumerate(ids)))
+    del vectors
+
+    process = psutil.Process()
+    with tempfile.TemporaryDirectory() as root_dir:
+        start = time.perf_counter()
+        docsearch.save_local(os.path.join(root_dir, "plain"))
+        FaissIndexStore(root_dir).save("corpus", docsearch)
+        print(f"saved {num_chunks} chunks twice in {time.perf_counter() - start:.2f} s")
+        del docsearch, index, docstore
+
+        rss = process.memory_info().rss
+        start = time.perf_counter()
+        plain = FAISS.load_local(os.path.join(root_dir, "plain"), FakeEmbeddings(size=dimensions))
+        print(f"FAISS.load_local:           {(time.perf_counter() - start) * 1000:7.1f} ms, "
+              f"{(process.memory_info().rss - rss) / 1e6:6.1f} MB more resident")
+        del plain
+
+        store = FaissIndexStore(root_dir)
+        rss = process.memory_info().rss
+        start = time.perf_counter()
+        mapped = store.load("corpus", FakeEmbeddings(size=dimensions))
+        print(f"FaissIndexStore.load:       {(time.perf_counter() - start) * 1000:7.1f} ms, "
+              f"{(process.memory_info().rss - rss) / 1e6:6.1f} MB more resident")
+
+        start = time.perf_counter()
+        for _ in range(100):
+            store.load("corpus", FakeEmbeddings(size=dimensions))
+        print(f"load by another session:    {(time.perf_counter() - start) * 1000 / 100:7.3f} ms")
+
+        start = time.perf_counter()
+        docs = mapped.similarity_search("Canada", k=4)
+        print(f"first search on the mapped index: {(time.perf_counter() - start) * 1000:.1f} ms, "
+              f"{len(docs)} results, names: {store.names()}")
+        del mapped, store
+
+    # Recall of the 4 nearest chunks (what the question answering chain is given) and latency of
+    # one question at a time, for each index type and search parameter, on synthetic vectors
+    # clustered like text embeddings: topics, variations within them and some noise
+    rng = np.random.default_rng(0)
+    topics = rng.standard_normal((500, dimensions), dtype=np.float32)
+    variations = 0.25 * rng.standard_normal((16, dimensions), dtype=np.float32)
+    vectors = topics[rng.integers(0, len(topics), num_chunks)]
+    vectors += rng.standard_normal((num_chunks, len(variations)), dtype=np.float32) @ variations
+    vectors += 0.1 * rng.standard_normal((num_chunks, dimensions), dtype=np.float32)
+    questions = vectors[rng.choice(num_chunks, 200, replace=False)]
+    questions += 0.01 * rng.standard_normal(questions.shape, dtype=np.float32)
+    k = 4
+
+    def search_all(index):
+        start = time.perf_counter()
+        found = [index.search(question[None], k)[1][0] for question in questions]
+        return found, (time.perf_counter() - start) * 1000 / len(questions)
+
+    exact, _ = search_all(build_index(vectors, "flat"))
+    print(f"auto index type for {num_chunks} chunks: {choose_index_type(num_chunks)}")
+    for index_type, search_params in [("flat", [{}]),
+                                      ("hnsw", [{"ef_search": ef_search} for ef_search in [16, 64, 256]]),
+                                      ("ivf", [{"nprobe": nprobe} for nprobe in [8, 32, 128]]),
+                                      ("ivfpq", [{"nprobe": nprobe} for nprobe in [8, 32, 128]])]:
+        start = time.perf_counter()
+        index = build_index(vectors, index_type)
+        print(f"{index_type}: built in {time.perf_counter() - start:.1f} s")
+        for params in search_params:
+            set_search_params(index, **params)
+            found, latency = search_all(index)
+            recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, exact)])
+            print(f"  {str(params or ''):18s} recall@{k} {recall:.3f}, {latency:6.2f} ms per question")
+        del index
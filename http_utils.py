@@ -0,0 +1,225 @@
+# This module holds the HTTP clients that the app's own calls to other services go through, so
+# that connections are kept alive and reused instead of each call opening a new TCP connection
+# and TLS session. get_session returns a requests session shared by all threads, and
+# get_async_session an aiohttp session shared by all tasks on an event loop. Both keep a pool of
+# connections per host, limit how many are open to each host, time out connections that hang
+# and retry requests that failed before the service processed them.
+
+import asyncio
+import os
+import random
+import threading
+import weakref
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+# Connections kept open to each host, and the number of hosts they are kept for
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", "16"))
+HTTP_POOLED_HOSTS = 8
+# Seconds to wait for a connection, and for the response (between bytes of it), e.g. generating
+# a talking head video can take a while
+HTTP_CONNECT_TIMEOUT_SECONDS = 5
+HTTP_READ_TIMEOUT_SECONDS = int(os.environ.get("HTTP_READ_TIMEOUT_SECONDS", "120"))
+# Idle connections are closed after this long, before the services close them
+HTTP_KEEPALIVE_SECONDS = 30
+
+# Requests are retried when they couldn't connect, or the service turned them away without
+# processing them, which is safe for POST requests too. Retries are 0.5, 1 and 2 s apart, or as
+# long as the service's Retry-After asks. If it asks for longer than the backoff ever waits, the
+# request fails instead of holding up the user's turn
+HTTP_MAX_RETRIES = 3
+HTTP_RETRY_BACKOFF_SECONDS = 0.5
+HTTP_RETRY_AFTER_MAX_SECONDS = HTTP_RETRY_BACKOFF_SECONDS * 2 ** HTTP_MAX_RETRIES
+HTTP_RETRY_STATUSES = (429, 503)
+# A request whose connection the service closed, e.g. a pooled connection it had just timed out,
+# may have been processed, so it's only retried if making it twice does no harm
+HTTP_IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+_session = None
+_session_lock = threading.Lock()
+_async_sessions = weakref.WeakKeyDictionary()
+
+
+class TimeoutSession(requests.Session):
+    """A requests session with a default timeout, requests has none."""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS))
+        return super().request(method, url, **kwargs)
+
+
+class CappedRetry(Retry):
+    """urllib3 retries that give up when the service's Retry-After asks for longer than
+    HTTP_RETRY_AFTER_MAX_SECONDS, urllib3 waits as long as it asks.
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and self.respect_retry_after_header:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > HTTP_RETRY_AFTER_MAX_SECONDS:
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After of {retry_after:g} s"))
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+def get_session():
+    """Return the requests session shared by all threads."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = CappedRetry(total=HTTP_MAX_RETRIES, connect=HTTP_MAX_RETRIES, read=0,
+                                status=HTTP_MAX_RETRIES, status_forcelist=HTTP_RETRY_STATUSES,
+                                allowed_methods=None, backoff_factor=HTTP_RETRY_BACKOFF_SECONDS,
+                                raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOLED_HOSTS, pool_maxsize=HTTP_MAX_CONNECTIONS_PER_HOST,
+                                  pool_block=True, max_retries=retry)
+            _session = TimeoutSession()
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def get_async_session():
+    """Return the aiohttp session shared by all tasks on the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+                                         keepalive_timeout=HTTP_KEEPALIVE_SECONDS)
+        timeout = aiohttp.ClientTimeout(connect=HTTP_CONNECT_TIMEOUT_SECONDS,
+                                        sock_read=HTTP_READ_TIMEOUT_SECONDS)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session():
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def fetch_json(method, url, **kwargs):
+    """Make a request with the running event loop's session, retrying it like get_session's do,
+    and idempotent ones also when the service closed the connection, and return the JSON of the
+    response. Raises aiohttp.ClientResponseError for error statuses, also when the service asks
+    to retry after longer than HTTP_RETRY_AFTER_MAX_SECONDS.
+    """
+    session = get_async_session()
+    retry_errors = aiohttp.ClientConnectorError
+    if method.upper() in HTTP_IDEMPOTENT_METHODS:
+        retry_errors = (aiohttp.ClientConnectorError, aiohttp.ServerDisconnectedError)
+    for retry in range(HTTP_MAX_RETRIES + 1):
+        delay = HTTP_RETRY_BACKOFF_SECONDS * 2 ** retry * (1 + random.random() / 2)
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status not in HTTP_RETRY_STATUSES or retry == HTTP_MAX_RETRIES:
+                    response.raise_for_status()
+                    return await response.json()
+                # Read, so that the connection can be reused
+                await response.read()
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+                    if delay > HTTP_RETRY_AFTER_MAX_SECONDS:
+                        response.raise_for_status()
+        except retry_errors:
+            if retry == HTTP_MAX_RETRIES:
+                raise
+        await asyncio.sleep(delay)
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import ssl
+    import subprocess
+    import tempfile
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # Stands in for an API over HTTPS, answering each request in 20 ms, with every fifth
+    # request for /busy turned away with a 503 first. A new connection takes the two 50 ms round
+    # trips of its TCP and TLS handshakes to a remote API
+    RESPONSE_SECONDS = 0.02
+    CONNECT_SECONDS = 0.1
+    num_connections, num_requests = [], []
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            num_connections.append(1)
+            time.sleep(CONNECT_SECONDS)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            num_requests.append(1)
+            time.sleep(RESPONSE_SECONDS)
+            status = 503 if self.path == "/busy" and len(num_requests) % 5 == 0 else 200
+            body = b'{"ok": true}'
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status == 503:
+                self.send_header("Retry-After", "0")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    certificate_dir = tempfile.mkdtemp()
+    certificate, key = os.path.join(certificate_dir, "cert.pem"), os.path.join(certificate_dir, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost", "-keyout", key, "-out", certificate, "-days", "1"],
+                   check=True, capture_output=True)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"https://localhost:{server.server_port}"
+
+    # 200 calls from 4 threads, as the Gradio workers make them
+    NUM_CALLS, NUM_THREADS = 200, 4
+
+    def benchmark(label, post, path="/"):
+        del num_connections[:], num_requests[:]
+        statuses = []
+
+        def call(_):
+            start = time.perf_counter()
+            statuses.append(post(url + path, json={"text": "hello"}, verify=certificate).status_code)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(NUM_THREADS) as executor:
+            latencies = sorted(executor.map(call, range(NUM_CALLS)))
+        elapsed = time.perf_counter() - start
+        print(f"{label:24s} {elapsed:.2f} s, median {latencies[NUM_CALLS // 2] * 1000:.1f} ms, "
+              f"p95 {latencies[NUM_CALLS * 95 // 100] * 1000:.1f} ms, {len(num_connections)} connections, "
+              f"{statuses.count(200)} of {NUM_CALLS} succeeded")
+
+    benchmark("requests.post", requests.post)
+    benchmark("shared session", get_session().post)
+    benchmark("requests.post, busy", requests.post, "/busy")
+    benchmark("shared session, busy", get_session().post, "/busy")
+
+    async def main():
+        del num_connections[:], num_requests[:]
+        ssl_context = ssl.create_default_context(cafile=certificate)
+        start = time.perf_counter()
+        results = await asyncio.gather(*[fetch_json("POST", url + "/busy", json={"text": "hello"}, ssl=ssl_context)
+                                         for _ in range(NUM_CALLS)])
+        print(f"{'fetch_json, busy':24s} {time.perf_counter() - start:.2f} s, {len(num_connections)} connections, "
+              f"{results.count({'ok': True})} of {NUM_CALLS} succeeded")
+        await close_async_session()
+
+    asyncio.run(main())
+    server.shutdown()
@@ -0,0 +1,83 @@
+# This module guesses cheaply, without an LLM call, whether a text is already written in a
+# given output language. It only looks at the writing system of the letters, so it can answer
+# for languages with a distinctive script (Russian, Japanese, Hindi, ...). For languages written
+# in the Latin script it can't tell, and is_in_language returns False.
+
+# Share of letters that must be in the language's script, leaving room for names,
+# abbreviations and units written in Latin letters
+MIN_SCRIPT_RATIO = 0.8
+
+CYRILLIC = [(0x0400, 0x052F)]
+ARABIC = [(0x0600, 0x06FF), (0x0750, 0x077F), (0x08A0, 0x08FF), (0xFB50, 0xFDFF), (0xFE70, 0xFEFF)]
+HAN = [(0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF)]
+KANA = [(0x3040, 0x30FF), (0x31F0, 0x31FF), (0xFF66, 0xFF9F)]
+HANGUL = [(0x1100, 0x11FF), (0x3130, 0x318F), (0xAC00, 0xD7AF)]
+DEVANAGARI = [(0x0900, 0x097F)]
+GEORGIAN = [(0x10A0, 0x10FF)]
+
+UKRAINIAN_ONLY_LETTERS = set("ієїґІЄЇҐ")
+RUSSIAN_ONLY_LETTERS = set("ыэъёЫЭЪЁ")
+
+# language -> (ranges of its script, letters that rule the language out)
+LANGUAGE_SCRIPTS = {
+    'Russian': (CYRILLIC, UKRAINIAN_ONLY_LETTERS),
+    'Ukrainian': (CYRILLIC, RUSSIAN_ONLY_LETTERS),
+    'Arabic': (ARABIC, set()),
+    'Arabic (Gulf)': (ARABIC, set()),
+    'Chinese (Cantonese)': (HAN, set()),
+    'Chinese (Mandarin)': (HAN, set()),
+    'Japanese': (HAN + KANA, set()),
+    'Korean': (HANGUL, set()),
+    'Hindi': (DEVANAGARI, set()),
+    'Georgian': (GEORGIAN, set()),
+}
+
+
+def _in_ranges(code_point, ranges):
+    for low, high in ranges:
+        if low <= code_point <= high:
+            return True
+    return False
+
+
+def is_in_language(text, language):
+    """Return True if text looks like it is already written in language.
+    False means either that it isn't, or that this can't be told from the script alone.
+    """
+    if language not in LANGUAGE_SCRIPTS:
+        return False
+    ranges, excluded_letters = LANGUAGE_SCRIPTS[language]
+
+    num_letters = 0
+    num_in_script = 0
+    has_kana = False
+    for char in text:
+        if not char.isalpha():
+            continue
+        if char in excluded_letters:
+            return False
+        num_letters += 1
+        code_point = ord(char)
+        if _in_ranges(code_point, ranges):
+            num_in_script += 1
+            if language == 'Japanese' and _in_ranges(code_point, KANA):
+                has_kana = True
+
+    # Japanese text without any kana is more likely Chinese
+    if language == 'Japanese' and not has_kana:
+        return False
+    return num_letters > 0 and num_in_script / num_letters >= MIN_SCRIPT_RATIO
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    print('Russian', is_in_language('Население Канады составляет около 38 миллионов человек (2023).', 'Russian'))
+    print('Russian', is_in_language('About 38 million people live in Canada.', 'Russian'))
+    print('Russian', is_in_language('Населення Канади становить близько 38 мільйонів. Її столиця Оттава.',
+                                    'Russian'))
+    print('Ukrainian', is_in_language('Населення Канади становить близько 38 мільйонів. Її столиця Оттава.',
+                                      'Ukrainian'))
+    print('Japanese', is_in_language('カナダの人口は約3800万人です。', 'Japanese'))
+    print('Japanese', is_in_language('加拿大人口约为3800万。', 'Japanese'))
+    print('Chinese (Mandarin)', is_in_language('加拿大人口约为3800万。', 'Chinese (Mandarin)'))
+    print('French', is_in_language('Le Canada compte environ 38 millions d\'habitants.', 'French'))
@@ -0,0 +1,240 @@
+# This module transcribes speech on the CPU with a local Whisper model, for running without the
+# serverless endpoint or a network. The model is loaded once, the first time it's needed.
+# Whisper decodes 30 second windows, so recordings are split into chunks of at most that long
+# at pauses found by a simple energy-based voice activity detector, instead of being cut off
+# after 30 seconds, and chunks without speech aren't decoded at all. Chunks from all the
+# recordings being transcribed at once are decoded together in batches by one worker thread,
+# which takes less time per chunk than decoding them one by one.
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from metrics_utils import Counters
+
+WHISPER_LOCAL_MODEL = os.environ.get("WHISPER_LOCAL_MODEL", "base")
+# Chunks decoded together, and how long to wait for more chunks to fill a batch
+WHISPER_BATCH_SIZE = int(os.environ.get("WHISPER_BATCH_SIZE", "8"))
+WHISPER_BATCH_WAIT_SECONDS = 0.05
+
+# Whisper's sample rate and window
+SAMPLE_RATE = 16000
+CHUNK_SECONDS = 30
+
+# A 30 ms frame is speech if it's louder than both this (about -50 dBFS) and a few times the
+# quietest tenth of the frames, i.e. the background noise, or than a quarter of the loudest
+# tenth, for recordings with hardly any pauses
+VAD_FRAME_SECONDS = 0.03
+VAD_MIN_RMS = 0.003
+VAD_NOISE_FACTOR = 3
+VAD_LOUD_FACTOR = 0.25
+# Pauses shorter than this are kept inside speech, and speech is padded by this much
+VAD_MIN_SILENCE_SECONDS = 0.3
+VAD_SPEECH_PAD_SECONDS = 0.2
+# Speech longer than a chunk is cut at its quietest frame in the last third of the chunk
+VAD_CUT_SEARCH_SECONDS = 10
+
+# Whisper's test for a window without speech, whose text is usually made up
+NO_SPEECH_PROB = 0.6
+NO_SPEECH_LOGPROB = -1.0
+
+
+def speech_chunks(audio, sample_rate=SAMPLE_RATE, max_seconds=CHUNK_SECONDS):
+    """Return (start, end) sample offsets of chunks of audio with speech in them, each at most
+    max_seconds long, ending in pauses where possible.
+    """
+    frame = int(VAD_FRAME_SECONDS * sample_rate)
+    num_frames = len(audio) // frame
+    if num_frames == 0:
+        return []
+    rms = np.sqrt(np.mean(np.square(audio[:num_frames * frame].reshape(num_frames, frame)), axis=1))
+    noise, loud = np.percentile(rms, [10, 90])
+    threshold = max(VAD_MIN_RMS, min(VAD_NOISE_FACTOR * noise, VAD_LOUD_FACTOR * loud))
+    speech = np.flatnonzero(rms > threshold)
+    if len(speech) == 0:
+        return []
+
+    # Runs of speech frames, joined across short pauses, padded and in samples
+    breaks = np.flatnonzero(np.diff(speech) > VAD_MIN_SILENCE_SECONDS / VAD_FRAME_SECONDS)
+    pad = int(VAD_SPEECH_PAD_SECONDS * sample_rate)
+    firsts = np.concatenate(([0], breaks + 1))
+    lasts = np.concatenate((breaks, [len(speech) - 1]))
+    regions = [(max(0, speech[first] * frame - pad), min(len(audio), (speech[last] + 1) * frame + pad))
+               for first, last in zip(firsts, lasts)]
+
+    # Consecutive regions are put in the same chunk while they fit, longer ones are cut
+    max_samples = max_seconds * sample_rate
+    search = VAD_CUT_SEARCH_SECONDS * sample_rate
+    chunks = []
+    for start, end in regions:
+        if chunks and end - chunks[-1][0] <= max_samples:
+            chunks[-1] = (chunks[-1][0], end)
+            continue
+        while end - start > max_samples:
+            first_frame = (start + max_samples - search) // frame
+            last_frame = min((start + max_samples) // frame, num_frames)
+            cut = (first_frame + int(np.argmin(rms[first_frame:last_frame]))) * frame
+            chunks.append((start, cut))
+            start = cut
+        chunks.append((start, end))
+    return chunks
+
+
+class LocalWhisperEngine:
+    """Transcribes audio with a local Whisper model, in batches across concurrent callers."""
+
+    async def transcribe(self, path, language=None):
+        """Transcribe the audio file at path and return its text. language is a Whisper language
+        code, e.g. from PollyVoiceData.get_whisper_lang_code, or None to detect it per chunk.
+        """
+        audio = await asyncio.to_thread(self._load_audio, path)
+        futures = self.submit(audio, language)
+        texts = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        return " ".join(text for text in texts if text)
+
+    def submit(self, audio, language=None):
+        """Queue the speech chunks of audio, float32 samples at 16 kHz, for decoding. Returns a
+        concurrent.futures.Future of the text of each chunk, in order.
+        """
+        self._start()
+        futures = []
+        num_samples = 0
+        for start, end in speech_chunks(audio):
+            future = Future()
+            self.chunks.put((audio[start:end], language, future))
+            futures.append(future)
+            num_samples += end - start
+        self.metrics.increment("audio_seconds", num_samples / SAMPLE_RATE)
+        self.metrics.increment("silence_seconds", (len(audio) - num_samples) / SAMPLE_RATE)
+        return futures
+
+    def real_time_factor(self):
+        """Seconds spent decoding per second of speech decoded so far."""
+        audio_seconds = self.metrics.get("audio_seconds")
+        return self.metrics.get("decode_seconds") / audio_seconds if audio_seconds else 0.0
+
+    def _start(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+
+    def _load_audio(self, path):
+        import whisper
+        return whisper.load_audio(path)
+
+    def _get_model(self):
+        if self.model is None:
+            import whisper
+            start = time.perf_counter()
+            self.model = whisper.load_model(self.model_name, device="cpu")
+            print(f"Loaded Whisper {self.model_name} in {time.perf_counter() - start:.1f} s")
+        return self.model
+
+    def _run(self):
+        while True:
+            # Waits for a chunk, then briefly for more to decode with it
+            batch = [self.chunks.get()]
+            deadline = time.monotonic() + self.batch_wait_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.chunks.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            batch = [chunk for chunk in batch if chunk[2].set_running_or_notify_cancel()]
+            # The language is an option of the whole batch
+            for language in {language for _, language, _ in batch}:
+                self._decode([chunk for chunk in batch if chunk[1] == language], language)
+
+    def _decode(self, batch, language):
+        try:
+            import torch
+            import whisper
+            model = self._get_model()
+            start = time.perf_counter()
+            mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(audio)),
+                                                           n_mels=model.dims.n_mels)
+                               for audio, _, _ in batch])
+            options = whisper.DecodingOptions(language=language, without_timestamps=True, fp16=False)
+            results = whisper.decode(model, mel, options)
+            self.metrics.increment("decode_seconds", time.perf_counter() - start)
+            self.metrics.increment("batches")
+            self.metrics.increment("chunks", len(batch))
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, _, future), result in zip(batch, results):
+            if result.no_speech_prob > NO_SPEECH_PROB and result.avg_logprob < NO_SPEECH_LOGPROB:
+                future.set_result("")
+            else:
+                future.set_result(result.text.strip())
+
+    def __init__(self, model_name=WHISPER_LOCAL_MODEL, batch_size=WHISPER_BATCH_SIZE,
+                 batch_wait_seconds=WHISPER_BATCH_WAIT_SECONDS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.batch_wait_seconds = batch_wait_seconds
+        self.model = None
+        self.chunks = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        self.metrics = Counters("Local whisper")
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import sys
+
+    # A recording of tones standing in for speech, with pauses of 0.1 to 3 s and 70 s without one
+    rng = np.random.default_rng(0)
+    parts = []
+    for kind, seconds in [("pause", 1), ("speech", 5), ("pause", 0.1), ("speech", 3), ("pause", 2),
+                          ("speech", 20), ("pause", 0.5), ("speech", 15), ("pause", 3), ("speech", 70)]:
+        t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+        if kind == "speech":
+            parts.append(0.2 * np.sin(2 * np.pi * 220 * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t)))
+        else:
+            parts.append(0.001 * rng.standard_normal(len(t)))
+    audio = np.concatenate(parts).astype(np.float32)
+    print(f"{len(audio) / SAMPLE_RATE:.0f} s recording, chunks:",
+          ", ".join(f"{start / SAMPLE_RATE:.1f}-{end / SAMPLE_RATE:.1f} s" for start, end in speech_chunks(audio)))
+
+    # Real-time factors of the recordings given on the command-line, each transcribed by 4 callers
+    # at once, as before (the first 30 s only, one at a time), in chunks one at a time, and in
+    # chunks decoded in batches
+    if len(sys.argv) < 2:
+        print(f"Usage: python {sys.argv[0]} recording.wav ... to measure real-time factors")
+        sys.exit()
+    import whisper
+
+    NUM_CALLERS = 4
+    recordings = [whisper.load_audio(path) for path in sys.argv[1:]] * NUM_CALLERS
+    total_seconds = sum(len(recording) for recording in recordings) / SAMPLE_RATE
+    engine = LocalWhisperEngine(batch_size=1)
+    model = engine._get_model()
+
+    start = time.perf_counter()
+    for recording in recordings:
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(recording), n_mels=model.dims.n_mels)
+        text = whisper.decode(model, mel, whisper.DecodingOptions(fp16=False)).text
+    elapsed = time.perf_counter() - start
+    kept_seconds = sum(min(len(recording), CHUNK_SECONDS * SAMPLE_RATE) for recording in recordings) / SAMPLE_RATE
+    print(f"first 30 s:        RTF {elapsed / total_seconds:.3f}, {kept_seconds / total_seconds:.0%} of the audio "
+          f"transcribed, {text[:60]!r}")
+
+    for label, batch_size in [("chunks, 1 by 1:", 1), ("chunks, batched:", WHISPER_BATCH_SIZE)]:
+        engine.batch_size = batch_size
+        engine.metrics = Counters("Local whisper")
+        start = time.perf_counter()
+        futures = [engine.submit(recording) for recording in recordings]
+        texts = [" ".join(future.result() for future in recording_futures) for recording_futures in futures]
+        elapsed = time.perf_counter() - start
+        print(f"{label:18s} RTF {elapsed / total_seconds:.3f}, {engine.metrics.get('chunks')} chunks in "
+              f"{engine.metrics.get('batches')} batches, {engine.metrics.get('silence_seconds'):.0f} s of "
+              f"silence skipped, {texts[0][:60]!r}")
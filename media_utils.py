@@ -0,0 +1,123 @@
+# This module gives every spoken reply and talking head video its own output file, so that
+# concurrent sessions never overwrite each other's media, and runs a janitor thread that
+# deletes those files once they are old or take up too much disk space. The output directories
+# are served under MEDIA_URL_PATH as they are, Gradio would copy every file it serves to its own
+# temporary directory, where nothing deletes them.
+
+import os
+import threading
+import time
+import uuid
+
+AUDIO_OUTPUT_DIR = "audios"
+VIDEO_OUTPUT_DIR = "videos"
+
+# Only files with this prefix are managed by the janitor, other files in the output
+# directories (e.g. placeholders used when building the UI) are left alone
+OUTPUT_FILE_PREFIX = "out_"
+
+MEDIA_MAX_AGE_SECONDS = 10 * 60
+MEDIA_MAX_BYTES = 512 * 1024 * 1024
+MEDIA_CLEAN_INTERVAL_SECONDS = 60
+
+# The output directories are served under this path, e.g. /media/audios/out_<uuid>.mp3
+MEDIA_URL_PATH = "/media/"
+
+
+def new_output_path(directory, extension):
+    """Return a path in directory that no other request uses, e.g. audios/out_<uuid>.mp3"""
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, OUTPUT_FILE_PREFIX + uuid.uuid4().hex + extension)
+
+
+def media_url(path):
+    """Return the URL that the output file at path, as returned by new_output_path, is served at."""
+    return MEDIA_URL_PATH + os.path.relpath(path).replace(os.sep, "/")
+
+
+class MediaJanitor:
+    """Periodically delete output files older than max_age_seconds, then the oldest ones
+    until the output files take up at most max_bytes.
+    """
+
+    def clean(self):
+        """Delete expired files once. Returns the number of files and bytes deleted."""
+        files = []
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if not name.startswith(OUTPUT_FILE_PREFIX):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        files.sort()
+        total_bytes = sum(size for _, size, _ in files)
+        oldest_allowed = time.time() - self.max_age_seconds
+        num_deleted, bytes_deleted = 0, 0
+        for mtime, size, path in files:
+            if mtime >= oldest_allowed and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            num_deleted += 1
+            bytes_deleted += size
+        return num_deleted, bytes_deleted
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="media-janitor", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                num_deleted, bytes_deleted = self.clean()
+                if num_deleted:
+                    print(f"Media janitor deleted {num_deleted} files, {bytes_deleted} bytes")
+            except Exception as e:
+                print("Media janitor error:", e)
+            self.stopped.wait(self.interval_seconds)
+
+    def __init__(self, directories, max_age_seconds=MEDIA_MAX_AGE_SECONDS, max_bytes=MEDIA_MAX_BYTES,
+                 interval_seconds=MEDIA_CLEAN_INTERVAL_SECONDS):
+        self.directories = directories
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.interval_seconds = interval_seconds
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        now = time.time()
+        for age_seconds in [3600, 1800, 300, 60, 10]:
+            path = new_output_path(output_dir, ".mp3")
+            with open(path, "wb") as f:
+                f.write(b"\0" * 1024)
+            os.utime(path, (now - age_seconds, now - age_seconds))
+        with open(os.path.join(output_dir, "tempfile.mp3"), "wb") as f:
+            f.write(b"\0" * 1024)
+
+        janitor = MediaJanitor([output_dir], max_age_seconds=600, max_bytes=1536)
+        print("deleted (files, bytes):", janitor.clean())
+        print("left:", sorted(name if not name.startswith(OUTPUT_FILE_PREFIX) else OUTPUT_FILE_PREFIX + "..."
+                              for name in os.listdir(output_dir)))
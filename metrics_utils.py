@@ -0,0 +1,33 @@
+# This module keeps simple named counters, e.g. cache hits and misses, that can be
+# incremented from several chat sessions at once and printed to the log.
+
+import threading
+
+
+class Counters:
+    def increment(self, key, amount=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def get(self, key):
+        with self.lock:
+            return self.counts.get(key, 0)
+
+    def ratio(self, key, *other_keys):
+        """Return counts[key] / (counts[key] + sum of other_keys), or 0.0 if all are zero."""
+        with self.lock:
+            total = self.counts.get(key, 0) + sum(self.counts.get(other, 0) for other in other_keys)
+            return self.counts.get(key, 0) / total if total else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def __str__(self):
+        counts = self.snapshot()
+        return self.name + ": " + ", ".join(f"{key}={counts[key]}" for key in sorted(counts))
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counts = {}
@@ -0,0 +1,24 @@
+# This module ties langchain's OpenAI models to one API key. langchain's OpenAI classes send
+# their requests with the openai package's global api_key, which every session's models set
+# when they are created, so turns of sessions with different keys running at the same time
+# could be sent and billed on each other's key. with_api_key makes a model pass its own key
+# with every request instead.
+
+class KeyedOpenAIResource:
+    """An openai API resource, e.g. openai.ChatCompletion, whose requests all use api_key."""
+
+    def create(self, **params):
+        return self.resource.create(api_key=self.api_key, **params)
+
+    async def acreate(self, **params):
+        return await self.resource.acreate(api_key=self.api_key, **params)
+
+    def __init__(self, resource, api_key):
+        self.resource = resource
+        self.api_key = api_key
+
+
+def with_api_key(model, api_key):
+    """Return model, e.g. a ChatOpenAI or OpenAIEmbeddings, with its requests sent with api_key."""
+    model.client = KeyedOpenAIResource(model.client, api_key)
+    return model
@@ -1,595 +1,115 @@
 # This class stores Polly voice data. Specifically, the class stores several records containing
 # language, lang_code, gender, voice_id and engine. The class also has a method to return the
-# voice_id, lang_code and engine given a language and gender.
+# voice_id, lang_code and engine given a language and gender. The records are kept in
+# polly_voices.csv, which is read and validated on the first lookup. The records and the
+# lookup indexes are built once per process and shared by all instances.
+
+import csv
+import os
+import sys
+import threading
+import time
+from types import MappingProxyType
 
 NEURAL_ENGINE = "neural"
 STANDARD_ENGINE = "standard"
 
+POLLY_VOICES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "polly_voices.csv")
+POLLY_VOICE_FIELDS = ['language', 'lang_code', 'whisper_lang_code', 'voice_id', 'gender', 'neural', 'standard']
+POLLY_GENDERS = {'Female', 'Male', 'Female (child)', 'Male (child)'}
+POLLY_ENGINE_FLAGS = {'Yes': True, 'No': False}
+
+
+class PollyVoice:
+    """One row of polly_voices.csv, with the neural and standard flags as bools"""
+    __slots__ = POLLY_VOICE_FIELDS
+
+    def __init__(self, language, lang_code, whisper_lang_code, voice_id, gender, neural, standard):
+        self.language = language
+        self.lang_code = lang_code
+        self.whisper_lang_code = whisper_lang_code
+        self.voice_id = voice_id
+        self.gender = gender
+        self.neural = neural
+        self.standard = standard
+
+
+def load_polly_voices(path=POLLY_VOICES_FILE):
+    """Read and validate the voice catalog and return a tuple of PollyVoice records, with
+    the neural and standard flags as bools. Raises ValueError naming the first bad line.
+    """
+    voices = []
+    seen = set()
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header != POLLY_VOICE_FIELDS:
+            raise ValueError(f"{path}: expected columns {POLLY_VOICE_FIELDS}, got {header}")
+        for row in reader:
+            where = f"{path}:{reader.line_num}"
+            if len(row) != len(POLLY_VOICE_FIELDS):
+                raise ValueError(f"{where}: expected {len(POLLY_VOICE_FIELDS)} columns, got {len(row)}")
+            for field, value in zip(POLLY_VOICE_FIELDS, row):
+                if not value or value != value.strip() or '"' in value:
+                    raise ValueError(f"{where}: bad {field} {value!r}")
+            language, lang_code, whisper_lang_code, voice_id, gender, neural, standard = row
+            if gender not in POLLY_GENDERS:
+                raise ValueError(f"{where}: unknown gender {gender!r}")
+            if neural not in POLLY_ENGINE_FLAGS or standard not in POLLY_ENGINE_FLAGS:
+                raise ValueError(f"{where}: neural and standard must be Yes or No")
+            neural = POLLY_ENGINE_FLAGS[neural]
+            standard = POLLY_ENGINE_FLAGS[standard]
+            if not neural and not standard:
+                raise ValueError(f"{where}: voice {voice_id} has no engine")
+            if (language, gender, voice_id) in seen:
+                raise ValueError(f"{where}: duplicate voice {voice_id} for {language}, {gender}")
+            seen.add((language, gender, voice_id))
+
+            # Languages, codes and genders repeat across rows, so share one string for each
+            voices.append(PollyVoice(sys.intern(language), sys.intern(lang_code), sys.intern(whisper_lang_code),
+                                     voice_id, sys.intern(gender), neural, standard))
+    return tuple(voices)
+
 
 class PollyVoiceData:
+    # Voice records and lookup tables, shared by all instances and loaded once per process
+    # on the first lookup
+    _tables = None
+    _tables_lock = threading.Lock()
+
     def get_voice(self, language, gender):
-        for voice in self.voice_data:
-            if voice['language'] == language and voice['gender'] == gender:
-                if voice['neural'] == 'Yes':
-                    return voice['voice_id'], voice['lang_code'], NEURAL_ENGINE
-        for voice in self.voice_data:
-            if voice['language'] == language and voice['gender'] == gender:
-                if voice['standard'] == 'Yes':
-                    return voice['voice_id'], voice['lang_code'], STANDARD_ENGINE
-        return None, None, None
+        return self._get_tables()[1].get((language, gender), (None, None, None))
 
     def get_whisper_lang_code(self, language):
-        for voice in self.voice_data:
-            if voice['language'] == language:
-                return voice['whisper_lang_code']
-        return "en"
-
-    def __init__(self):
-        self.voice_data = [
-            {'language': 'Arabic',
-             'lang_code': 'arb',
-             'whisper_lang_code': 'ar',
-             'voice_id': 'Zeina',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Arabic (Gulf)',
-             'lang_code': 'ar-AE',
-             'whisper_lang_code': 'ar',
-             'voice_id': 'Hala',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Catalan',
-             'lang_code': 'ca-ES',
-             'whisper_lang_code': 'ca',
-             'voice_id': 'Arlet',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Chinese (Cantonese)',
-             'lang_code': 'yue-CN',
-             'whisper_lang_code': 'zh',
-             'voice_id': 'Hiujin',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Chinese (Mandarin)',
-             'lang_code': 'cmn-CN',
-             'whisper_lang_code': 'zh',
-             'voice_id': 'Zhiyu',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Danish',
-             'lang_code': 'da-DK',
-             'whisper_lang_code': 'da',
-             'voice_id': 'Naja',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Danish',
-             'lang_code': 'da-DK',
-             'whisper_lang_code': 'da',
-             'voice_id': 'Mads',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Dutch',
-             'lang_code': 'nl-NL',
-             'whisper_lang_code': 'nl',
-             'voice_id': 'Laura',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Dutch',
-             'lang_code': 'nl-NL',
-             'whisper_lang_code': 'nl',
-             'voice_id': 'Lotte',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Dutch',
-             'lang_code': 'nl-NL',
-             'whisper_lang_code': 'nl',
-             'voice_id': 'Ruben',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'English (Australian)',
-             'lang_code': 'en-AU',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Nicole',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'English (Australian)',
-             'lang_code': 'en-AU',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Olivia',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'English (Australian)',
-             'lang_code': 'en-AU',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Russell',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'English (British)',
-             'lang_code': 'en-GB',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Amy',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (British)',
-             'lang_code': 'en-GB',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Emma',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (British)',
-             'lang_code': 'en-GB',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Brian',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (British)',
-             'lang_code': 'en-GB',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Arthur',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'English (Indian)',
-             'lang_code': 'en-IN',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Aditi',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'English (Indian)',
-             'lang_code': 'en-IN',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Raveena',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'English (Indian)',
-             'lang_code': 'en-IN',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Kajal',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'English (New Zealand)',
-             'lang_code': 'en-NZ',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Aria',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'English (South African)',
-             'lang_code': 'en-ZA',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Ayanda',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Ivy',
-             'gender': 'Female (child)',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Joanna',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Kendra',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Kimberly',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Salli',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Joey',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Justin',
-             'gender': 'Male (child)',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Kevin',
-             'gender': 'Male (child)',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'English (US)',
-             'lang_code': 'en-US',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Matthew',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'English (Welsh)',
-             'lang_code': 'en-GB-WLS',
-             'whisper_lang_code': 'en',
-             'voice_id': 'Geraint',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Finnish',
-             'lang_code': 'fi-FI',
-             'whisper_lang_code': 'fi',
-             'voice_id': 'Suvi',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'French',
-             'lang_code': 'fr-FR',
-             'whisper_lang_code': 'fr',
-             'voice_id': 'Celine',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'French',
-             'lang_code': 'fr-FR',
-             'whisper_lang_code': 'fr',
-             'voice_id': 'Lea',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'French',
-             'lang_code': 'fr-FR',
-             'whisper_lang_code': 'fr',
-             'voice_id': 'Mathieu',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'French (Canadian)',
-             'lang_code': 'fr-CA',
-             'whisper_lang_code': 'fr',
-             'voice_id': 'Chantal',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'French (Canadian)',
-             'lang_code': 'fr-CA',
-             'whisper_lang_code': 'fr',
-             'voice_id': 'Gabrielle',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'French (Canadian)',
-             'lang_code': 'fr-CA',
-             'whisper_lang_code': 'fr',
-             'voice_id': 'Liam',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'German',
-             'lang_code': 'de-DE',
-             'whisper_lang_code': 'de',
-             'voice_id': 'Marlene',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'German',
-             'lang_code': 'de-DE',
-             'whisper_lang_code': 'de',
-             'voice_id': 'Vicki',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'German',
-             'lang_code': 'de-DE',
-             'whisper_lang_code': 'de',
-             'voice_id': 'Hans',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'German',
-             'lang_code': 'de-DE',
-             'whisper_lang_code': 'de',
-             'voice_id': 'Daniel',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'German (Austrian)',
-             'lang_code': 'de-AT',
-             'whisper_lang_code': 'de',
-             'voice_id': 'Hannah',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Hindi',
-             'lang_code': 'hi-IN',
-             'whisper_lang_code': 'hi',
-             'voice_id': 'Aditi',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Hindi',
-             'lang_code': 'hi-IN',
-             'whisper_lang_code': 'hi',
-             'voice_id': 'Kajal',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Icelandic',
-             'lang_code': 'is-IS',
-             'whisper_lang_code': 'is',
-             'voice_id': 'Dora',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Icelandic',
-             'lang_code': 'is-IS',
-             'whisper_lang_code': 'is',
-             'voice_id': 'Karl',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Italian',
-             'lang_code': 'it-IT',
-             'whisper_lang_code': 'it',
-             'voice_id': 'Carla',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Italian',
-             'lang_code': 'it-IT',
-             'whisper_lang_code': 'it',
-             'voice_id': 'Bianca',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Japanese',
-             'lang_code': 'ja-JP',
-             'whisper_lang_code': 'ja',
-             'voice_id': 'Mizuki',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Japanese',
-             'lang_code': 'ja-JP',
-             'whisper_lang_code': 'ja',
-             'voice_id': 'Takumi',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Korean',
-             'lang_code': 'ko-KR',
-             'whisper_lang_code': 'ko',
-             'voice_id': 'Seoyeon',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Norwegian',
-             'lang_code': 'nb-NO',
-             'whisper_lang_code': 'no',
-             'voice_id': 'Liv',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Norwegian',
-             'lang_code': 'nb-NO',
-             'whisper_lang_code': 'no',
-             'voice_id': 'Ida',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Polish',
-             'lang_code': 'pl-PL',
-             'whisper_lang_code': 'pl',
-             'voice_id': 'Ewa',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Polish',
-             'lang_code': 'pl-PL',
-             'whisper_lang_code': 'pl',
-             'voice_id': 'Maja',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Polish',
-             'lang_code': 'pl-PL',
-             'whisper_lang_code': 'pl',
-             'voice_id': 'Jacek',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Polish',
-             'lang_code': 'pl-PL',
-             'whisper_lang_code': 'pl',
-             'voice_id': 'Jan',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Polish',
-             'lang_code': 'pl-PL',
-             'whisper_lang_code': 'pl',
-             'voice_id': 'Ola',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Portuguese (Brazilian)',
-             'lang_code': 'pt-BR',
-             'whisper_lang_code': 'pt',
-             'voice_id': 'Camila',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Portuguese (Brazilian)',
-             'lang_code': 'pt-BR',
-             'whisper_lang_code': 'pt',
-             'voice_id': 'Vitoria',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Portuguese (Brazilian)',
-             'lang_code': 'pt-BR',
-             'whisper_lang_code': 'pt',
-             'voice_id': 'Ricardo',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Portuguese (European)',
-             'lang_code': 'pt-PT',
-             'whisper_lang_code': 'pt',
-             'voice_id': 'Ines',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Portuguese (European)',
-             'lang_code': 'pt-PT',
-             'whisper_lang_code': 'pt',
-             'voice_id': 'Cristiano',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Romanian',
-             'lang_code': 'ro-RO',
-             'whisper_lang_code': 'ro',
-             'voice_id': 'Carmen',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Russian',
-             'lang_code': 'ru-RU',
-             'whisper_lang_code': 'ru',
-             'voice_id': 'Tatyana',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Russian',
-             'lang_code': 'ru-RU',
-             'whisper_lang_code': 'ru',
-             'voice_id': 'Maxim',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Spanish (European)',
-             'lang_code': 'es-ES',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Conchita',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Spanish (European)',
-             'lang_code': 'es-ES',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Lucia',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Spanish (European)',
-             'lang_code': 'es-ES',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Enrique',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Spanish (Mexican)',
-             'lang_code': 'es-MX',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Mia',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Spanish (US)',
-             'lang_code': 'es-US',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Lupe',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'Yes'},
-            {'language': 'Spanish (US)',
-             'lang_code': 'es-US',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Penelope',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Spanish (US)',
-             'lang_code': 'es-US',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Miguel',
-             'gender': 'Male',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Spanish (US)',
-             'lang_code': 'es-US',
-             'whisper_lang_code': 'es',
-             'voice_id': 'Pedro',
-             'gender': 'Male',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Swedish',
-             'lang_code': 'sv-SE',
-             'whisper_lang_code': 'sv',
-             'voice_id': 'Astrid',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Swedish',
-             'lang_code': 'sv-SE',
-             'whisper_lang_code': 'sv',
-             'voice_id': 'Elin',
-             'gender': 'Female',
-             'neural': 'Yes',
-             'standard': 'No'},
-            {'language': 'Turkish',
-             'lang_code': 'tr-TR',
-             'whisper_lang_code': 'tr',
-             'voice_id': 'Filiz',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'},
-            {'language': 'Welsh',
-             'lang_code': 'cy-GB',
-             'whisper_lang_code': 'cy',
-             'voice_id': 'Gwyneth',
-             'gender': 'Female',
-             'neural': 'No',
-             'standard': 'Yes'}
-        ]
-
-
-# Run from the command-line
+        return self._get_tables()[2].get(language, "en")
+
+    @property
+    def voice_data(self):
+        return self._get_tables()[0]
+
+    @classmethod
+    def _get_tables(cls):
+        if cls._tables is None:
+            with cls._tables_lock:
+                if cls._tables is None:
+                    cls._tables = cls._build_tables(load_polly_voices())
+        return cls._tables
+
+    @staticmethod
+    def _build_tables(voices):
+        # The first neural voice for a language and gender wins, then the first standard one
+        neural_index, standard_index, whisper_lang_code_index = {}, {}, {}
+        for voice in voices:
+            key = (voice.language, voice.gender)
+            if voice.neural:
+                neural_index.setdefault(key, (voice.voice_id, voice.lang_code, NEURAL_ENGINE))
+            if voice.standard:
+                standard_index.setdefault(key, (voice.voice_id, voice.lang_code, STANDARD_ENGINE))
+            whisper_lang_code_index.setdefault(voice.language, voice.whisper_lang_code)
+        voice_index = {**standard_index, **neural_index}
+        return voices, MappingProxyType(voice_index), MappingProxyType(whisper_lang_code_index)
+
+
 if __name__ == '__main__':
     polly_voice_data = PollyVoiceData()
 
@@ -633,3 +153,40 @@ if __name__ == '__main__':
     print('Foo whisper_lang_code:', whisper_lang_code)
 
 
+    # Benchmark the indexed lookups against scanning the list of voices, as get_voice used to
+    def linear_get_voice(voices, language, gender):
+        for voice in voices:
+            if voice.language == language and voice.gender == gender and voice.neural:
+                return voice.voice_id, voice.lang_code, NEURAL_ENGINE
+        for voice in voices:
+            if voice.language == language and voice.gender == gender and voice.standard:
+                return voice.voice_id, voice.lang_code, STANDARD_ENGINE
+        return None, None, None
+
+    voices = polly_voice_data.voice_data
+    keys = sorted({(voice.language, voice.gender) for voice in voices})
+    keys += [('Foo', 'Male'), ('Foo', 'Female')]
+    for key in keys:
+        assert polly_voice_data.get_voice(*key) == linear_get_voice(voices, *key), key
+
+    num_rounds = 200
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        for key in keys:
+            linear_get_voice(voices, *key)
+    linear_us = (time.perf_counter() - start) / (num_rounds * len(keys)) * 1e6
+    start = time.perf_counter()
+    for _ in range(num_rounds):
+        for key in keys:
+            polly_voice_data.get_voice(*key)
+    indexed_us = (time.perf_counter() - start) / (num_rounds * len(keys)) * 1e6
+    print(f"get_voice over {len(keys)} keys: linear scan {linear_us:.2f} us, indexed {indexed_us:.2f} us")
+
+    # Time and memory for loading the catalog
+    import tracemalloc
+    tracemalloc.start()
+    start = time.perf_counter()
+    voices = load_polly_voices()
+    load_ms = (time.perf_counter() - start) * 1000
+    print(f"load_polly_voices: {len(voices)} voices in {load_ms:.2f} ms, "
+          f"{tracemalloc.get_traced_memory()[0] / 1024:.1f} KB")
@@ -0,0 +1,354 @@
+# This module answers questions about the text in the Embeddings tab. retrieve_chunks searches
+# the vector store for the chunks closest to the question, drops the ones that aren't similar
+# enough to it or that repeat a chunk already chosen, and orders the rest by maximal marginal
+# relevance: relevant to the question, but unlike the chunks before them. If they fit in the
+# token budget of the "stuff" chain's prompt, answer_question stuffs them all into one prompt.
+# Otherwise it uses a map-reduce chain, which asks about each chunk in parallel and then combines
+# the answers, rather than overflowing the context window or leaving relevant chunks out.
+# Answers are kept in an AnswerCache for a while, and returned again when the same or a very
+# similar question is asked about the same document, without retrieving chunks or asking the LLM.
+
+import asyncio
+import itertools
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain.callbacks import get_openai_callback
+from langchain.chains.question_answering import load_qa_chain
+
+from metrics_utils import Counters
+from splitter_utils import get_token_counter
+
+# Tokens of chunks stuffed into the question answering prompt. With the prompt, the question and
+# the answer, this stays well within gpt-3.5-turbo's 4096 tokens
+QA_CONTEXT_TOKENS = int(os.environ.get("QA_CONTEXT_TOKENS", "1500"))
+# Chunks considered for each question
+QA_FETCH_K = int(os.environ.get("QA_FETCH_K", "20"))
+# Cosine similarity to the question below which chunks are left out, unless none is above it.
+# Related passages are typically above 0.75 with OpenAI's ada-002 embeddings
+QA_MIN_SIMILARITY = float(os.environ.get("QA_MIN_SIMILARITY", "0.75"))
+# Chunks at least this similar to a chosen one are left out as duplicates
+QA_DUPLICATE_SIMILARITY = float(os.environ.get("QA_DUPLICATE_SIMILARITY", "0.95"))
+# Weight of relevance to the question versus difference from the chunks chosen before
+QA_MMR_LAMBDA = float(os.environ.get("QA_MMR_LAMBDA", "0.7"))
+# Whether to use a map-reduce chain when the relevant chunks don't fit in QA_CONTEXT_TOKENS,
+# rather than leaving the least relevant ones out
+QA_MAP_REDUCE = os.environ.get("QA_MAP_REDUCE", "true").lower() == "true"
+
+QA_METRICS = Counters("Question answering")
+
+# Cosine similarity to a question asked before at which its answer is reused. Rewordings of a
+# question, e.g. "What's the capital?" and "What is the capital?", are above 0.97 with ada-002
+ANSWER_CACHE_MIN_SIMILARITY = float(os.environ.get("ANSWER_CACHE_MIN_SIMILARITY", "0.97"))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+# Numbers and symbols other than punctuation, which similar questions must have in common, e.g.
+# "What is 2+2?" and "What is 2-2?" are very similar, but don't have the same answer
+LITERAL_PATTERN = re.compile(r"\d+(?:[.,]\d+)*|[^\w\s.,;:!?'\"]")
+
+
+class AnswerCache:
+    """Size-bounded, least recently used cache of answers to questions, that expire after
+    ttl_seconds. Answers are found by the exact question, or by the similarity of the question's
+    embedding to the embeddings of questions asked before. Questions are only compared with
+    those with the same key, e.g. asked about the same document and answered by the same LLM.
+    """
+
+    @staticmethod
+    def normalize(question):
+        # Only case, white space and the punctuation at the end, symbols change the question
+        return " ".join(question.casefold().split()).rstrip("?!. ")
+
+    def get(self, key, question, question_vector=None):
+        """Return the answer cached for question, or if question_vector is given, for the most
+        similar question at least min_similarity similar to it, or None. A miss is only counted
+        if question_vector is given.
+        """
+        normalized = self.normalize(question)
+        with self.lock:
+            self._expire()
+            entry_id = self.questions.get((key, normalized))
+            if entry_id is not None:
+                self.metrics.increment("exact_hits")
+            elif question_vector is not None:
+                literals = LITERAL_PATTERN.findall(normalized)
+                entry_ids = [entry_id for entry_id, entry in self.entries.items()
+                             if entry[0] == key and LITERAL_PATTERN.findall(entry[1]) == literals]
+                if entry_ids:
+                    vectors = np.vstack([self.entries[entry_id][2] for entry_id in entry_ids])
+                    similarities = vectors @ _normalized(question_vector)
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.min_similarity:
+                        entry_id = entry_ids[best]
+                        self.metrics.increment("similar_hits")
+                if entry_id is None:
+                    self.metrics.increment("misses")
+            if entry_id is None:
+                return None
+            self.entries.move_to_end(entry_id)
+            return self.entries[entry_id][3]
+
+    def put(self, key, question, question_vector, answer):
+        normalized = self.normalize(question)
+        with self.lock:
+            old_entry_id = self.questions.pop((key, normalized), None)
+            if old_entry_id is not None:
+                del self.entries[old_entry_id]
+            entry_id = next(self.entry_ids)
+            self.entries[entry_id] = (key, normalized, _normalized(question_vector), answer,
+                                      time.monotonic() + self.ttl_seconds)
+            self.questions[(key, normalized)] = entry_id
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.metrics.increment("evictions")
+
+    def hit_ratio(self):
+        counts = self.metrics.snapshot()
+        hits = counts.get("exact_hits", 0) + counts.get("similar_hits", 0)
+        total = hits + counts.get("misses", 0)
+        return hits / total if total else 0.0
+
+    def _expire(self):
+        now = time.monotonic()
+        for entry_id, entry in list(self.entries.items()):
+            if entry[4] <= now:
+                self._remove(entry_id)
+                self.metrics.increment("expirations")
+
+    def _remove(self, entry_id):
+        key, normalized, _, _, _ = self.entries.pop(entry_id)
+        del self.questions[(key, normalized)]
+
+    def __init__(self, min_similarity=ANSWER_CACHE_MIN_SIMILARITY, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES):
+        self.min_similarity = min_similarity
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # entry id -> (key, normalized question, normalized question vector, answer, expiry time),
+        # least recently used first
+        self.entries = OrderedDict()
+        # (key, normalized question) -> entry id
+        self.questions = {}
+        self.entry_ids = itertools.count()
+        self.metrics = Counters("Answer cache")
+
+
+def _normalized(vector):
+    vector = np.array(vector, dtype=np.float32)
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+def retrieve_chunks(docsearch, question_vector, fetch_k=QA_FETCH_K, min_similarity=QA_MIN_SIMILARITY,
+                    duplicate_similarity=QA_DUPLICATE_SIMILARITY, lambda_mult=QA_MMR_LAMBDA):
+    """Return the documents of docsearch, a langchain FAISS vector store, to answer the question
+    embedded as question_vector from, in order of maximal marginal relevance.
+    """
+    question_vector = _normalized(question_vector)
+    _, positions = docsearch.index.search(question_vector[None], fetch_k)
+    positions = [int(position) for position in positions[0] if position != -1]
+    if not positions:
+        return []
+
+    # Similarities are computed from the vectors, as indexes differ in what their distances are
+    vectors = np.vstack([docsearch.index.reconstruct(position) for position in positions])
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    similarities = vectors @ question_vector
+
+    candidates = [i for i in range(len(positions)) if similarities[i] >= min_similarity]
+    if not candidates:
+        candidates = [int(np.argmax(similarities))]
+    chosen = []
+    # Highest similarity of each candidate to the chunks chosen so far
+    redundancy = np.zeros(len(positions), dtype=np.float32)
+    while candidates:
+        best = max(candidates, key=lambda i: lambda_mult * similarities[i] - (1 - lambda_mult) * redundancy[i])
+        candidates.remove(best)
+        if redundancy[best] >= duplicate_similarity:
+            continue
+        chosen.append(best)
+        redundancy = np.maximum(redundancy, vectors @ vectors[best])
+    return [docsearch.docstore.search(docsearch.index_to_docstore_id[positions[i]]) for i in chosen]
+
+
+def answer_question(qa_chain, docsearch, question, callbacks=None, max_tokens=QA_CONTEXT_TOKENS,
+                    map_reduce=QA_MAP_REDUCE, cache=None):
+    """Answer question from the chunks of docsearch with qa_chain, a "stuff" question answering
+    chain, or, if the relevant chunks don't fit in max_tokens, with a map-reduce chain of the same
+    LLM. callbacks are passed to the stuff chain, e.g. to stream its answer. If cache, an
+    AnswerCache, is given, answers are looked up in and added to it. Prints the latency and
+    tokens of the question.
+    """
+    start = time.perf_counter()
+    # Vector stores built by faiss_utils have a fingerprint of their texts, others aren't cached
+    fingerprint = getattr(docsearch, "fingerprint", None)
+    if cache and fingerprint:
+        llm = qa_chain.llm_chain.llm
+        cache_key = (fingerprint, getattr(llm, "model_name", type(llm).__name__))
+    else:
+        cache_key = None
+
+    if cache_key:
+        answer = cache.get(cache_key, question)
+        if answer is not None:
+            print(f"Answered from the cache in {(time.perf_counter() - start) * 1000:.1f} ms.", cache.metrics)
+            return answer
+    question_vector = docsearch.embedding_function(question)
+    if cache_key:
+        answer = cache.get(cache_key, question, question_vector)
+        if answer is not None:
+            print(f"Answered from the cache in {(time.perf_counter() - start) * 1000:.1f} ms.", cache.metrics)
+            return answer
+
+    count_tokens = get_token_counter()
+    chunks = [(doc, count_tokens(doc.page_content)) for doc in retrieve_chunks(docsearch, question_vector)]
+    retrieval_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with get_openai_callback() as usage:
+        if not map_reduce or sum(tokens for _, tokens in chunks) <= max_tokens:
+            chain_type = "stuff"
+            # The most relevant chunks that fit, if not all do
+            docs, num_tokens = [], 0
+            for doc, tokens in chunks:
+                if num_tokens + tokens <= max_tokens:
+                    docs.append(doc)
+                    num_tokens += tokens
+            answer = qa_chain.run(input_documents=docs, question=question, callbacks=callbacks)
+        else:
+            chain_type = "map_reduce"
+            docs, num_tokens = [doc for doc, _ in chunks], sum(tokens for _, tokens in chunks)
+            # Run asynchronously so that the chunks are asked about in parallel. Not streamed,
+            # as the answers about single chunks aren't the answer
+            map_reduce_chain = load_qa_chain(qa_chain.llm_chain.llm, chain_type="map_reduce")
+            answer = asyncio.run(map_reduce_chain.arun(input_documents=docs, question=question))
+    answer_seconds = time.perf_counter() - start
+
+    QA_METRICS.increment(chain_type)
+    QA_METRICS.increment("context_tokens", num_tokens)
+    # Streamed responses don't report their usage, so it is 0 for them
+    print(f"Answered with {chain_type} from {len(docs)} of {len(chunks)} relevant chunks, {num_tokens} tokens, "
+          f"in {retrieval_seconds * 1000:.0f} ms retrieval + {answer_seconds:.2f} s answer "
+          f"({count_tokens(answer)} tokens). OpenAI usage: {usage.successful_requests} requests, "
+          f"{usage.prompt_tokens} prompt + {usage.completion_tokens} completion tokens, ${usage.total_cost:.4f}")
+    if cache_key:
+        cache.put(cache_key, question, question_vector, answer)
+    return answer
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import hashlib
+
+    from langchain.chat_models.base import BaseChatModel
+    from langchain.embeddings.base import Embeddings
+    from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+    from faiss_utils import build_vector_store
+    from splitter_utils import split_text
+
+    # Embeds texts as bags of words, so that texts about the same things are similar. Like with
+    # ada-002, all vectors share a large component, so that unrelated texts are about 0.7 similar
+    class WordEmbeddings(Embeddings):
+        def embed_documents(self, texts):
+            return [self.embed_query(text) for text in texts]
+
+        def embed_query(self, text):
+            words = np.zeros(512, dtype=np.float32)
+            for word in re.findall(r"[a-z]+", text.lower()):
+                words[1 + int(hashlib.md5(word.encode()).hexdigest(), 16) % (len(words) - 1)] += 1
+            vector = 0.53 * words / max(np.linalg.norm(words), 1e-12)
+            vector[0] = 0.85
+            return vector.tolist()
+
+    # Takes 0.5 s per call plus 1 ms per prompt token and answers "ok". A chat model like
+    # ChatOpenAI, whose asynchronous calls for several prompts run in parallel
+    class SlowChatModel(BaseChatModel):
+        @property
+        def _llm_type(self):
+            return "slow-chat"
+
+        def get_num_tokens(self, text):
+            return get_token_counter()(text)
+
+        def _generate(self, messages, stop=None, run_manager=None):
+            time.sleep(self._seconds(messages))
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content="ok"))])
+
+        async def _agenerate(self, messages, stop=None, run_manager=None):
+            await asyncio.sleep(self._seconds(messages))
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content="ok"))])
+
+        def _seconds(self, messages):
+            return 0.5 + 0.001 * sum(self.get_num_tokens(message.content) for message in messages)
+
+    topics = {
+        "capital": ["Ottawa is the capital of Canada.", "The city of Ottawa lies on the Ottawa River.",
+                    "Parliament Hill in Ottawa overlooks the river.", "Ottawa was chosen as the capital in 1857.",
+                    "The Rideau Canal in Ottawa becomes a skating rink in winter.",
+                    "Ottawa is home to many national museums.", "Ottawa has a population of about a million.",
+                    "Ottawa's tulip festival is held every May."],
+        "hockey": ["Ice hockey is the most popular winter sport in Canada.",
+                   "Canadian children learn hockey on frozen ponds.", "Hockey Night in Canada airs on Saturdays.",
+                   "The Stanley Cup is the oldest hockey trophy.", "Wayne Gretzky is a famous hockey player.",
+                   "Outdoor hockey rinks are flooded every winter.", "Hockey teams practice early in the morning.",
+                   "Canada often wins Olympic hockey gold."],
+        "syrup": ["Quebec produces most of the world's maple syrup.", "Maple syrup is made from maple tree sap.",
+                  "Sap is boiled down in sugar shacks.", "It takes forty litres of sap to make one litre of syrup.",
+                  "Maple syrup season starts in early spring.", "Maple taffy is made by pouring syrup on snow.",
+                  "Maple syrup is graded by colour and taste.", "The maple leaf is on Canada's flag."],
+        "geography": ["Canada is the second largest country by area.", "Canada spans from the Atlantic to the Pacific.",
+                      "The Canadian Arctic has thousands of islands.", "Canada has more lakes than any other country.",
+                      "The Rocky Mountains run through western Canada.", "Canada shares the longest border with the US.",
+                      "Most Canadians live near the southern border.", "The Canadian Shield covers half the country."],
+    }
+    # Paragraphs of random sentences about one topic, and some paragraphs repeated word for word
+    rng = np.random.default_rng(0)
+    paragraphs = [" ".join(rng.choice(sentences, 4, replace=False))
+                  for _ in range(40) for sentences in topics.values()]
+    paragraphs += paragraphs[:20]
+    texts = list(split_text("\n\n".join(paragraphs)))
+    docsearch = build_vector_store(texts, WordEmbeddings().embed_documents(texts), WordEmbeddings())
+    llm = SlowChatModel()
+    qa_chain = load_qa_chain(llm, chain_type="stuff")
+
+    for question in ["What is the capital of Canada?", "Where does maple syrup come from?",
+                     "Tell me everything about hockey and maple syrup and Ottawa."]:
+        print(question)
+        start = time.perf_counter()
+        docs = docsearch.similarity_search(question)
+        qa_chain.run(input_documents=docs, question=question)
+        print(f"  similarity_search, k=4: {sum(get_token_counter()(doc.page_content) for doc in docs)} tokens, "
+              f"{time.perf_counter() - start:.2f} s")
+        for max_tokens in [1500, 300]:
+            print(f"  answer_question, {max_tokens} token budget: ", end="")
+            answer_question(qa_chain, docsearch, question, max_tokens=max_tokens, map_reduce=True)
+
+    # The map step of a map-reduce chain, called synchronously, asks about one chunk after another
+    question = "Tell me everything about hockey and maple syrup and Ottawa."
+    docs = retrieve_chunks(docsearch, WordEmbeddings().embed_query(question))
+    map_reduce_chain = load_qa_chain(llm, chain_type="map_reduce")
+    start = time.perf_counter()
+    map_reduce_chain.run(input_documents=docs, question=question)
+    print(f"map_reduce over {len(docs)} chunks, sequential: {time.perf_counter() - start:.2f} s")
+    start = time.perf_counter()
+    asyncio.run(map_reduce_chain.arun(input_documents=docs, question=question))
+    print(f"map_reduce over {len(docs)} chunks, parallel:   {time.perf_counter() - start:.2f} s")
+    print(QA_METRICS)
+
+    # Questions as they are asked in a session, some of them again or reworded
+    questions = ["What is the capital of Canada?", "Where does maple syrup come from?",
+                 "What is the capital of Canada?", "what's the capital of Canada", "How is maple syrup made?",
+                 "Where does maple syrup come from ?", "Which city is the capital of Canada?",
+                 "Where does the maple syrup come from?"]
+    for cache in [None, AnswerCache()]:
+        start = time.perf_counter()
+        for question in questions:
+            answer_question(qa_chain, docsearch, question, cache=cache)
+        print(f"{len(questions)} questions {'with' if cache else 'without'} the answer cache: "
+              f"{time.perf_counter() - start:.2f} s")
+    print(cache.metrics, f"hit_ratio={cache.hit_ratio():.2f}")
@@ -0,0 +1,226 @@
+# This module uploads recordings to S3 for the serverless Whisper endpoint to download.
+# Each recording gets a random key, so that recordings uploaded in the same second by different
+# sessions don't overwrite each other, and the endpoint is given a presigned URL of it instead
+# of making the object public with a second request. The URL is signed locally, so an upload
+# is a single request, or a single multipart upload for large files.
+# Recordings are deleted once they have been transcribed, and a lifecycle rule on the bucket
+# expires any that are left behind, e.g. by a crash. The rule is added once when setting up the
+# bucket, by whoever may configure it, with
+#     python s3_utils.py --setup-lifecycle <bucket>
+# The app only checks for it at startup and warns if it's missing.
+
+import mimetypes
+import os
+import sys
+import uuid
+
+from botocore.exceptions import ClientError
+
+# Prefix of the keys of uploaded recordings, the lifecycle rule only applies to these
+AUDIO_UPLOAD_PREFIX = "whisper-input/"
+# Presigned URLs are valid until the transcription job has certainly timed out
+AUDIO_URL_EXPIRY_SECONDS = 15 * 60
+# Recordings left in the bucket are expired after this many days
+AUDIO_EXPIRY_DAYS = 1
+AUDIO_LIFECYCLE_RULE_ID = "expire-whisper-input"
+
+
+def setup_lifecycle(s3, bucket, prefix=AUDIO_UPLOAD_PREFIX, expiry_days=AUDIO_EXPIRY_DAYS):
+    """Add the rule that expires recordings under prefix after expiry_days to the bucket's
+    lifecycle configuration, keeping its other rules. Needs s3:GetLifecycleConfiguration and
+    s3:PutLifecycleConfiguration. Returns False if the rule was there already.
+    """
+    rules = _lifecycle_rules(s3, bucket)
+    if any(rule.get("ID") == AUDIO_LIFECYCLE_RULE_ID for rule in rules):
+        return False
+    rules.append({"ID": AUDIO_LIFECYCLE_RULE_ID, "Status": "Enabled",
+                  "Filter": {"Prefix": prefix},
+                  "Expiration": {"Days": expiry_days}})
+    s3.put_bucket_lifecycle_configuration(Bucket=bucket, LifecycleConfiguration={"Rules": rules})
+    return True
+
+
+def _lifecycle_rules(s3, bucket):
+    try:
+        return s3.get_bucket_lifecycle_configuration(Bucket=bucket)["Rules"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+            raise
+        return []
+
+
+class S3AudioStore:
+    """Uploads recordings to a bucket and shares them with presigned URLs."""
+
+    def upload(self, path):
+        """Upload the file at path, and return its key and a presigned URL to download it."""
+        extension = os.path.splitext(path)[1]
+        key = f"{self.prefix}{uuid.uuid4().hex}{extension}"
+        extra_args = {}
+        content_type = mimetypes.guess_type(path)[0]
+        if content_type:
+            extra_args["ContentType"] = content_type
+        # A managed transfer, in parts if the file is larger than the multipart threshold
+        self.s3.upload_file(path, self.bucket, key, ExtraArgs=extra_args)
+        url = self.s3.generate_presigned_url("get_object", Params={"Bucket": self.bucket, "Key": key},
+                                             ExpiresIn=self.url_expiry_seconds)
+        return key, url
+
+    def delete(self, key):
+        try:
+            self.s3.delete_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            # The lifecycle rule expires it eventually
+            print(f"Deleting s3://{self.bucket}/{key} failed:", e)
+
+    def check_lifecycle(self):
+        """Warn if the bucket has no rule that expires recordings left behind, see
+        setup_lifecycle. Returns True if it has. Only reads the configuration.
+        """
+        try:
+            rules = _lifecycle_rules(self.s3, self.bucket)
+        except ClientError as e:
+            # E.g. not allowed to read the bucket's configuration
+            print(f"Checking the lifecycle of s3://{self.bucket} failed:", e)
+            return False
+        if any(rule.get("ID") == AUDIO_LIFECYCLE_RULE_ID and rule.get("Status") == "Enabled" for rule in rules):
+            return True
+        print(f"Warning: recordings left in s3://{self.bucket}/{self.prefix} don't expire, "
+              f"run python s3_utils.py --setup-lifecycle {self.bucket}")
+        return False
+
+    def __init__(self, s3, bucket, prefix=AUDIO_UPLOAD_PREFIX, url_expiry_seconds=AUDIO_URL_EXPIRY_SECONDS):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expiry_seconds = url_expiry_seconds
+
+
+# Run from the command-line
+if __name__ == '__main__' and sys.argv[1:2] == ["--setup-lifecycle"]:
+    import boto3
+
+    if len(sys.argv) != 3:
+        sys.exit(f"Usage: python {sys.argv[0]} --setup-lifecycle <bucket>")
+    if setup_lifecycle(boto3.client("s3"), sys.argv[2]):
+        print(f"Recordings in s3://{sys.argv[2]}/{AUDIO_UPLOAD_PREFIX} expire after {AUDIO_EXPIRY_DAYS} days")
+    else:
+        print(f"s3://{sys.argv[2]} already has the {AUDIO_LIFECYCLE_RULE_ID} rule")
+elif __name__ == '__main__':
+    import base64
+    import tempfile
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit
+
+    import boto3
+    from botocore.config import Config
+
+    # Stands in for S3: objects and lifecycle configurations in memory, path-style URLs, and
+    # each request delayed by a round trip to the region
+    ROUND_TRIP_SECONDS = float(os.environ.get("S3_ROUND_TRIP_SECONDS", "0.05"))
+    objects, lifecycles, num_requests = {}, {}, []
+
+    class S3Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_PUT(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            path, query = self._split()
+            if query == "lifecycle":
+                lifecycles[path] = body
+            elif query != "acl":
+                objects[path] = body
+            self._respond(200, headers={"ETag": '"0"'})
+
+        def do_GET(self):
+            path, query = self._split()
+            if query == "lifecycle":
+                if path not in lifecycles:
+                    self._respond(404, b"<Error><Code>NoSuchLifecycleConfiguration</Code></Error>")
+                else:
+                    self._respond(200, lifecycles[path])
+            elif path in objects:
+                self._respond(200, objects[path])
+            else:
+                self._respond(404, b"<Error><Code>NoSuchKey</Code></Error>")
+
+        def do_DELETE(self):
+            objects.pop(self._split()[0], None)
+            self._respond(204)
+
+        def _split(self):
+            url = urlsplit(self.path)
+            return url.path, url.query.split("=")[0]
+
+        def _respond(self, status, body=b"", headers={}):
+            num_requests.append(self.command)
+            time.sleep(ROUND_TRIP_SECONDS)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), S3Handler)
+    ThreadPoolExecutor(1).submit(server.serve_forever)
+    s3 = boto3.client("s3", endpoint_url=f"http://127.0.0.1:{server.server_port}", region_name="us-east-1",
+                      aws_access_key_id="test", aws_secret_access_key="test",
+                      config=Config(s3={"addressing_style": "path"},
+                                    request_checksum_calculation="when_required"))
+
+    # 16 sessions each sending a 10 s recording (16 kHz, 16 bit) in the same second
+    NUM_SESSIONS = 16
+    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
+        f.write(os.urandom(320000))
+    recording = f.name
+
+    def upload_with_acl(_):
+        # The previous share_url
+        key = f"{int(time.time())}_aud.mp3"
+        s3.upload_file(recording, "bucket", key)
+        s3.put_object_acl(Bucket="bucket", Key=key, ACL="public-read")
+        return key
+
+    store = S3AudioStore(s3, "bucket")
+    store.check_lifecycle()
+    setup_lifecycle(s3, "bucket")
+    print("lifecycle rule found:", store.check_lifecycle())
+    store.upload(recording)
+    objects.clear()
+
+    def upload_presigned(_):
+        return store.upload(recording)[0]
+
+    def encode_inline(_):
+        with open(recording, "rb") as f:
+            return base64.b64encode(f.read())
+
+    for label, share in [("upload and ACL", upload_with_acl), ("presigned upload", upload_presigned),
+                         ("inline base64", encode_inline)]:
+        del num_requests[:]
+
+        def timed(i):
+            start = time.perf_counter()
+            result = share(i)
+            return result, time.perf_counter() - start
+
+        with ThreadPoolExecutor(NUM_SESSIONS) as executor:
+            results, latencies = zip(*executor.map(timed, range(NUM_SESSIONS)))
+        if share is encode_inline:
+            kept, num_bytes = "", len(results[0])
+        else:
+            kept, num_bytes = f", {len(set(results))} of {NUM_SESSIONS} kept", os.path.getsize(recording)
+        print(f"{label:16s} {sum(latencies) / NUM_SESSIONS * 1000:5.1f} ms, "
+              f"{len(num_requests) / NUM_SESSIONS:.0f} requests, {num_bytes} bytes per recording{kept}")
+
+    for key in list(objects):
+        store.delete(key.split("/", 2)[2])
+    print("objects left:", len(objects), "lifecycle:", lifecycles["/bucket"].decode()[:120])
+    os.remove(recording)
+    server.shutdown()
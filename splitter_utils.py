@@ -0,0 +1,159 @@
+# This module splits the text pasted into the Embeddings tab into chunks for embedding.
+# split_text is a generator that walks the text once, sentence by sentence, and yields each chunk
+# as soon as it is complete, so chunks can be embedded while the rest of the text is still being
+# split, without a list of all the pieces and chunks in memory. Chunks are measured in tokens
+# rather than characters, end at sentence boundaries and overlap by a few sentences, so that the
+# chunks a question retrieves fit the "stuff" question answering chain's prompt.
+# Where chunks end is decided by the text around the end, not by where the previous chunk ended,
+# so that after an edit only the chunks around it change and the rest are found in the
+# embedding cache.
+
+import os
+import re
+import zlib
+from collections import deque
+
+# tiktoken's encoding of gpt-3.5-turbo, gpt-4 and text-embedding-ada-002
+TIKTOKEN_ENCODING = "cl100k_base"
+# Without tiktoken, a token is estimated to be about 4 characters of English text
+CHARACTERS_PER_TOKEN = 4
+
+# The question answering chain is given the 4 chunks closest to the question, about 1000 tokens
+EMBEDDING_CHUNK_TOKENS = int(os.environ.get("EMBEDDING_CHUNK_TOKENS", "256"))
+# Sentences at the end of a chunk that are repeated at the start of the next one, so that
+# a passage split between two chunks is still found whole in one of them
+EMBEDDING_CHUNK_OVERLAP_TOKENS = int(os.environ.get("EMBEDDING_CHUNK_OVERLAP_TOKENS", "32"))
+
+# A sentence starts with a non-space character and ends with punctuation (and closing quotes or
+# brackets) followed by white space, before a blank line or at the end of the text
+SENTENCE_PATTERN = re.compile(r"""\S(?:[^.!?\n]+|[.!?]+["')\]]*(?![\s"')\]]|\Z)|\n(?![ \t]*\n))*(?:[.!?]+["')\]]*)?""")
+WORD_PATTERN = re.compile(r"\S+")
+PARAGRAPH_END_PATTERN = re.compile(r"\s*(\n[ \t]*\n|\Z)")
+# Once a chunk is half full, it ends at the end of a paragraph, or after about one in this
+# many sentences, picked by a hash of the sentence
+SENTENCE_BOUNDARY_ODDS = 4
+
+_count_tokens = None
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARACTERS_PER_TOKEN - 1) // CHARACTERS_PER_TOKEN
+
+
+def get_token_counter():
+    """Return a function that counts the tokens of a text with tiktoken, or estimates them
+    if tiktoken isn't installed or can't download its encoding.
+    """
+    global _count_tokens
+    if _count_tokens is None:
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding(TIKTOKEN_ENCODING)
+            _count_tokens = lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception as e:
+            print("Estimating tokens from characters, tiktoken isn't available:", e)
+            _count_tokens = estimate_tokens
+    return _count_tokens
+
+
+def split_text(text, max_tokens=EMBEDDING_CHUNK_TOKENS, overlap_tokens=EMBEDDING_CHUNK_OVERLAP_TOKENS,
+               count_tokens=None):
+    """Yield chunks of text of at most about max_tokens tokens each, ending at sentence
+    boundaries where possible. Each chunk starts with the last sentences, up to overlap_tokens,
+    of the previous one.
+    """
+    count_tokens = count_tokens or get_token_counter()
+    # (start, end, tokens) of the pieces of text in the current chunk, and whether any of them
+    # weren't in the previous chunk
+    chunk = deque()
+    chunk_tokens = 0
+    is_new = False
+    for start, end, tokens, is_boundary in _pieces(text, max_tokens, count_tokens):
+        if chunk_tokens + tokens > max_tokens:
+            if is_new:
+                yield text[chunk[0][0]:chunk[-1][1]]
+                is_new = False
+            chunk_tokens = _drop_to(chunk, chunk_tokens, min(overlap_tokens, max_tokens - tokens))
+        chunk.append((start, end, tokens))
+        chunk_tokens += tokens
+        is_new = True
+        if is_boundary and chunk_tokens >= max_tokens // 2:
+            yield text[chunk[0][0]:chunk[-1][1]]
+            is_new = False
+            chunk_tokens = _drop_to(chunk, chunk_tokens, overlap_tokens)
+    if is_new:
+        yield text[chunk[0][0]:chunk[-1][1]]
+
+
+def _drop_to(chunk, chunk_tokens, max_tokens):
+    # Drop pieces from the start of chunk until it has at most max_tokens
+    while chunk and chunk_tokens > max_tokens:
+        chunk_tokens -= chunk.popleft()[2]
+    return chunk_tokens
+
+
+def _pieces(text, max_tokens, count_tokens):
+    # (start, end, tokens, whether a chunk may end after it) of the sentences of text, with the
+    # ones longer than max_tokens split between words, and words longer than that split anywhere
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = match.group()
+        if sentence[-1].isspace():
+            # At a blank line
+            sentence = sentence.rstrip()
+        start, end = match.start(), match.start() + len(sentence)
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            is_boundary = (PARAGRAPH_END_PATTERN.match(text, end) is not None
+                           or zlib.crc32(sentence.encode("utf-8")) % SENTENCE_BOUNDARY_ODDS == 0)
+            yield start, end, tokens, is_boundary
+            continue
+        for match in WORD_PATTERN.finditer(text, start, end):
+            word_tokens = count_tokens(match.group())
+            if word_tokens <= max_tokens:
+                yield match.start(), match.end(), word_tokens, False
+                continue
+            # A token is at least one character
+            for word_start in range(match.start(), match.end(), max_tokens):
+                word_end = min(word_start + max_tokens, match.end())
+                yield word_start, word_end, count_tokens(text[word_start:word_end]), False
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import time
+    import tracemalloc
+
+    from langchain.text_splitter import CharacterTextSplitter
+
+    count_tokens = get_token_counter()
+    text = "Canada is a country in North America. It is the second largest country in the world " \
+           "by total area!\n\nIts capital is Ottawa, and its largest city is \"Toronto.\" Is it cold? Often."
+    for chunk in split_text(text, max_tokens=32, overlap_tokens=16):
+        print(f"{count_tokens(chunk):3d} tokens: {chunk!r}")
+
+    # A 20 MB document, split by the previous splitter and by split_text
+    paragraphs = [f"Paragraph {i}. " + "Canada is the second largest country in the world by total area. " * (i % 16)
+                  for i in range(40000)]
+    document = "\n\n".join(paragraphs)
+    del paragraphs
+    print(f"document: {len(document) / 1e6:.1f} MB")
+
+    splitters = [("CharacterTextSplitter",
+                  lambda: CharacterTextSplitter(chunk_size=1000, chunk_overlap=0).split_text(document)),
+                 ("split_text", lambda: split_text(document))]
+    for label, splitter in splitters:
+        start = time.perf_counter()
+        num_chunks, longest = 0, 0
+        for chunk in splitter():
+            num_chunks += 1
+            longest = max(longest, count_tokens(chunk))
+        elapsed = time.perf_counter() - start
+
+        # Measured separately, tracemalloc slows down allocations
+        tracemalloc.start()
+        for _ in splitter():
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{label:21s} {num_chunks} chunks, longest {longest} tokens, {elapsed:.2f} s, "
+              f"peak {peak / 1e6:.1f} MB besides the document")
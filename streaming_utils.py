@@ -0,0 +1,65 @@
+# This module streams the answer of a chain to the UI while the LLM is still generating it.
+# The handler below receives tokens from a ChatOpenAI created with streaming=True and reports
+# the answer text received so far. For the conversational agent, only the text after the
+# "AI:" prefix of its final answer is reported, so thoughts and tool actions are not shown.
+
+import queue
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+AGENT_ANSWER_PREFIX = "AI:"
+
+
+class AnswerStreamHandler(BaseCallbackHandler):
+    """Call on_answer with the answer generated so far each time a new token arrives.
+    If answer_prefix is given, text is only reported once an LLM call has produced the prefix,
+    and only the part after it. Otherwise the whole output of every LLM call is reported.
+    """
+
+    def __init__(self, on_answer, answer_prefix=None):
+        # Not on_text, which is the callback chains call with their prompts
+        self.on_answer = on_answer
+        self.answer_prefix = answer_prefix
+        # run_id -> (text generated so far, start of the answer in it or -1)
+        self.outputs = {}
+
+    def on_llm_new_token(self, token, run_id=None, **kwargs):
+        text, answer_start = self.outputs.get(run_id, ("", -1))
+        text += token
+        if self.answer_prefix is None:
+            answer_start = 0
+        elif answer_start == -1:
+            prefix_start = text.find(self.answer_prefix)
+            if prefix_start != -1:
+                answer_start = prefix_start + len(self.answer_prefix)
+        self.outputs[run_id] = (text, answer_start)
+
+        if answer_start != -1:
+            answer = text[answer_start:].strip()
+            if answer:
+                self.on_answer(answer)
+
+    def on_llm_end(self, response, run_id=None, **kwargs):
+        self.outputs.pop(run_id, None)
+
+    def on_llm_error(self, error, run_id=None, **kwargs):
+        self.outputs.pop(run_id, None)
+
+
+def iter_partial_results(future, updates, poll_interval=0.05):
+    """Yield the latest value put on the updates queue until future is done.
+    Values that arrive faster than they are consumed are coalesced, only the newest is yielded.
+    """
+    while True:
+        try:
+            latest = updates.get(timeout=poll_interval)
+        except queue.Empty:
+            if future.done():
+                return
+            continue
+        while True:
+            try:
+                latest = updates.get_nowait()
+            except queue.Empty:
+                break
+        yield latest
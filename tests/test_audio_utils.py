@@ -0,0 +1,128 @@
+import functools
+import os
+import shutil
+import wave
+
+import numpy as np
+import pytest
+
+import audio_utils
+from audio_utils import FRAME_SECONDS, SAMPLE_RATE, SILENCE_PAD_SECONDS, SilenceTrimmer, shrink_recording
+
+FRAME_BYTES = int(FRAME_SECONDS * SAMPLE_RATE) * 2
+PAD_SECONDS = int(SILENCE_PAD_SECONDS / FRAME_SECONDS) * FRAME_SECONDS
+
+
+def make_samples(*parts, sample_rate=SAMPLE_RATE, noise=0.0005):
+    """Return 16 bit samples of noise standing in for a recording of parts, (seconds, is_speech)
+    pairs, as bytes.
+    """
+    rng = np.random.default_rng(0)
+    audio = np.concatenate([rng.standard_normal(int(seconds * sample_rate)) * (0.1 if is_speech else noise)
+                            for seconds, is_speech in parts])
+    return (np.clip(audio, -1, 1) * 32767).astype(np.int16).tobytes()
+
+
+def trim(data, block_bytes):
+    trimmer = SilenceTrimmer()
+    kept = b"".join(trimmer.feed(data[i:i + block_bytes]) for i in range(0, len(data), block_bytes))
+    return kept, trimmer
+
+
+RECORDING = [(1, False), (2, True), (3, False), (2, True), (1, False)]
+
+
+@pytest.mark.parametrize("block_bytes", [audio_utils.READ_BYTES, 1001])
+def test_silence_around_speech_is_dropped_and_pauses_shortened(block_bytes):
+    data = make_samples(*RECORDING)
+    kept, trimmer = trim(data, block_bytes)
+
+    # The speech, and the padding before and after each part of it
+    expected_seconds = 2 * 2 + 4 * PAD_SECONDS
+    assert abs(trimmer.kept_seconds() - expected_seconds) <= 2 * FRAME_SECONDS
+    assert len(kept) == round(trimmer.kept_seconds() / FRAME_SECONDS) * FRAME_BYTES
+    # Whole frames of the recording, in order
+    frames = [data[i:i + FRAME_BYTES] for i in range(0, len(data), FRAME_BYTES)]
+    kept_frames = [kept[i:i + FRAME_BYTES] for i in range(0, len(kept), FRAME_BYTES)]
+    positions = [frames.index(frame) for frame in kept_frames]
+    assert positions == sorted(positions)
+
+
+def test_silence_is_dropped_altogether():
+    kept, trimmer = trim(make_samples((5, False)), audio_utils.READ_BYTES)
+    assert kept == b""
+    assert trimmer.kept_seconds() == 0
+
+
+def test_speech_is_kept_in_a_noisy_recording():
+    # Background noise louder than the absolute threshold, but much quieter than the speech
+    data = make_samples((0.5, False), (3, True), (2, False), (3, True), (2, False), noise=0.01)
+    kept, trimmer = trim(data, audio_utils.READ_BYTES)
+    assert abs(trimmer.kept_seconds() - (2 * 3 + 4 * PAD_SECONDS)) <= 2 * FRAME_SECONDS
+
+
+def find_ffmpeg():
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return shutil.which("ffmpeg")
+
+
+requires_ffmpeg = pytest.mark.skipif(find_ffmpeg() is None, reason="needs ffmpeg")
+
+
+def write_wav(path, *parts):
+    # As the browser records, 48 kHz stereo
+    samples = np.frombuffer(make_samples(*parts, sample_rate=48000), dtype=np.int16)
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(48000)
+        f.writeframes(np.repeat(samples, 2).tobytes())
+
+
+@pytest.fixture
+def ffmpeg(monkeypatch):
+    ffmpeg = find_ffmpeg()
+    monkeypatch.setattr(audio_utils, "preprocess_recording",
+                        functools.partial(audio_utils.preprocess_recording, ffmpeg=ffmpeg))
+    return ffmpeg
+
+
+@requires_ffmpeg
+def test_recordings_are_shrunk_to_their_speech(tmp_path, ffmpeg):
+    path = tmp_path / "recording.wav"
+    write_wav(path, *RECORDING)
+    output_path = tmp_path / "recording.ogg"
+
+    seconds = audio_utils.preprocess_recording(str(path), str(output_path), ffmpeg=ffmpeg)
+    assert abs(seconds - (2 * 2 + 4 * PAD_SECONDS)) <= 0.1
+    assert output_path.read_bytes()[:4] == b"OggS"
+    assert os.path.getsize(output_path) < os.path.getsize(path) / 10
+
+
+@requires_ffmpeg
+def test_shrink_recording_sends_silent_and_broken_recordings_as_they_are(tmp_path, ffmpeg):
+    recording = tmp_path / "recording.wav"
+    write_wav(recording, *RECORDING)
+    silent = tmp_path / "silent.wav"
+    write_wav(silent, (3, False))
+    broken = tmp_path / "broken.wav"
+    broken.write_bytes(b"not a recording")
+
+    shrunk = shrink_recording(str(recording))
+    assert shrunk.endswith(audio_utils.PREPROCESSED_EXTENSION)
+    os.remove(shrunk)
+    assert shrink_recording(str(silent)) == str(silent)
+    assert shrink_recording(str(broken)) == str(broken)
+
+
+def test_shrink_recording_without_ffmpeg_sends_the_recording_as_it_is(tmp_path, monkeypatch):
+    monkeypatch.setattr(audio_utils, "preprocess_recording",
+                        functools.partial(audio_utils.preprocess_recording, ffmpeg=str(tmp_path / "no-ffmpeg")))
+    monkeypatch.setattr(audio_utils.tempfile, "tempdir", str(tmp_path))
+    path = str(tmp_path / "recording.wav")
+    write_wav(path, *RECORDING)
+    assert shrink_recording(path) == path
+    assert os.listdir(tmp_path) == ["recording.wav"]
@@ -0,0 +1,63 @@
+import os
+import threading
+
+from cache_utils import DiskLRUCache
+
+
+def make_cache(cache_dir, max_bytes=1024):
+    return DiskLRUCache(str(cache_dir), max_bytes, ".bin", "Test cache")
+
+
+def test_bytes_round_trip_and_count_hits(tmp_path):
+    cache = make_cache(tmp_path)
+    path = cache.put_bytes("a", b"abc")
+    assert path == os.path.join(str(tmp_path), "a.bin")
+    assert cache.get_bytes("a") == b"abc"
+    assert cache.get_path("a") == path
+    assert cache.get_bytes("b") is None
+    assert cache.hit_ratio() == 2 / 3
+
+
+def test_replacing_an_entry_keeps_the_size_right(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=10)
+    cache.put_bytes("a", b"\0" * 8)
+    cache.put_bytes("a", b"\0" * 4)
+    cache.put_bytes("b", b"\0" * 6)
+    assert cache.size == 10
+    assert cache.get_bytes("a") == b"\0" * 4
+
+
+def test_an_entry_deleted_behind_the_cache_is_a_miss(tmp_path):
+    cache = make_cache(tmp_path)
+    os.remove(cache.put_bytes("a", b"abc"))
+    assert cache.get_bytes("a") is None
+
+
+def test_only_stale_temp_files_are_removed_on_load(tmp_path):
+    # Left over from an interrupted write
+    stale = tmp_path / "a.bin.0123.tmp"
+    stale.write_bytes(b"partial")
+    os.utime(stale, (1000, 1000))
+    # Another process's write in progress
+    (tmp_path / "b.bin.4567.tmp").write_bytes(b"partial")
+
+    cache = make_cache(tmp_path)
+    assert os.listdir(tmp_path) == ["b.bin.4567.tmp"]
+    assert cache.size == 0
+
+
+def test_concurrent_puts_stay_within_the_size(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=100)
+
+    def put(thread):
+        for i in range(50):
+            cache.put_bytes(f"{thread}-{i}", b"\0" * 10)
+
+    threads = [threading.Thread(target=put, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert cache.size == 100
+    assert len(cache.entries) == 10
+    assert sorted(os.listdir(tmp_path)) == sorted(key + ".bin" for key in cache.entries)
@@ -0,0 +1,46 @@
+import threading
+import time
+
+from concurrency_utils import SessionExecutor
+
+
+def test_turns_of_a_session_run_in_order():
+    executor = SessionExecutor(max_workers=4)
+    log, log_lock = [], threading.Lock()
+
+    def turn(session_id, i):
+        # Later turns are quicker, so they would overtake earlier ones if run concurrently
+        time.sleep(0.01 * (5 - i))
+        with log_lock:
+            log.append((session_id, i))
+
+    futures = [executor.submit(session_id, turn, session_id, i) for i in range(5) for session_id in "abc"]
+    for future in futures:
+        future.result()
+    executor.shutdown()
+    for session_id in "abc":
+        assert [i for s, i in log if s == session_id] == list(range(5))
+    assert executor.active_sessions() == 0
+
+
+def test_sessions_run_concurrently():
+    executor = SessionExecutor(max_workers=2)
+    started = threading.Barrier(2, timeout=5)
+    # Both turns can only pass the barrier if they run at the same time
+    futures = [executor.submit(session_id, started.wait) for session_id in ("a", "b")]
+    for future in futures:
+        future.result()
+    executor.shutdown()
+
+
+def test_a_failed_turn_does_not_block_the_session():
+    executor = SessionExecutor(max_workers=1)
+
+    def fail():
+        raise ValueError("turn failed")
+
+    failed = executor.submit("a", fail)
+    after = executor.submit("a", lambda: "next turn")
+    assert isinstance(failed.exception(), ValueError)
+    assert after.result() == "next turn"
+    executor.shutdown()
@@ -0,0 +1,187 @@
+import threading
+import time
+
+import pytest
+from langchain.embeddings.base import Embeddings
+from openai.error import InvalidRequestError, RateLimitError
+
+import embedding_utils
+from embedding_utils import CachedEmbeddings, EmbeddingCache, embed_in_batches
+
+
+class CountingEmbeddings(Embeddings):
+    """Embeds a text as [its length, its number of words], and remembers what it was asked."""
+
+    def embed_documents(self, texts):
+        with self.lock:
+            self.requests.append(list(texts))
+        return [[float(len(text)), float(len(text.split()))] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def embedded_texts(self):
+        return [text for request in self.requests for text in request]
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+        self.model = "counting"
+
+
+def test_embedding_cache_round_trips_and_evicts(tmp_path):
+    # Each vector of 4 float32s takes 16 bytes
+    cache = EmbeddingCache(str(tmp_path), max_bytes=32)
+    cache.put("ada", "first", [0.5, 1.0, -2.0, 0.25])
+    cache.put("ada", "second", [1.0, 2.0, 3.0, 4.0])
+    assert cache.get("ada", "first") == [0.5, 1.0, -2.0, 0.25]
+    assert cache.get("other-model", "first") is None
+    cache.put("ada", "third", [0.0, 0.0, 0.0, 0.0])
+
+    assert cache.get("ada", "second") is None
+    assert cache.get("ada", "first") is not None
+    assert cache.get("ada", "third") == [0.0, 0.0, 0.0, 0.0]
+    assert cache.metrics.get("evictions") == 1
+
+
+def test_only_new_and_changed_chunks_are_embedded(tmp_path):
+    model = CountingEmbeddings()
+    document = ["First paragraph.", "Second paragraph.", "Third paragraph."]
+    first = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)))
+    assert first.embed_documents(document) == model.embed_documents(document)
+    model.requests.clear()
+
+    # The same document again, with one paragraph edited, after a restart
+    edited = ["First paragraph.", "Second paragraph, edited.", "Third paragraph."]
+    again = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)))
+    assert again.embed_documents(edited) == [[16.0, 2.0], [25.0, 3.0], [16.0, 2.0]]
+    assert model.embedded_texts() == ["Second paragraph, edited."]
+
+
+def test_repeated_chunks_are_embedded_once(tmp_path):
+    model = CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)))
+    texts, vectors = embeddings.embed_chunks(iter(["Hello.", "Hi there.", "Hello."]))
+    assert texts == ["Hello.", "Hi there.", "Hello."]
+    assert vectors == [[6.0, 1.0], [9.0, 2.0], [6.0, 1.0]]
+    assert model.embedded_texts() == ["Hello.", "Hi there."]
+
+
+def test_vectors_of_different_models_are_kept_apart(tmp_path):
+    cache = EmbeddingCache(str(tmp_path))
+    model = CountingEmbeddings()
+    CachedEmbeddings(model, cache).embed_documents(["Hello."])
+    CachedEmbeddings(model, cache, model="other").embed_documents(["Hello."])
+    assert model.embedded_texts() == ["Hello.", "Hello."]
+
+
+def test_queries_go_to_the_query_model(tmp_path):
+    model, query_model = CountingEmbeddings(), CountingEmbeddings()
+    embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)), query_embeddings=query_model)
+    assert embeddings.embed_query("Why?") == [4.0, 1.0]
+    assert model.requests == []
+    assert query_model.embedded_texts() == ["Why?"]
+
+
+class FlakyEmbeddings(CountingEmbeddings):
+    """Takes longer for earlier batches, and fails the batches holding fail_texts fail_times times."""
+
+    def embed_documents(self, texts):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failing = self.failures_left > 0 and any(text in self.fail_texts for text in texts)
+            if failing:
+                self.failures_left -= 1
+        try:
+            time.sleep(0.02 / (1 + int(texts[0].split()[-1])))
+            if failing:
+                raise self.error
+            return super().embed_documents(texts)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def __init__(self, fail_texts=(), fail_times=0, error=RateLimitError("Rate limit reached")):
+        super().__init__()
+        self.fail_texts = set(fail_texts)
+        self.failures_left = fail_times
+        self.error = error
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+
+def numbered_texts(num_texts):
+    return [f"chunk {i}" for i in range(num_texts)]
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(embedding_utils, "EMBEDDING_RETRY_BASE_SECONDS", 0)
+
+
+def test_batches_come_back_in_order(no_backoff):
+    model = FlakyEmbeddings()
+    texts = numbered_texts(23)
+    batches = []
+    vectors = embed_in_batches(model, texts, batch_size=5, max_workers=3,
+                               on_batch=lambda batch, _: batches.append(batch))
+    assert vectors == CountingEmbeddings().embed_documents(texts)
+    assert sorted(len(batch) for batch in model.requests) == [3, 5, 5, 5, 5]
+    assert sorted(batches) == sorted(model.requests)
+    assert model.max_in_flight <= 3
+
+
+def test_a_generator_is_only_read_as_far_as_the_batches_in_flight(no_backoff):
+    read = []
+
+    def texts():
+        for text in numbered_texts(100):
+            read.append(text)
+            yield text
+
+    finished = []
+
+    def on_batch(batch, _):
+        # The finished batches, two in flight and one being formed at most
+        finished.append(batch)
+        assert len(read) <= (len(finished) + 2) * 10
+
+    embed_in_batches(FlakyEmbeddings(), texts(), batch_size=10, max_workers=2, on_batch=on_batch)
+    assert len(read) == 100
+
+
+def test_rate_limited_batches_are_retried(no_backoff):
+    model = FlakyEmbeddings(fail_texts=["chunk 7"], fail_times=2)
+    texts = numbered_texts(20)
+    assert embed_in_batches(model, texts, batch_size=5, max_workers=2) == CountingEmbeddings().embed_documents(texts)
+    assert model.failures_left == 0
+
+
+def test_embedding_gives_up_after_the_retries(no_backoff):
+    model = FlakyEmbeddings(fail_texts=["chunk 7"], fail_times=10)
+    with pytest.raises(RateLimitError):
+        embed_in_batches(model, numbered_texts(20), batch_size=5, max_workers=2, max_retries=3)
+    assert model.failures_left == 6
+
+
+def test_other_errors_are_not_retried(no_backoff):
+    model = FlakyEmbeddings(fail_texts=["chunk 7"], fail_times=10, error=InvalidRequestError("Too long", None))
+    with pytest.raises(InvalidRequestError):
+        embed_in_batches(model, numbered_texts(20), batch_size=5, max_workers=2)
+    assert model.failures_left == 9
+
+
+def test_a_failed_document_resumes_from_the_cached_batches(tmp_path, no_backoff):
+    texts = numbered_texts(20)
+    model = FlakyEmbeddings(fail_texts=["chunk 19"], fail_times=10)
+    with pytest.raises(RateLimitError):
+        CachedEmbeddings(model, EmbeddingCache(str(tmp_path)), batch_size=5, max_workers=1).embed_chunks(texts)
+
+    model = FlakyEmbeddings()
+    progress = []
+    embeddings = CachedEmbeddings(model, EmbeddingCache(str(tmp_path)), batch_size=5, max_workers=1)
+    assert embeddings.embed_chunks(texts, lambda *args: progress.append(args))[1] == \
+        CountingEmbeddings().embed_documents(texts)
+    assert model.embedded_texts() == texts[15:]
+    assert progress == [(20, None), (20, 20)]
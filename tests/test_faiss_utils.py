@@ -0,0 +1,191 @@
+import hashlib
+import os
+import threading
+
+import faiss
+import numpy as np
+import pytest
+
+import faiss_utils
+from faiss_utils import (CURRENT_FILE, FAISS_PQ_MIN_VECTORS, FAISS_STALE_SECONDS, PUBLISHED_FILE, FaissIndexStore,
+                         build_index, build_vector_store, choose_index_type)
+
+DIMENSIONS = 8
+
+
+class HashEmbeddings:
+    """Embeds a text as a random vector seeded by the text, the same every time."""
+
+    def embed_query(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(DIMENSIONS).astype(np.float32).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+
+def make_vector_store(texts):
+    embeddings = HashEmbeddings()
+    return build_vector_store(texts, embeddings.embed_documents(texts), embeddings, "flat")
+
+
+TEXTS = ["Ottawa is the capital of Canada.", "Canada has about 38 million people.", "Maple syrup is sweet."]
+
+
+def test_saved_indexes_load_with_their_documents(tmp_path):
+    store = FaissIndexStore(str(tmp_path))
+    docsearch = make_vector_store(TEXTS)
+    store.save("canada", docsearch)
+
+    loaded = FaissIndexStore(str(tmp_path)).load("canada", HashEmbeddings())
+    assert loaded.fingerprint == docsearch.fingerprint
+    for text in TEXTS:
+        assert loaded.similarity_search(text, k=1)[0].page_content == text
+    assert store.names() == ["canada"]
+
+
+def test_unknown_and_invalid_names(tmp_path):
+    store = FaissIndexStore(str(tmp_path))
+    assert store.load("missing", HashEmbeddings()) is None
+    for name in ["", "../etc", "a/b", ".hidden"]:
+        with pytest.raises(ValueError):
+            store.save(name, make_vector_store(TEXTS))
+
+
+def test_saving_again_replaces_the_index_and_keeps_the_previous_version(tmp_path):
+    store = FaissIndexStore(str(tmp_path))
+    versions = [store.save("canada", make_vector_store(TEXTS[:i + 1])) for i in range(3)]
+
+    assert store.load("canada", HashEmbeddings()).index.ntotal == 3
+    directory = os.path.join(str(tmp_path), "canada")
+    with open(os.path.join(directory, CURRENT_FILE)) as f:
+        assert f.read() == versions[2]
+    # The previous version is kept for loaders that read CURRENT just before the switch
+    assert sorted(name for name in os.listdir(directory) if name[0].isdigit()) == versions[1:]
+
+
+def test_saves_leave_other_saves_unpublished_versions_alone(tmp_path):
+    store = FaissIndexStore(str(tmp_path))
+    store.save("canada", make_vector_store(TEXTS))
+    directory = os.path.join(str(tmp_path), "canada")
+    # Another save still writing its version, and one left over from a save that crashed
+    os.makedirs(os.path.join(directory, "1-writing"))
+    os.makedirs(os.path.join(directory, "0-crashed"))
+    stale_time = os.stat(directory).st_mtime - FAISS_STALE_SECONDS - 1
+    os.utime(os.path.join(directory, "0-crashed"), (stale_time, stale_time))
+
+    store.save("canada", make_vector_store(TEXTS))
+    store.save("canada", make_vector_store(TEXTS))
+    names = os.listdir(directory)
+    assert "1-writing" in names
+    assert "0-crashed" not in names
+    assert not os.path.exists(os.path.join(directory, "1-writing", PUBLISHED_FILE))
+
+
+def test_loads_while_saving(tmp_path):
+    store = FaissIndexStore(str(tmp_path))
+    store.save("canada", make_vector_store(TEXTS))
+    errors, stop = [], threading.Event()
+
+    def save():
+        try:
+            for _ in range(10):
+                store.save("canada", make_vector_store(TEXTS))
+        except Exception as error:
+            errors.append(error)
+
+    def load():
+        loader = FaissIndexStore(str(tmp_path))
+        try:
+            while not stop.is_set():
+                docsearch = loader.load("canada", HashEmbeddings())
+                assert docsearch.similarity_search(TEXTS[0], k=1)[0].page_content == TEXTS[0]
+        except Exception as error:
+            errors.append(error)
+
+    loaders = [threading.Thread(target=load) for _ in range(2)]
+    savers = [threading.Thread(target=save) for _ in range(3)]
+    for thread in loaders + savers:
+        thread.start()
+    for thread in savers:
+        thread.join()
+    stop.set()
+    for thread in loaders:
+        thread.join()
+    assert errors == []
+
+
+def random_vectors(num_vectors, dimensions=64):
+    return np.random.default_rng(0).standard_normal((num_vectors, dimensions)).astype(np.float32)
+
+
+@pytest.mark.parametrize("index_type, num_vectors, expected", [
+    ("ivfpq", 100, "ivf"),
+    ("ivfpq", FAISS_PQ_MIN_VECTORS - 1, "ivf"),
+    ("ivfpq", FAISS_PQ_MIN_VECTORS, "ivfpq"),
+    ("ivfpq", 10, "flat"),
+    ("ivf", 10, "flat"),
+    ("ivf", 100, "ivf"),
+    ("hnsw", 10, "hnsw"),
+    ("flat", 10, "flat"),
+])
+def test_forced_types_fall_back_below_their_training_minimum(index_type, num_vectors, expected):
+    assert choose_index_type(num_vectors, index_type) == expected
+
+
+def test_auto_chooses_by_size():
+    assert choose_index_type(100) == "flat"
+    assert choose_index_type(10 ** 6 + 1) == "ivf"
+
+
+@pytest.mark.parametrize("index_type, expected_class", [
+    ("ivfpq", faiss.IndexIVFFlat),
+    ("ivf", faiss.IndexIVFFlat),
+    ("hnsw", faiss.IndexHNSWFlat),
+    ("flat", faiss.IndexFlatL2),
+    ("auto", faiss.IndexFlatL2),
+])
+def test_build_index_on_a_small_corpus(index_type, expected_class):
+    vectors = random_vectors(100)
+    index = build_index(vectors, index_type)
+    assert isinstance(index, expected_class)
+    assert index.ntotal == 100
+    _, ids = index.search(vectors[:5], 1)
+    assert ids[:, 0].tolist() == list(range(5))
+
+
+def test_build_index_on_a_tiny_corpus():
+    vectors = random_vectors(3)
+    index = build_index(vectors, "ivfpq")
+    assert isinstance(index, faiss.IndexFlatL2)
+    assert index.ntotal == 3
+
+
+def test_build_index_rejects_unknown_types():
+    with pytest.raises(ValueError):
+        build_index(random_vectors(10), "lsh")
+
+
+@pytest.mark.parametrize("index_type", ["hnsw", "ivf"])
+def test_approximate_indexes_find_most_nearest_neighbors(index_type):
+    vectors = random_vectors(5000)
+    queries = np.random.default_rng(1).standard_normal((50, 64)).astype(np.float32)
+    exact = faiss.IndexFlatL2(64)
+    exact.add(vectors)
+    _, expected = exact.search(queries, 4)
+    _, found = build_index(vectors, index_type).search(queries, 4)
+    recall = np.mean([len(set(e) & set(f)) / 4 for e, f in zip(expected, found)])
+    # Random vectors are the hardest case, there are no clusters of similar chunks
+    assert recall >= 0.8
+
+
+def test_saved_approximate_indexes_load_with_their_search_params(tmp_path, monkeypatch):
+    texts = [f"chunk {i}" for i in range(200)]
+    embeddings = HashEmbeddings()
+    store = FaissIndexStore(str(tmp_path))
+    store.save("chunks", build_vector_store(texts, embeddings.embed_documents(texts), embeddings, "ivf"))
+    monkeypatch.setattr(faiss_utils, "FAISS_IVF_NPROBE", 7)
+
+    loaded = store.load("chunks", embeddings)
+    assert faiss.extract_index_ivf(loaded.index).nprobe == 7
+    assert loaded.similarity_search("chunk 42", k=1)[0].page_content == "chunk 42"
@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+import pytest
+
+import http_utils
+from http_utils import HTTP_RETRY_AFTER_MAX_SECONDS, close_async_session, fetch_json, get_session
+
+OK_RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 12\r\n\r\n{"ok": true}'
+
+
+def busy_response(retry_after):
+    return (b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n"
+            b"Retry-After: " + str(retry_after).encode() + b"\r\n\r\n")
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(http_utils, "HTTP_RETRY_BACKOFF_SECONDS", 0)
+
+
+def serve_async(responses, method="GET"):
+    """Serve responses, raw HTTP responses or None to close the connection without one, to
+    requests made with fetch_json, and return the JSON of the last and the number of requests.
+    """
+    requests_made = []
+
+    async def handle(reader, writer):
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                # The client closed the connection
+                return
+            lengths = [int(line.split(b":")[1]) for line in head.lower().split(b"\r\n")
+                       if line.startswith(b"content-length:")]
+            await reader.readexactly(lengths[0] if lengths else 0)
+            requests_made.append(head)
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+            if response is None:
+                writer.close()
+                return
+            writer.write(response)
+            await writer.drain()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/"
+        try:
+            return await fetch_json(method, url, json={"text": "hello"})
+        finally:
+            await close_async_session()
+            server.close()
+
+    try:
+        return asyncio.run(main()), len(requests_made)
+    except aiohttp.ClientError as e:
+        e.num_requests = len(requests_made)
+        raise
+
+
+def test_fetch_json_retries_busy_responses():
+    assert serve_async([busy_response(0), busy_response(0), OK_RESPONSE], "POST") == ({"ok": True}, 3)
+
+
+def test_fetch_json_retries_idempotent_requests_whose_connection_was_closed():
+    assert serve_async([None, OK_RESPONSE], "GET") == ({"ok": True}, 2)
+
+
+def test_fetch_json_doesnt_retry_other_requests_whose_connection_was_closed():
+    with pytest.raises(aiohttp.ServerDisconnectedError) as error:
+        serve_async([None, OK_RESPONSE], "POST")
+    assert error.value.num_requests == 1
+
+
+def test_fetch_json_gives_up_when_asked_to_retry_after_too_long():
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        serve_async([busy_response(int(HTTP_RETRY_AFTER_MAX_SECONDS) + 1), OK_RESPONSE], "POST")
+    assert error.value.status == 503
+    assert error.value.num_requests == 1
+
+
+def test_fetch_json_raises_after_the_retries():
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        serve_async([busy_response(0)], "POST")
+    assert error.value.num_requests == http_utils.HTTP_MAX_RETRIES + 1
+
+
+class BusyHandler(BaseHTTPRequestHandler):
+    """Turns away the requests to /busy/<seconds> with a 503 asking to retry after that long,
+    every other request to it, and answers the others.
+    """
+    protocol_version = "HTTP/1.1"
+    num_requests = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        BusyHandler.num_requests += 1
+        if self.path.startswith("/busy/") and BusyHandler.num_requests % 2 == 1:
+            self.send_response(503)
+            self.send_header("Retry-After", self.path.split("/")[-1])
+            body = b""
+        else:
+            self.send_response(200)
+            body = b'{"ok": true}'
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def busy_server():
+    BusyHandler.num_requests = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BusyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_session_retries_busy_responses(busy_server):
+    response = get_session().post(busy_server + "/busy/0", json={"text": "hello"})
+    assert response.json() == {"ok": True}
+    assert BusyHandler.num_requests == 2
+
+
+def test_session_gives_up_when_asked_to_retry_after_too_long(busy_server):
+    # As when the retries run out, the busy response is returned
+    start = time.monotonic()
+    url = busy_server + f"/busy/{int(HTTP_RETRY_AFTER_MAX_SECONDS) + 1}"
+    response = get_session().post(url, json={"text": "hello"})
+    assert response.status_code == 503
+    assert BusyHandler.num_requests == 1
+    assert time.monotonic() - start < HTTP_RETRY_AFTER_MAX_SECONDS
@@ -0,0 +1,32 @@
+import pytest
+
+from language_utils import is_in_language
+
+UKRAINIAN_TEXT = "Населення Канади становить близько 38 мільйонів. Її столиця Оттава."
+
+
+@pytest.mark.parametrize("text, language, expected", [
+    ("Население Канады составляет около 38 миллионов человек (2023).", "Russian", True),
+    ("About 38 million people live in Canada.", "Russian", False),
+    (UKRAINIAN_TEXT, "Russian", False),
+    (UKRAINIAN_TEXT, "Ukrainian", True),
+    ("Это ещё не всё.", "Ukrainian", False),
+    ("カナダの人口は約3800万人です。", "Japanese", True),
+    # Han characters without kana are more likely Chinese
+    ("加拿大人口约为3800万。", "Japanese", False),
+    ("加拿大人口约为3800万。", "Chinese (Mandarin)", True),
+    ("캐나다의 인구는 약 3800만 명입니다.", "Korean", True),
+    ("कनाडा की जनसंख्या लगभग 3.8 करोड़ है।", "Hindi", True),
+])
+def test_is_in_language_by_script(text, language, expected):
+    assert is_in_language(text, language) == expected
+
+
+def test_a_few_latin_letters_are_allowed():
+    assert is_in_language("Столица Канады — Оттава, население около 38 млн (по данным NASA).", "Russian")
+
+
+def test_latin_script_languages_and_text_without_letters_are_not_recognized():
+    assert not is_in_language("Le Canada compte environ 38 millions d'habitants.", "French")
+    assert not is_in_language("38 000 000", "Russian")
+    assert not is_in_language("", "Japanese")
@@ -0,0 +1,107 @@
+import threading
+
+import numpy as np
+import pytest
+
+from local_whisper_utils import (CHUNK_SECONDS, SAMPLE_RATE, VAD_SPEECH_PAD_SECONDS, LocalWhisperEngine,
+                                 speech_chunks)
+
+
+def make_audio(*parts):
+    """Return noise standing in for a recording of parts, (seconds, is_speech) pairs."""
+    rng = np.random.default_rng(0)
+    return np.concatenate([rng.standard_normal(int(seconds * SAMPLE_RATE)).astype(np.float32)
+                           * (0.1 if is_speech else 0.0005) for seconds, is_speech in parts])
+
+
+def seconds(chunks):
+    return [(start / SAMPLE_RATE, end / SAMPLE_RATE) for start, end in chunks]
+
+
+def test_silence_has_no_chunks():
+    assert speech_chunks(make_audio((5, False))) == []
+    assert speech_chunks(np.zeros(10, dtype=np.float32)) == []
+
+
+def test_speech_that_fits_is_one_padded_chunk():
+    chunks = seconds(speech_chunks(make_audio((2, False), (3, True), (1, False), (3, True), (2, False))))
+    assert len(chunks) == 1
+    (start, end), = chunks
+    assert abs(start - (2 - VAD_SPEECH_PAD_SECONDS)) < 0.05
+    assert abs(end - (9 + VAD_SPEECH_PAD_SECONDS)) < 0.05
+
+
+def test_speech_is_split_at_the_pauses_between_chunks():
+    audio = make_audio((1, False), (20, True), (5, False), (20, True), (1, False))
+    chunks = seconds(speech_chunks(audio))
+    assert len(chunks) == 2
+    assert chunks[0][1] < 21.5 and chunks[1][0] > 25.5
+    # The pause between them isn't decoded
+    assert all(end - start <= CHUNK_SECONDS for start, end in chunks)
+
+
+def test_long_speech_is_cut_at_its_quiet_moments():
+    # Speech with a short breath every 7 s, too short to end the speech
+    parts = []
+    for _ in range(10):
+        parts += [(6.9, True), (0.1, False)]
+    audio = make_audio(*parts)
+    chunks = speech_chunks(audio)
+
+    assert len(chunks) == 3
+    assert all(end - start <= CHUNK_SECONDS * SAMPLE_RATE for start, end in chunks)
+    # The chunks follow on from each other, and are cut in breaths
+    assert all(end == next_start for (_, end), (next_start, _) in zip(chunks, chunks[1:]))
+    for _, end in chunks[:-1]:
+        assert end / SAMPLE_RATE % 7 > 6.85
+
+
+def test_speech_without_pauses_is_found_in_a_noisy_recording():
+    # Background noise louder than the absolute threshold, but much quieter than the speech
+    rng = np.random.default_rng(0)
+    audio = rng.standard_normal(10 * SAMPLE_RATE).astype(np.float32) * 0.02
+    audio[SAMPLE_RATE:9 * SAMPLE_RATE] *= 5
+    (start, end), = seconds(speech_chunks(audio))
+    assert abs(start - (1 - VAD_SPEECH_PAD_SECONDS)) < 0.05
+    assert abs(end - (9 + VAD_SPEECH_PAD_SECONDS)) < 0.05
+
+
+class LengthEngine(LocalWhisperEngine):
+    """Transcribes a chunk as its length in seconds instead of with a Whisper model."""
+
+    def _decode(self, batch, language):
+        self.batches.append((len(batch), language))
+        for audio, _, future in batch:
+            future.set_result(f"{len(audio) / SAMPLE_RATE:.1f}")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+
+def test_chunks_of_concurrent_recordings_are_decoded_together():
+    engine = LengthEngine(batch_size=8, batch_wait_seconds=0.2)
+    audio = make_audio((1, False), (20, True), (5, False), (20, True), (1, False))
+    futures = []
+    threads = [threading.Thread(target=lambda: futures.append(engine.submit(audio, "en"))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for recording in futures:
+        assert [future.result(timeout=5) for future in recording] == ["20.4", "20.4"]
+    assert engine.batches == [(6, "en")]
+    num_samples = sum(end - start for start, end in speech_chunks(audio))
+    assert engine.metrics.get("audio_seconds") == pytest.approx(3 * num_samples / SAMPLE_RATE)
+
+
+def test_chunks_in_different_languages_are_decoded_apart_and_cancelled_ones_not_at_all():
+    engine = LengthEngine(batch_size=8, batch_wait_seconds=0.2)
+    audio = make_audio((3, True))
+    english = engine.submit(audio, "en")
+    english[0].cancel()
+    japanese = engine.submit(audio, "ja")
+    detected = engine.submit(audio)
+    assert japanese[0].result(timeout=5) == detected[0].result(timeout=5) == "3.0"
+    assert sorted(engine.batches, key=str) == [(1, "ja"), (1, None)]
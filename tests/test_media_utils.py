@@ -0,0 +1,56 @@
+import os
+import time
+
+from media_utils import MEDIA_URL_PATH, OUTPUT_FILE_PREFIX, MediaJanitor, media_url, new_output_path
+
+
+def write_file(path, num_bytes, age_seconds=0):
+    with open(path, "wb") as f:
+        f.write(b"\0" * num_bytes)
+    mtime = time.time() - age_seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_every_request_gets_its_own_output_file(tmp_path):
+    directory = str(tmp_path / "audios")
+    paths = {new_output_path(directory, ".mp3") for _ in range(100)}
+    assert len(paths) == 100
+    assert os.path.isdir(directory)
+    for path in paths:
+        assert os.path.dirname(path) == directory
+        assert os.path.basename(path).startswith(OUTPUT_FILE_PREFIX) and path.endswith(".mp3")
+
+
+def test_media_url_is_relative_to_the_served_directories(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = new_output_path("videos", ".mp4")
+    assert media_url(path) == MEDIA_URL_PATH + "videos/" + os.path.basename(path)
+
+
+def test_janitor_deletes_old_output_files_only(tmp_path):
+    write_file(tmp_path / "out_old.mp3", 10, age_seconds=120)
+    write_file(tmp_path / "out_new.mp3", 10)
+    # E.g. a placeholder used when building the UI
+    write_file(tmp_path / "tempfile.mp3", 10, age_seconds=120)
+
+    janitor = MediaJanitor([str(tmp_path), str(tmp_path / "missing")], max_age_seconds=60)
+    assert janitor.clean() == (1, 10)
+    assert sorted(os.listdir(tmp_path)) == ["out_new.mp3", "tempfile.mp3"]
+
+
+def test_janitor_deletes_the_oldest_files_past_the_size_limit(tmp_path):
+    for i in range(5):
+        write_file(tmp_path / f"out_{i}.mp3", 100, age_seconds=50 - i)
+
+    janitor = MediaJanitor([str(tmp_path)], max_age_seconds=60, max_bytes=250)
+    assert janitor.clean() == (3, 300)
+    assert sorted(os.listdir(tmp_path)) == ["out_3.mp3", "out_4.mp3"]
+
+
+def test_janitor_thread_stops_without_waiting_for_the_interval():
+    janitor = MediaJanitor([], interval_seconds=60)
+    janitor.start()
+    start = time.monotonic()
+    janitor.stop()
+    assert time.monotonic() - start < 5
+    assert janitor.thread is None
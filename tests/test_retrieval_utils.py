@@ -0,0 +1,168 @@
+from typing import List
+
+import numpy as np
+import pytest
+from langchain.chains.question_answering import load_qa_chain
+from langchain.llms.base import LLM
+
+import splitter_utils
+from faiss_utils import build_vector_store
+from retrieval_utils import AnswerCache, answer_question, retrieve_chunks
+
+QUESTION_VECTOR = [1.0, 0.0, 0.0]
+
+# Chunks with their vectors, the question's vector is QUESTION_VECTOR
+CHUNKS = {
+    "Ottawa is the capital of Canada.": [0.95, 0.312, 0.0],
+    "Ottawa is Canada's capital.": [0.94, 0.34, 0.0],
+    "Ottawa lies on the Ottawa River.": [0.85, 0.296, 0.436],
+    "Parliament sits in Ottawa.": [0.8, -0.2, 0.566],
+    "Maple syrup is sweet.": [0.0, 1.0, 0.0],
+}
+
+
+class QuestionEmbeddings:
+    """Embeds every question as QUESTION_VECTOR."""
+
+    def embed_query(self, text):
+        return QUESTION_VECTOR
+
+
+class RecordingLLM(LLM):
+    """Answers every prompt with its number, and remembers the prompts."""
+
+    prompts: List[str] = []
+
+    @property
+    def _llm_type(self):
+        return "recording"
+
+    def _call(self, prompt, stop=None, run_manager=None):
+        self.prompts.append(prompt)
+        return f"answer {len(self.prompts)}"
+
+    async def _acall(self, prompt, stop=None, run_manager=None):
+        return self._call(prompt, stop)
+
+    def get_num_tokens(self, text):
+        return len(text.split())
+
+
+@pytest.fixture(autouse=True)
+def count_words(monkeypatch):
+    monkeypatch.setattr(splitter_utils, "_count_tokens", lambda text: len(text.split()))
+
+
+def make_vector_store(chunks=CHUNKS):
+    return build_vector_store(list(chunks), list(chunks.values()), QuestionEmbeddings(), "flat")
+
+
+def test_retrieve_chunks_leaves_out_unrelated_chunks_and_duplicates():
+    docs = retrieve_chunks(make_vector_store(), QUESTION_VECTOR, lambda_mult=1)
+    assert [doc.page_content for doc in docs] == [
+        "Ottawa is the capital of Canada.", "Ottawa lies on the Ottawa River.", "Parliament sits in Ottawa."]
+
+
+def test_retrieve_chunks_prefers_chunks_unlike_the_ones_chosen():
+    # The river chunk is closer to the question, but also to the first chunk
+    docs = retrieve_chunks(make_vector_store(), QUESTION_VECTOR)
+    assert [doc.page_content for doc in docs] == [
+        "Ottawa is the capital of Canada.", "Parliament sits in Ottawa.", "Ottawa lies on the Ottawa River."]
+
+
+def test_retrieve_chunks_keeps_the_closest_chunk_if_none_is_similar_enough():
+    docs = retrieve_chunks(make_vector_store({"Maple syrup is sweet.": [0.0, 1.0, 0.0],
+                                              "Hockey is popular.": [0.3, 0.0, 0.95]}), QUESTION_VECTOR)
+    assert [doc.page_content for doc in docs] == ["Hockey is popular."]
+
+
+def test_answer_question_stuffs_the_chunks_that_fit():
+    llm = RecordingLLM()
+    answer = answer_question(load_qa_chain(llm, chain_type="stuff"), make_vector_store(), "What is the capital?",
+                             max_tokens=1000)
+    assert answer == "answer 1"
+    assert len(llm.prompts) == 1
+    assert "Ottawa lies on the Ottawa River." in llm.prompts[0]
+    assert "Maple syrup" not in llm.prompts[0]
+
+
+def test_answer_question_falls_back_to_map_reduce_when_the_chunks_dont_fit():
+    llm = RecordingLLM()
+    answer_question(load_qa_chain(llm, chain_type="stuff"), make_vector_store(), "What is the capital?",
+                    max_tokens=10)
+    # One question about each of the 3 relevant chunks, and one combining the answers
+    assert len(llm.prompts) == 4
+    assert "answer" in llm.prompts[-1]
+
+
+def test_answer_question_without_map_reduce_stuffs_the_most_relevant_chunks_that_fit():
+    llm = RecordingLLM()
+    answer_question(load_qa_chain(llm, chain_type="stuff"), make_vector_store(), "What is the capital?",
+                    max_tokens=10, map_reduce=False)
+    assert len(llm.prompts) == 1
+    assert "Ottawa is the capital of Canada." in llm.prompts[0]
+    assert "Ottawa lies on the Ottawa River." not in llm.prompts[0]
+
+
+def test_normalize_ignores_case_white_space_and_final_punctuation():
+    assert AnswerCache.normalize("  What is  the CAPITAL?! ") == "what is the capital"
+    assert AnswerCache.normalize("What is the capital.") == "what is the capital"
+
+
+def test_normalize_keeps_symbols_and_numbers():
+    assert AnswerCache.normalize("What is 2+2?") == "what is 2+2"
+    assert AnswerCache.normalize("What is 2+2?") != AnswerCache.normalize("What is 2-2?")
+    assert AnswerCache.normalize("Is C# faster?") != AnswerCache.normalize("Is C faster?")
+
+
+def test_exact_hit_after_normalizing():
+    cache = AnswerCache()
+    cache.put("doc", "What is the capital?", [1.0, 0.0], "Ottawa")
+    assert cache.get("doc", "what is the capital") == "Ottawa"
+    assert cache.get("other doc", "What is the capital?") is None
+
+
+def test_similar_hit_needs_the_same_numbers_and_symbols():
+    cache = AnswerCache(min_similarity=0.9)
+    cache.put("doc", "What is 2+2?", [1.0, 0.0], "4")
+    close_vector = np.array([0.99, 0.05])
+    assert cache.get("doc", "What's 2+2?", close_vector) == "4"
+    assert cache.get("doc", "What's 2-2?", close_vector) is None
+    assert cache.get("doc", "What's 3+3?", close_vector) is None
+
+
+def test_answers_expire():
+    cache = AnswerCache(ttl_seconds=0)
+    cache.put("doc", "What is the capital?", [1.0, 0.0], "Ottawa")
+    assert cache.get("doc", "What is the capital?", [1.0, 0.0]) is None
+    assert cache.metrics.get("expirations") == 1
+    assert cache.hit_ratio() == 0.0
+
+
+def test_least_recently_used_answers_are_evicted():
+    cache = AnswerCache(max_entries=2)
+    cache.put("doc", "First?", [1.0, 0.0], "1")
+    cache.put("doc", "Second?", [0.0, 1.0], "2")
+    assert cache.get("doc", "First?") == "1"
+    cache.put("doc", "Third?", [1.0, 1.0], "3")
+
+    assert cache.get("doc", "Second?") is None
+    assert cache.get("doc", "First?") == "1"
+    assert cache.get("doc", "Third?") == "3"
+    assert cache.metrics.get("evictions") == 1
+
+
+def test_answer_question_answers_again_from_the_cache():
+    llm = RecordingLLM()
+    qa_chain = load_qa_chain(llm, chain_type="stuff")
+    docsearch = make_vector_store()
+    cache = AnswerCache()
+    answer = answer_question(qa_chain, docsearch, "What is the capital?", cache=cache)
+
+    # The same question worded differently, its embedding is the same
+    assert answer_question(qa_chain, docsearch, "what's the capital", cache=cache) == answer
+    assert len(llm.prompts) == 1
+    assert cache.metrics.get("similar_hits") == 1
+    # A different document isn't answered from the cache
+    answer_question(qa_chain, make_vector_store(dict(list(CHUNKS.items())[:2])), "What is the capital?", cache=cache)
+    assert len(llm.prompts) == 2
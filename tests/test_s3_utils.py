@@ -0,0 +1,116 @@
+from urllib.parse import parse_qs, urlparse
+
+import boto3
+import pytest
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from s3_utils import AUDIO_LIFECYCLE_RULE_ID, AUDIO_UPLOAD_PREFIX, S3AudioStore, setup_lifecycle
+
+OTHER_RULE = {"ID": "expire-logs", "Status": "Enabled", "Filter": {"Prefix": "logs/"}, "Expiration": {"Days": 30}}
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeS3:
+    """Stands in for a boto3 S3 client, keeping uploads and the lifecycle configuration in memory.
+    URLs are presigned by a real client, which needs no request.
+    """
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None):
+        with open(path, "rb") as f:
+            self.objects[(bucket, key)] = (f.read(), ExtraArgs)
+
+    def generate_presigned_url(self, *args, **kwargs):
+        return self.signer.generate_presigned_url(*args, **kwargs)
+
+    def delete_object(self, Bucket, Key):
+        if self.error:
+            raise self.error
+        del self.objects[(Bucket, Key)]
+
+    def get_bucket_lifecycle_configuration(self, Bucket):
+        if self.error:
+            raise self.error
+        if self.rules is None:
+            raise client_error("NoSuchLifecycleConfiguration", "GetBucketLifecycleConfiguration")
+        return {"Rules": [dict(rule) for rule in self.rules]}
+
+    def put_bucket_lifecycle_configuration(self, Bucket, LifecycleConfiguration):
+        self.rules = LifecycleConfiguration["Rules"]
+        self.num_puts += 1
+
+    def __init__(self, rules=None, error=None):
+        self.objects = {}
+        self.rules = rules
+        self.error = error
+        self.num_puts = 0
+        self.signer = boto3.client("s3", region_name="us-east-1", aws_access_key_id="test",
+                                   aws_secret_access_key="test", config=Config(signature_version="s3v4"))
+
+
+def test_uploads_get_their_own_keys_and_presigned_urls(tmp_path):
+    path = tmp_path / "recording.mp3"
+    path.write_bytes(b"RIFF")
+    s3 = FakeS3()
+    store = S3AudioStore(s3, "bucket", url_expiry_seconds=600)
+
+    key, url = store.upload(str(path))
+    other_key, _ = store.upload(str(path))
+    assert key.startswith(AUDIO_UPLOAD_PREFIX) and key.endswith(".mp3")
+    assert key != other_key
+    assert s3.objects[("bucket", key)] == (b"RIFF", {"ContentType": "audio/mpeg"})
+    parsed = urlparse(url)
+    assert parsed.path.endswith("/" + key)
+    assert parse_qs(parsed.query)["X-Amz-Expires"] == ["600"]
+
+    store.delete(key)
+    assert ("bucket", key) not in s3.objects
+
+
+def test_failed_deletes_are_left_to_the_lifecycle_rule(capsys):
+    S3AudioStore(FakeS3(error=client_error("AccessDenied", "DeleteObject")), "bucket").delete("key")
+    assert "AccessDenied" in capsys.readouterr().out
+
+
+def test_setup_lifecycle_keeps_the_other_rules():
+    s3 = FakeS3(rules=[OTHER_RULE])
+    assert setup_lifecycle(s3, "bucket")
+    assert s3.rules[0] == OTHER_RULE
+    assert s3.rules[1]["ID"] == AUDIO_LIFECYCLE_RULE_ID
+    assert s3.rules[1]["Filter"] == {"Prefix": AUDIO_UPLOAD_PREFIX}
+
+    # Once the rule is there, the configuration isn't written again
+    assert not setup_lifecycle(s3, "bucket")
+    assert s3.num_puts == 1
+
+
+def test_setup_lifecycle_on_a_bucket_without_a_configuration():
+    s3 = FakeS3()
+    assert setup_lifecycle(s3, "bucket")
+    assert [rule["ID"] for rule in s3.rules] == [AUDIO_LIFECYCLE_RULE_ID]
+
+
+def test_setup_lifecycle_raises_other_errors():
+    with pytest.raises(ClientError):
+        setup_lifecycle(FakeS3(error=client_error("AccessDenied", "GetBucketLifecycleConfiguration")), "bucket")
+
+
+def test_check_lifecycle_only_reads_the_configuration(capsys):
+    s3 = FakeS3(rules=[OTHER_RULE])
+    assert not S3AudioStore(s3, "bucket").check_lifecycle()
+    assert "--setup-lifecycle bucket" in capsys.readouterr().out
+    assert s3.num_puts == 0
+
+    setup_lifecycle(s3, "bucket")
+    assert S3AudioStore(s3, "bucket").check_lifecycle()
+    s3.rules[1]["Status"] = "Disabled"
+    assert not S3AudioStore(s3, "bucket").check_lifecycle()
+
+
+def test_check_lifecycle_warns_if_it_cant_read_the_configuration(capsys):
+    s3 = FakeS3(error=client_error("AccessDenied", "GetBucketLifecycleConfiguration"))
+    assert not S3AudioStore(s3, "bucket").check_lifecycle()
+    assert "AccessDenied" in capsys.readouterr().out
@@ -0,0 +1,82 @@
+import random
+
+import pytest
+
+from splitter_utils import split_text
+
+
+def count_words(text):
+    # Unlike estimating tokens from characters, the counts of the pieces of a chunk add up to its count
+    return len(text.split())
+
+
+def make_document(num_paragraphs, seed=0):
+    rng = random.Random(seed)
+    words = ["Canada", "is", "a", "country", "in", "North", "America,", "with", "ten", "provinces", "and",
+             "three", "territories", "(Yukon,", "Nunavut", "and", "the", "Northwest", "Territories)"]
+    paragraphs = []
+    for _ in range(num_paragraphs):
+        sentences = [" ".join(rng.choice(words) for _ in range(rng.randint(3, 30))) + rng.choice([".", "!", "?", '."'])
+                     for _ in range(rng.randint(1, 8))]
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def chunk_spans(text, chunks):
+    # Where the chunks are in text, they are its substrings in order
+    spans = []
+    position = 0
+    for chunk in chunks:
+        start = text.index(chunk, position)
+        spans.append((start, start + len(chunk)))
+        position = start + 1
+    return spans
+
+
+def assert_covers(text, chunks):
+    covered = [False] * len(text)
+    for start, end in chunk_spans(text, chunks):
+        covered[start:end] = [True] * (end - start)
+    assert all(is_covered or char.isspace() for char, is_covered in zip(text, covered))
+
+
+@pytest.mark.parametrize("max_tokens, overlap_tokens", [(64, 16), (256, 32), (40, 0)])
+def test_chunks_cover_all_the_text_within_the_size(max_tokens, overlap_tokens):
+    text = make_document(50)
+    chunks = list(split_text(text, max_tokens, overlap_tokens, count_tokens=count_words))
+    assert len(chunks) > 5
+    assert_covers(text, chunks)
+    assert all(count_words(chunk) <= max_tokens for chunk in chunks)
+
+
+def test_chunks_end_at_sentence_boundaries_and_overlap():
+    text = make_document(50)
+    chunks = list(split_text(text, 64, 16, count_tokens=count_words))
+    assert all(chunk.endswith((".", "!", "?", '."')) for chunk in chunks)
+    spans = chunk_spans(text, chunks)
+    assert any(next_start < end for (_, end), (next_start, _) in zip(spans, spans[1:]))
+
+
+def test_long_sentences_and_words_are_split():
+    text = " ".join(f"word{i}" for i in range(100)) + " " + "x" * 50 + "."
+    chunks = list(split_text(text, 10, 2, count_tokens=count_words))
+    assert_covers(text, chunks)
+    assert all(count_words(chunk) <= 10 for chunk in chunks)
+    # Counting characters, the last word is longer than a chunk
+    assert list(split_text("x" * 25 + ".", 10, 0, count_tokens=len)) == ["x" * 10, "x" * 10, "x" * 5 + "."]
+
+
+def test_an_edit_only_changes_the_chunks_around_it():
+    text = make_document(50)
+    paragraphs = text.split("\n\n")
+    paragraphs[25] = "This paragraph was rewritten."
+    edited = "\n\n".join(paragraphs)
+
+    chunks = list(split_text(text, 64, 16, count_tokens=count_words))
+    edited_chunks = list(split_text(edited, 64, 16, count_tokens=count_words))
+    assert len(set(edited_chunks) - set(chunks)) <= 3
+
+
+def test_empty_text_has_no_chunks():
+    assert list(split_text("", count_tokens=count_words)) == []
+    assert list(split_text(" \n\n ", count_tokens=count_words)) == []
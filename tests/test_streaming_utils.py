@@ -0,0 +1,57 @@
+import queue
+import threading
+import uuid
+from concurrent.futures import Future
+
+from streaming_utils import AGENT_ANSWER_PREFIX, AnswerStreamHandler, iter_partial_results
+
+
+def stream(handler, tokens, run_id=None):
+    run_id = run_id or uuid.uuid4()
+    for token in tokens:
+        handler.on_llm_new_token(token, run_id=run_id)
+    handler.on_llm_end(None, run_id=run_id)
+
+
+def test_only_the_agent_answer_after_the_prefix_is_reported():
+    answers = []
+    handler = AnswerStreamHandler(answers.append, answer_prefix=AGENT_ANSWER_PREFIX)
+    # A tool step, then the final answer with its prefix split across tokens
+    stream(handler, ["Thought: Yes\n", "Action: Search"])
+    stream(handler, ["Thought: No\n", "A", "I: Hello", " there", "."])
+    assert answers == ["Hello", "Hello there", "Hello there."]
+    assert handler.outputs == {}
+
+
+def test_without_a_prefix_everything_is_reported():
+    answers = []
+    handler = AnswerStreamHandler(answers.append)
+    stream(handler, [" ", "Bonjour", " à tous"])
+    assert answers == ["Bonjour", "Bonjour à tous"]
+
+
+def test_concurrent_llm_calls_are_kept_apart():
+    answers = []
+    handler = AnswerStreamHandler(answers.append)
+    first, second = uuid.uuid4(), uuid.uuid4()
+    handler.on_llm_new_token("one", run_id=first)
+    handler.on_llm_new_token("two", run_id=second)
+    handler.on_llm_new_token(" more", run_id=first)
+    handler.on_llm_error(RuntimeError(), run_id=second)
+    assert answers == ["one", "two", "one more"]
+    assert list(handler.outputs) == [first]
+
+
+def test_iter_partial_results_yields_the_newest_value_until_done():
+    future, updates = Future(), queue.Queue()
+    for value in ["a", "ab", "abc"]:
+        updates.put(value)
+    results = iter_partial_results(future, updates, poll_interval=0.01)
+    # Values waiting together are coalesced into the newest one
+    assert next(results) == "abc"
+
+    # Waits for values that arrive later
+    threading.Timer(0.05, updates.put, args=("abcd",)).start()
+    assert next(results) == "abcd"
+    future.set_result(None)
+    assert list(results) == []
@@ -0,0 +1,57 @@
+import threading
+
+from langchain.agents import AgentType, Tool, initialize_agent
+from langchain.llms.fake import FakeListLLM
+
+from trace_utils import ACTION_EVENT, FINISH_EVENT, OBSERVATION_EVENT, TraceCallbackHandler, format_trace
+
+
+def make_agent(search=lambda query: "38 million"):
+    tool = Tool(name="Search", func=search, description="Looks things up")
+    llm = FakeListLLM(responses=[
+        "Thought: I should look this up\nAction: Search\nAction Input: population of Canada",
+        "Thought: I now know the final answer\nFinal Answer: About 38 million.",
+    ])
+    return initialize_agent([tool], llm, agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION)
+
+
+def test_handler_collects_the_trace_of_a_run():
+    events = []
+    handler = TraceCallbackHandler(on_event=events.append)
+    output = make_agent().run("How many people live in Canada?", callbacks=[handler])
+
+    assert output == "About 38 million."
+    assert [event.kind for event in handler.events] == [ACTION_EVENT, OBSERVATION_EVENT, FINISH_EVENT]
+    assert events == handler.events
+    action = handler.events[0]
+    assert (action.tool, action.tool_input) == ("Search", "population of Canada")
+    assert handler.get_text() == (
+        "Thought: I should look this up\nAction: Search\nAction Input: population of Canada"
+        "\nObservation: 38 million\nThought:"
+        "Thought: I now know the final answer\nFinal Answer: About 38 million.\n")
+
+
+def test_handler_leaves_out_what_other_threads_print(capsys):
+    def search(query):
+        # Another session's turn prints while this one runs
+        printer = threading.Thread(target=print, args=("Thought: another session's trace",))
+        printer.start()
+        printer.join()
+        return "38 million"
+
+    handler = TraceCallbackHandler()
+    make_agent(search).run("How many people live in Canada?", callbacks=[handler])
+    assert "another session" in capsys.readouterr().out
+    assert "another session" not in handler.get_text()
+
+
+def test_format_trace_puts_a_blank_line_before_each_keyword():
+    trace = ("Thought: Do I need to use a tool? Yes\nAction: Search\nAction Input: Canada"
+             "\nObservation: 38 million\nThought: Do I need to use a tool? No\nAI: About 38 million.\n")
+    assert format_trace(trace) == (
+        "\n\nThought: Do I need to use a tool? Yes\n\n\nAction: Search\nAction \n\nInput: Canada"
+        "\n\n\nObservation: 38 million\n\n\nThought: Do I need to use a tool? No\n\n\nAI: About 38 million.\n")
+
+
+def test_format_trace_keeps_text_without_keywords():
+    assert format_trace("\x1b[1mno keywords here\x1b[0m") == "\x1b[1mno keywords here\x1b[0m"
@@ -0,0 +1,249 @@
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import tts_utils
+from tts_utils import (PipelinedSpeaker, SpeechStreams, TTSCache, split_sentences, split_text_for_speech,
+                       start_speech_warmup, synthesize_speech, warm_up_speech)
+
+
+class FakeAudioStream:
+    """Stands in for the StreamingBody of a Polly response."""
+
+    def iter_chunks(self, chunk_size):
+        for start in range(0, len(self.audio), chunk_size):
+            yield self.audio[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+    def __init__(self, audio):
+        self.audio = audio
+        self.closed = False
+
+
+class FakePollyClient:
+    """Stands in for the shared Polly client, the audio of a text is the text."""
+
+    def synthesize_speech(self, **params):
+        self.requests.append(params)
+        stream = FakeAudioStream(params["Text"].encode("utf-8"))
+        self.streams.append(stream)
+        return {"AudioStream": stream}
+
+    def describe_voices(self, **params):
+        return {"Voices": []}
+
+    def __init__(self):
+        self.requests = []
+        self.streams = []
+
+
+@pytest.fixture
+def polly(monkeypatch):
+    client = FakePollyClient()
+    monkeypatch.setattr(tts_utils, "_polly_client", client)
+    return client
+
+
+def test_tts_cache_evicts_least_recently_used(tmp_path):
+    cache = TTSCache(str(tmp_path), max_bytes=3 * 1024)
+    for text in ["one", "two", "three"]:
+        cache.put(text, "Matthew", "en-US", "neural", b"\0" * 1024)
+    # Using "one" makes "two" the least recently used
+    assert cache.get("one", "Matthew", "en-US", "neural") is not None
+    cache.put("four", "Matthew", "en-US", "neural", b"\0" * 1024)
+
+    assert cache.get("two", "Matthew", "en-US", "neural") is None
+    for text in ["one", "three", "four"]:
+        path = cache.get(text, "Matthew", "en-US", "neural")
+        with open(path, "rb") as f:
+            assert len(f.read()) == 1024
+    assert cache.size == 3 * 1024
+    assert len(os.listdir(tmp_path)) == 3
+    assert cache.metrics.get("evictions") == 1
+
+
+def test_tts_cache_skips_audio_larger_than_the_cache(tmp_path):
+    cache = TTSCache(str(tmp_path), max_bytes=1024)
+    assert cache.put("long", "Matthew", "en-US", "neural", b"\0" * 2048) is None
+    assert cache.get("long", "Matthew", "en-US", "neural") is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_tts_cache_reloads_in_least_recently_used_order(tmp_path):
+    cache = TTSCache(str(tmp_path), max_bytes=2 * 1024)
+    for i, text in enumerate(["old", "new"]):
+        path = cache.put(text, "Matthew", "en-US", "neural", b"\0" * 1024)
+        os.utime(path, (1000 + i, 1000 + i))
+
+    reloaded = TTSCache(str(tmp_path), max_bytes=1024)
+    assert reloaded.get("old", "Matthew", "en-US", "neural") is None
+    assert reloaded.get("new", "Matthew", "en-US", "neural") is not None
+
+
+def test_tts_cache_keys_on_everything_that_determines_the_audio():
+    keys = {TTSCache.key("Hello", "Matthew", "en-US", "neural"),
+            TTSCache.key("Hello", "Joanna", "en-US", "neural"),
+            TTSCache.key("Hello", "Matthew", "en-GB", "neural"),
+            TTSCache.key("Hello", "Matthew", "en-US", "standard"),
+            TTSCache.key("Hello ", "Matthew", "en-US", "neural")}
+    assert len(keys) == 5
+
+
+def test_repeated_phrases_are_played_from_the_cache(tmp_path, polly):
+    cache = TTSCache(str(tmp_path))
+    for _ in range(3):
+        assert synthesize_speech("Hello there.", "Matthew", "en-US", "neural", cache) == b"Hello there."
+    assert len(polly.requests) == 1
+    assert cache.metrics.get("hits") == 2
+
+
+def test_all_threads_share_one_polly_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(tts_utils, "_polly_client", None)
+    with ThreadPoolExecutor(8) as executor:
+        clients = list(executor.map(lambda _: tts_utils.get_polly_client(), range(32)))
+    assert all(client is clients[0] for client in clients)
+    assert clients[0].meta.config.max_pool_connections == tts_utils.POLLY_MAX_POOL_CONNECTIONS
+
+
+LONG_REPLY = ("Canada is a country in North America. Its ten provinces and three territories extend from "
+              "the Atlantic Ocean to the Pacific Ocean and northward into the Arctic Ocean! It is the world's "
+              "second-largest country by total area... Its southern and western border with the United States "
+              "is the world's longest binational land border.\nIts capital is Ottawa, and its three largest "
+              "metropolitan areas are Toronto, Montreal and Vancouver? " * 5)
+
+
+def test_split_text_for_speech_covers_all_the_text():
+    chunks = split_text_for_speech(LONG_REPLY, first_chunk_chars=60, max_chars=300)
+    assert " ".join(chunks).split() == LONG_REPLY.split()
+    assert len(chunks[0]) <= 60
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    # Chunks end at sentence boundaries
+    assert all(chunk.endswith((".", "!", "?")) for chunk in chunks)
+
+
+def test_split_text_for_speech_splits_sentences_longer_than_a_chunk():
+    sentence = " ".join(["word"] * 100) + "."
+    text = sentence + " " + "x" * 50
+    chunks = split_text_for_speech(text, first_chunk_chars=20, max_chars=40)
+    assert "".join(chunks).replace(" ", "") == text.replace(" ", "")
+    assert all(len(chunk) <= 40 for chunk in chunks)
+    # A word longer than a chunk is cut
+    assert split_text_for_speech("x" * 50, first_chunk_chars=40, max_chars=40) == ["x" * 40, "x" * 10]
+
+
+def test_split_sentences_at_cjk_full_stops():
+    assert split_sentences("カナダの首都はオタワです。人口は約3800万人です！本当？") == [
+        "カナダの首都はオタワです。", "人口は約3800万人です！", "本当？"]
+
+
+def test_pipelined_speaker_yields_the_chunks_in_order():
+    text = LONG_REPLY * 4
+    chunks = split_text_for_speech(text)
+    assert len(chunks) > 3
+    positions = {chunk: i for i, chunk in enumerate(chunks)}
+    in_flight, max_in_flight, lock = [0], [0], threading.Lock()
+
+    def open_speech(text, voice_id, language_code, engine):
+        with lock:
+            in_flight[0] += 1
+            max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+        # Earlier chunks take longer, so later ones are ready first
+        time.sleep(0.05 / (1 + positions[text]))
+        with lock:
+            in_flight[0] -= 1
+        return iter([text.encode("utf-8")])
+
+    speaker = PipelinedSpeaker(open_speech, max_in_flight=3, max_workers=8)
+    assert list(speaker.iter_audio(text, "Matthew", "en-US", "neural")) == [
+        chunk.encode("utf-8") for chunk in chunks]
+    assert max_in_flight[0] <= 3
+
+
+def test_pipelined_speaker_releases_audio_that_wont_be_played(polly):
+    speaker = PipelinedSpeaker(functools.partial(tts_utils.open_speech, cache=None), max_in_flight=3)
+    audio = speaker.iter_audio(LONG_REPLY * 4, "Matthew", "en-US", "neural")
+    next(audio)
+    # The listener went away after the first block
+    audio.close()
+    speaker.executor.shutdown(wait=True)
+    assert 1 < len(polly.streams) <= 4
+    assert all(stream.closed for stream in polly.streams)
+
+
+def test_speech_streams_open_registered_replies_until_they_expire(polly, tmp_path):
+    cache = TTSCache(str(tmp_path))
+    streams = SpeechStreams(PipelinedSpeaker(functools.partial(tts_utils.open_speech, cache=cache)),
+                            ttl_seconds=0.2)
+    stream_id = streams.register("Hello there.", "Matthew", "en-US", "neural")
+    # Nothing is synthesized until the audio is requested
+    assert polly.requests == []
+    assert streams.open("unknown") is None
+    for _ in range(2):
+        assert b"".join(streams.open(stream_id)) == b"Hello there."
+    # Requested again from the cache
+    assert len(polly.requests) == 1
+
+    time.sleep(0.3)
+    assert streams.open(stream_id) is None
+    streams.register("Bye.", "Matthew", "en-US", "neural")
+    assert stream_id not in streams.entries
+
+
+def test_audio_is_streamed_in_blocks_and_only_cached_once_complete(polly, tmp_path, monkeypatch):
+    monkeypatch.setattr(tts_utils, "AUDIO_STREAM_BLOCK_BYTES", 4)
+    cache = TTSCache(str(tmp_path))
+    audio = tts_utils.open_speech("Hello there.", "Matthew", "en-US", "neural", cache=cache)
+    assert next(audio) == b"Hell"
+    # The listener went away before the end
+    audio.close()
+    assert polly.streams[0].closed
+    assert cache.get("Hello there.", "Matthew", "en-US", "neural") is None
+
+    audio = tts_utils.open_speech("Hello there.", "Matthew", "en-US", "neural", cache=cache)
+    assert list(audio) == [b"Hell", b"o th", b"ere."]
+    assert cache.get("Hello there.", "Matthew", "en-US", "neural") is not None
+
+
+def test_closing_audio_blocks_releases_the_source_even_if_never_read(polly):
+    audio = tts_utils.open_speech("Hello there.", "Matthew", "en-US", "neural")
+    audio.close()
+    assert polly.streams[0].closed
+
+
+def test_warmup_fills_the_cache_with_the_phrases(polly, tmp_path):
+    cache = TTSCache(str(tmp_path))
+    voice_phrases = [(("Matthew", "en-US", "neural"), ["Hello.", "What's on your mind?"]),
+                     (("Tatyana", "ru-RU", "standard"), ["Что у вас на уме?"])]
+    thread = start_speech_warmup(voice_phrases, cache)
+    assert thread.daemon
+    thread.join(5)
+
+    assert cache.get("What's on your mind?", "Matthew", "en-US", "neural") is not None
+    assert cache.get("Что у вас на уме?", "Tatyana", "ru-RU", "standard") is not None
+    assert len(polly.requests) == 3
+
+
+def test_warmup_goes_on_after_failures(polly, tmp_path, monkeypatch):
+    def fail(**params):
+        raise RuntimeError("AccessDenied")
+
+    monkeypatch.setattr(polly, "describe_voices", fail)
+    cache = TTSCache(str(tmp_path))
+
+    def open_speech(text, voice_id, language_code, engine, cache=None):
+        if text == "Hello.":
+            raise RuntimeError("Throttled")
+        return tts_utils.open_speech(text, voice_id, language_code, engine, cache)
+
+    answered = warm_up_speech([(("Matthew", "en-US", "neural"), ["Hello.", "Bye."])], cache, open_speech)
+    assert not answered
+    assert cache.get("Bye.", "Matthew", "en-US", "neural") is not None
@@ -0,0 +1,109 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from azure_utils import AzureVoiceData, load_azure_voices
+from polly_utils import NEURAL_ENGINE, STANDARD_ENGINE, PollyVoiceData, load_polly_voices
+
+# The voice records as they were hardcoded in PollyVoiceData and AzureVoiceData
+with open(os.path.join(os.path.dirname(__file__), "data", "hardcoded_voices.json"), encoding="utf-8") as f:
+    HARDCODED_VOICES = json.load(f)
+HARDCODED_POLLY_VOICES = HARDCODED_VOICES["polly_voices"]
+# Except for a stray quote in one voice name, which was fixed when the catalogs moved to CSV
+HARDCODED_AZURE_VOICES = [{**voice, "azure_voice": voice["azure_voice"].rstrip('"')}
+                          for voice in HARDCODED_VOICES["azure_voices"]]
+
+LANGUAGES = sorted({voice["language"] for voice in HARDCODED_POLLY_VOICES + HARDCODED_AZURE_VOICES}) + ["Foo"]
+GENDERS = ["Female", "Male", "Female (child)", "Male (child)", "Other"]
+
+
+def scan_polly_voice(language, gender):
+    # The linear scan PollyVoiceData.get_voice used to do
+    for voice in HARDCODED_POLLY_VOICES:
+        if voice["language"] == language and voice["gender"] == gender and voice["neural"] == "Yes":
+            return voice["voice_id"], voice["lang_code"], NEURAL_ENGINE
+    for voice in HARDCODED_POLLY_VOICES:
+        if voice["language"] == language and voice["gender"] == gender and voice["standard"] == "Yes":
+            return voice["voice_id"], voice["lang_code"], STANDARD_ENGINE
+    return None, None, None
+
+
+def scan_whisper_lang_code(language):
+    for voice in HARDCODED_POLLY_VOICES:
+        if voice["language"] == language:
+            return voice["whisper_lang_code"]
+    return "en"
+
+
+def scan_azure_voice(language, gender):
+    for voice in HARDCODED_AZURE_VOICES:
+        if voice["language"] == language and voice["gender"] == gender:
+            return voice["azure_voice"]
+    return None
+
+
+@pytest.mark.parametrize("language", LANGUAGES)
+def test_indexed_lookups_match_scanning_the_voices(language):
+    polly_voice_data, azure_voice_data = PollyVoiceData(), AzureVoiceData()
+    for gender in GENDERS:
+        assert polly_voice_data.get_voice(language, gender) == scan_polly_voice(language, gender)
+        assert azure_voice_data.get_voice(language, gender) == scan_azure_voice(language, gender)
+    assert polly_voice_data.get_whisper_lang_code(language) == scan_whisper_lang_code(language)
+
+
+def test_voice_tables_are_shared_by_all_instances():
+    with ThreadPoolExecutor(8) as executor:
+        tables = list(executor.map(lambda _: PollyVoiceData().voice_data, range(32)))
+    assert all(table is tables[0] for table in tables)
+    assert AzureVoiceData().voice_data is AzureVoiceData().voice_data
+
+
+def test_polly_catalog_holds_the_hardcoded_voices():
+    flags = {True: "Yes", False: "No"}
+    voices = [{"language": voice.language, "lang_code": voice.lang_code,
+               "whisper_lang_code": voice.whisper_lang_code, "voice_id": voice.voice_id,
+               "gender": voice.gender, "neural": flags[voice.neural], "standard": flags[voice.standard]}
+              for voice in load_polly_voices()]
+    assert voices == HARDCODED_POLLY_VOICES
+
+
+def test_azure_catalog_holds_the_hardcoded_voices():
+    voices = [{"language": voice.language, "azure_voice": voice.azure_voice, "gender": voice.gender}
+              for voice in load_azure_voices()]
+    assert voices == HARDCODED_AZURE_VOICES
+
+
+POLLY_HEADER = "language,lang_code,whisper_lang_code,voice_id,gender,neural,standard\n"
+POLLY_ROW = "French,fr-FR,fr,Lea,Female,Yes,Yes\n"
+
+
+@pytest.mark.parametrize("contents, error", [
+    ("language,voice_id\n" + POLLY_ROW, "expected columns"),
+    (POLLY_HEADER + "French,fr-FR,fr,Lea,Female,Yes\n", ":2: expected 7 columns"),
+    (POLLY_HEADER + POLLY_ROW + "French,fr-FR,fr,Remi,Other,Yes,No\n", ":3: unknown gender"),
+    (POLLY_HEADER + "French,fr-FR,fr,Lea,Female,yes,Yes\n", "must be Yes or No"),
+    (POLLY_HEADER + "French,fr-FR,fr,Lea,Female,No,No\n", "has no engine"),
+    (POLLY_HEADER + 'French,fr-FR,fr,"Lea""",Female,Yes,Yes\n', "bad voice_id"),
+    (POLLY_HEADER + "French,fr-FR,fr,Lea ,Female,Yes,Yes\n", "bad voice_id"),
+    (POLLY_HEADER + POLLY_ROW + POLLY_ROW, ":3: duplicate voice Lea"),
+])
+def test_bad_polly_catalogs_are_rejected_with_the_line(tmp_path, contents, error):
+    path = tmp_path / "polly_voices.csv"
+    path.write_text(contents, encoding="utf-8")
+    with pytest.raises(ValueError, match=error):
+        load_polly_voices(str(path))
+
+
+@pytest.mark.parametrize("contents, error", [
+    ("language,azure_voice,gender\nSpanish (US),es-US-AlonsoNeural\",Male\n", "bad azure_voice"),
+    ("language,azure_voice,gender\nFrench,fr-FR-HenriNeural,Other\n", "unknown gender"),
+    ("language,azure_voice,gender\nFrench,fr-FR-HenriNeural,Male\nFrench,fr-FR-AlainNeural,Male\n",
+     ":3: more than one voice"),
+])
+def test_bad_azure_catalogs_are_rejected_with_the_line(tmp_path, contents, error):
+    path = tmp_path / "azure_voices.csv"
+    path.write_text(contents, encoding="utf-8")
+    with pytest.raises(ValueError, match=error):
+        load_azure_voices(str(path))
@@ -0,0 +1,114 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import whisper_utils
+from http_utils import close_async_session
+from whisper_utils import RunPodWhisperClient, WhisperJobError, inline_audio, join_segments
+
+SEGMENTS = [{"text": " Hello,"}, {"text": " "}, {"text": " how are you?"}]
+
+
+class FakeEndpoint:
+    """Stands in for the RunPod endpoint: each status request gets the next of statuses, a
+    status string or an error status code, and the last one after that. Remembers the requests.
+    """
+
+    async def handle_run(self, request):
+        self.requests.append(("run", await request.json()))
+        return web.json_response({"id": "job1", "status": "IN_QUEUE"})
+
+    async def handle_status(self, request):
+        self.requests.append(("status", request.match_info["job_id"]))
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        if isinstance(status, int):
+            return web.json_response({"error": "nope"}, status=status)
+        if status == "COMPLETED":
+            return web.json_response({"id": "job1", "status": status, "output": {"segments": SEGMENTS}})
+        return web.json_response({"id": "job1", "status": status, "error": "out of memory"})
+
+    async def handle_cancel(self, request):
+        self.requests.append(("cancel", request.match_info["job_id"]))
+        return web.json_response({"id": "job1", "status": "CANCELLED"})
+
+    def request_kinds(self):
+        return [kind for kind, _ in self.requests]
+
+    async def run(self, client_coroutine, **client_options):
+        """Serve the endpoint while client_coroutine(client) runs, and return its result."""
+        app = web.Application()
+        app.add_routes([web.post("/run", self.handle_run), web.get("/status/{job_id}", self.handle_status),
+                        web.post("/cancel/{job_id}", self.handle_cancel)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        try:
+            return await client_coroutine(RunPodWhisperClient("test", url=url, **client_options))
+        finally:
+            await close_async_session()
+            await runner.cleanup()
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.requests = []
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(whisper_utils, "WHISPER_POLL_INITIAL_SECONDS", 0.01)
+    monkeypatch.setattr(whisper_utils, "WHISPER_POLL_MAX_SECONDS", 0.02)
+
+
+def transcribe(endpoint, **client_options):
+    return asyncio.run(endpoint.run(lambda client: client.transcribe({"audio": "clip.mp3"}, language="en"),
+                                    **client_options))
+
+
+def test_transcribe_polls_until_the_job_is_done():
+    endpoint = FakeEndpoint(["IN_QUEUE", "IN_PROGRESS", "COMPLETED"])
+    assert transcribe(endpoint) == "Hello, how are you?"
+    assert endpoint.requests[0] == ("run", {"input": {"audio": "clip.mp3", "language": "en"}})
+    assert endpoint.request_kinds() == ["run", "status", "status", "status"]
+
+
+def test_transient_status_errors_are_polled_through():
+    endpoint = FakeEndpoint([500, "IN_PROGRESS", 502, "COMPLETED"])
+    assert transcribe(endpoint) == "Hello, how are you?"
+    assert endpoint.request_kinds() == ["run"] + ["status"] * 4
+
+
+def test_a_job_that_takes_too_long_is_cancelled():
+    endpoint = FakeEndpoint(["IN_QUEUE"])
+    with pytest.raises(asyncio.TimeoutError):
+        transcribe(endpoint, timeout_seconds=0.2)
+    assert endpoint.requests[-1] == ("cancel", "job1")
+
+
+def test_a_rejected_key_fails_at_once():
+    endpoint = FakeEndpoint([401])
+    with pytest.raises(aiohttp.ClientResponseError) as error:
+        transcribe(endpoint)
+    assert error.value.status == 401
+    assert endpoint.request_kinds() == ["run", "status", "cancel"]
+
+
+def test_a_failed_job_raises():
+    endpoint = FakeEndpoint(["IN_PROGRESS", "FAILED"])
+    with pytest.raises(WhisperJobError, match="out of memory"):
+        transcribe(endpoint)
+
+
+def test_join_segments_falls_back_to_the_transcription():
+    assert join_segments({"segments": SEGMENTS}) == "Hello, how are you?"
+    assert join_segments({"segments": [], "transcription": " Hi. "}) == "Hi."
+
+
+def test_only_small_recordings_are_inlined(tmp_path):
+    path = tmp_path / "clip.mp3"
+    path.write_bytes(b"\0" * 10)
+    assert inline_audio(str(path)) == {"audio_base64": "AAAAAAAAAAAAAA=="}
+    assert inline_audio(str(path), max_bytes=9) is None
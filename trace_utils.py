@@ -0,0 +1,115 @@
+# This module captures the reasoning trace of an agent run (Thought/Action/Observation)
+# through a LangChain callback handler that belongs to a single invocation. Unlike
+# redirecting sys.stdout, this leaves output printed by other threads alone, so traced
+# runs of different sessions can execute in parallel.
+
+import re
+from collections import namedtuple
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+ACTION_EVENT = "action"
+OBSERVATION_EVENT = "observation"
+FINISH_EVENT = "finish"
+
+# kind is one of the *_EVENT constants, text is the trace text the event contributes.
+# tool and tool_input are only set for ACTION_EVENT.
+TraceEvent = namedtuple("TraceEvent", ["kind", "text", "tool", "tool_input"], defaults=[None, None])
+
+# A blank line is put in front of "Thought:", "Action:", "Observation:", "Input:" and "AI:".
+# Callback traces hold no colors or banners, only these keywords, and one literal pattern per
+# keyword finds them faster than a single alternation pattern does, see the benchmark below.
+_TRACE_KEYWORDS = ["Thought:", "Action:", "Observation:", "Input:", "AI:"]
+_TRACE_PATTERNS = [(re.compile(re.escape(keyword)), "\n\n" + keyword) for keyword in _TRACE_KEYWORDS]
+
+
+def format_trace(text):
+    """Format an agent trace for display in a chat bubble."""
+    for pattern, replacement in _TRACE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """Collect the agent trace of one chain.run call as a list of TraceEvent records.
+    Pass a new instance to every run, e.g. chain.run(input=inp, callbacks=[handler]).
+    If on_event is given, it is called with each TraceEvent as soon as it happens.
+    """
+
+    def __init__(self, on_event=None):
+        self.events = []
+        self.on_event = on_event
+
+    def on_agent_action(self, action, **kwargs):
+        # action.log holds the "Thought: ... Action: ... Action Input: ..." text the LLM produced
+        self._add(TraceEvent(ACTION_EVENT, action.log, action.tool, action.tool_input))
+
+    def on_tool_end(self, output, observation_prefix=None, llm_prefix=None, **kwargs):
+        text = ""
+        if observation_prefix:
+            text += "\n" + observation_prefix
+        text += output
+        if llm_prefix:
+            text += "\n" + llm_prefix
+        self._add(TraceEvent(OBSERVATION_EVENT, text))
+
+    def on_agent_finish(self, finish, **kwargs):
+        self._add(TraceEvent(FINISH_EVENT, finish.log + "\n"))
+
+    def get_text(self):
+        """Return the trace as the agent's verbose output would print it, without colors
+        and without the chain start/end banners.
+        """
+        return "".join(event.text for event in self.events)
+
+    def _add(self, event):
+        self.events.append(event)
+        if self.on_event:
+            self.on_event(event)
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import random
+    import time
+
+    from langchain.schema import AgentAction, AgentFinish
+
+    alternation = re.compile("|".join(re.escape(keyword) for keyword in _TRACE_KEYWORDS))
+
+    def single_pass_format_trace(text):
+        # All keywords found by one alternation pattern in a single scan
+        return alternation.sub(lambda match: "\n\n" + match.group(0), text)
+
+    def synthetic_trace(num_steps, observation_size):
+        # Feeds the callbacks a conversational agent run makes, and returns the collected trace
+        random.seed(0)
+        words = ["the", "population", "of", "Canada", "is", "about", "38", "million", "people", "in", "2023"]
+        handler = TraceCallbackHandler()
+        for step in range(num_steps):
+            observation = " ".join(random.choice(words) for _ in range(observation_size // 6))
+            tool_input = f"question {step}"
+            handler.on_agent_action(AgentAction(
+                "Search", tool_input, f"Thought: Do I need to use a tool? Yes\nAction: Search\nAction Input: {tool_input}"))
+            handler.on_tool_end(observation, observation_prefix="Observation: ", llm_prefix="Thought:")
+        handler.on_agent_finish(AgentFinish(
+            {"output": "About 38 million."}, " Do I need to use a tool? No\nAI: About 38 million."))
+        return handler.get_text()
+
+    def best_time(fn, text, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn(text)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    for num_steps, observation_size in [(5, 2_000), (20, 20_000), (50, 100_000)]:
+        trace = synthetic_trace(num_steps, observation_size)
+        assert single_pass_format_trace(trace) == format_trace(trace)
+
+        single_pass_time = best_time(single_pass_format_trace, trace)
+        per_keyword_time = best_time(format_trace, trace)
+        print(f"{len(trace) / 1e6:6.2f} MB trace: single pass {single_pass_time * 1000:8.2f} ms, "
+              f"per keyword {per_keyword_time * 1000:8.2f} ms ({single_pass_time / per_keyword_time:4.1f}x)")
@@ -0,0 +1,481 @@
+# This module holds the text-to-speech helpers used when speaking replies with Amazon Polly.
+# TTSCache stores synthesized audio on disk, keyed by a hash of everything that determines
+# the audio (text, voice_id, language_code and engine), so that repeated phrases like greetings
+# and error messages are played without calling Polly again. get_polly_client returns one
+# long-lived Polly client shared by all sessions, so credentials, endpoint setup and TLS
+# connections are reused instead of being set up for every utterance. PipelinedSpeaker splits
+# long replies at sentence boundaries and synthesizes the pieces in parallel, so that the first
+# sentence can be played while the rest is still being synthesized. SpeechStreams hands out ids
+# under which a reply's audio can be streamed to the browser in blocks as Polly produces it.
+# start_speech_warmup creates the Polly client, checks that Polly answers and synthesizes common
+# phrases into the cache in the background at startup, so the first replies don't pay for it.
+
+import hashlib
+import itertools
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import boto3
+from botocore.config import Config
+
+from cache_utils import DiskLRUCache
+
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MAX_BYTES = 256 * 1024 * 1024
+AUDIO_FILE_EXTENSION = ".mp3"
+
+# Connections kept open to Polly, at most one request in flight per connection
+POLLY_MAX_POOL_CONNECTIONS = int(os.environ.get("POLLY_MAX_POOL_CONNECTIONS", "16"))
+POLLY_CONNECT_TIMEOUT = 5
+POLLY_READ_TIMEOUT = 30
+
+# Polly synthesizes at most 3000 billed characters per request. The first chunk of a reply is
+# kept short so that it is ready quickly, the following ones pack more sentences per request.
+SPEECH_FIRST_CHUNK_CHARS = 200
+SPEECH_MAX_CHUNK_CHARS = 1500
+# Chunks of one reply being synthesized at the same time
+SPEECH_MAX_IN_FLIGHT = 4
+
+# Size of the blocks audio is forwarded in while streaming
+AUDIO_STREAM_BLOCK_BYTES = 16 * 1024
+# How long the audio of a reply can be requested after it was registered
+SPEECH_STREAM_TTL_SECONDS = 10 * 60
+
+# A sentence ends with ., !, ? or ... followed by whitespace, with a CJK full stop, or with a line break
+_SENTENCE_PATTERN = re.compile(r".+?(?:[.!?\u2026]+(?=\s|$)|[\u3002\uff01\uff1f]+|\n+|$)", re.S)
+
+_polly_client = None
+_polly_client_lock = threading.Lock()
+
+
+def create_polly_client(max_pool_connections=POLLY_MAX_POOL_CONNECTIONS, endpoint_url=None):
+    """Create a Polly client with a pool of keep-alive connections.
+    Clients are thread-safe, so a single one can serve all sessions.
+    """
+    config = Config(
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        connect_timeout=POLLY_CONNECT_TIMEOUT,
+        read_timeout=POLLY_READ_TIMEOUT,
+        retries={'max_attempts': 3, 'mode': 'standard'}
+    )
+    return boto3.Session(
+        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+        region_name=os.environ["AWS_DEFAULT_REGION"]
+    ).client('polly', config=config, endpoint_url=endpoint_url)
+
+
+def get_polly_client():
+    """Return the Polly client shared by all sessions, creating it on first use."""
+    global _polly_client
+    # boto3 sessions aren't thread-safe, so only one thread may create the client
+    with _polly_client_lock:
+        if _polly_client is None:
+            _polly_client = create_polly_client()
+        return _polly_client
+
+
+def open_speech(text, voice_id, language_code, engine, cache=None):
+    """Start synthesizing text and return an iterator over its MP3 audio in blocks.
+    The audio comes from the cache if given and possible, otherwise it is forwarded from Polly's
+    response as it arrives, and cached once it has been read completely.
+    """
+    if cache:
+        cached_path = cache.get(text, voice_id, language_code, engine)
+        if cached_path:
+            try:
+                f = open(cached_path, 'rb')
+                return AudioBlocks(_iter_file(f), f)
+            except IOError as error:
+                # Evicted in the meantime, synthesize it again
+                print(error)
+
+    response = get_polly_client().synthesize_speech(
+        Text=text,
+        OutputFormat='mp3',
+        VoiceId=voice_id,
+        LanguageCode=language_code,
+        Engine=engine
+    )
+    if "AudioStream" not in response:
+        return iter(())
+    stream = response["AudioStream"]
+    return AudioBlocks(_iter_polly_audio(stream, cache, (text, voice_id, language_code, engine)), stream)
+
+
+class AudioBlocks:
+    """Iterator over the blocks of one piece of audio. Closing it releases the file or Polly
+    response the audio is read from, even if it was never iterated, which closing a generator
+    that hasn't started doesn't do.
+    """
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.blocks)
+
+    def close(self):
+        self.blocks.close()
+        self.source.close()
+
+    def __init__(self, blocks, source):
+        self.blocks = blocks
+        self.source = source
+
+
+def _iter_file(f):
+    with f:
+        while True:
+            block = f.read(AUDIO_STREAM_BLOCK_BYTES)
+            if not block:
+                return
+            yield block
+
+
+def _iter_polly_audio(stream, cache, cache_key_args):
+    blocks = []
+    with closing(stream):
+        for block in stream.iter_chunks(AUDIO_STREAM_BLOCK_BYTES):
+            blocks.append(block)
+            yield block
+
+    # Only complete audio is cached, not what was read before the listener went away
+    if cache:
+        try:
+            cache.put(*cache_key_args, b"".join(blocks))
+        except IOError as error:
+            # Not being able to cache the audio doesn't keep it from being played
+            print(error)
+
+
+def probe_polly():
+    """Check that Polly answers with the configured credentials, opening a connection in the
+    shared client's pool on the way. Returns True if it does.
+    """
+    try:
+        get_polly_client().describe_voices(LanguageCode="en-US")
+        return True
+    except Exception as error:
+        print("Polly health probe failed:", error)
+        return False
+
+
+def warm_up_speech(voice_phrases, cache, open_speech=open_speech):
+    """Create the shared Polly client, probe Polly and synthesize phrases into cache, for each
+    ((voice_id, language_code, engine), phrases) of voice_phrases. Failures are only printed,
+    speech works without the warmup, the first replies are just slower. Returns True if Polly
+    answered the probe.
+    """
+    start = time.perf_counter()
+    answered = probe_polly()
+    if not answered:
+        # E.g. no DescribeVoices permission, synthesizing may still work
+        print("Warming up speech anyway")
+    for (voice_id, language_code, engine), phrases in voice_phrases:
+        for phrase in phrases:
+            try:
+                for _ in open_speech(phrase, voice_id, language_code, engine, cache=cache):
+                    pass
+            except Exception as error:
+                print(f"Speech warmup failed for {voice_id}:", error)
+    print(f"Speech warmup done in {time.perf_counter() - start:.2f} s. {cache.metrics}")
+    return answered
+
+
+def start_speech_warmup(voice_phrases, cache):
+    """Run warm_up_speech on a background thread so that it never delays startup."""
+    thread = threading.Thread(target=warm_up_speech, args=(voice_phrases, cache), name="speech-warmup",
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def synthesize_speech(text, voice_id, language_code, engine, cache=None):
+    """Return the MP3 audio of text like open_speech does, but all at once.
+    Returns None if Polly returned no audio.
+    """
+    return b"".join(open_speech(text, voice_id, language_code, engine, cache)) or None
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in _SENTENCE_PATTERN.findall(text) if sentence.strip()]
+
+
+def _split_long_sentence(sentence, max_chars):
+    # Split at the last space before max_chars, or hard at max_chars if there is none
+    while len(sentence) > max_chars:
+        cut = sentence.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        yield sentence[:cut].strip()
+        sentence = sentence[cut:].strip()
+    if sentence:
+        yield sentence
+
+
+def split_text_for_speech(text, first_chunk_chars=SPEECH_FIRST_CHUNK_CHARS, max_chars=SPEECH_MAX_CHUNK_CHARS):
+    """Split text at sentence boundaries into chunks of at most max_chars characters.
+    The first chunk holds only as many sentences as fit in first_chunk_chars (at least one).
+    """
+    chunks = []
+    current = ""
+    limit = first_chunk_chars
+    for sentence in split_sentences(text):
+        for piece in _split_long_sentence(sentence, max_chars):
+            if current and len(current) + 1 + len(piece) > limit:
+                chunks.append(current)
+                current = ""
+                limit = max_chars
+            current = current + " " + piece if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class PipelinedSpeaker:
+    """Synthesize long text chunk by chunk, with up to max_in_flight chunks of one text
+    synthesized in parallel, and yield the audio in order as soon as it is ready.
+    MP3 audio of consecutive chunks can be concatenated into one playable file.
+    """
+
+    def iter_audio(self, text, voice_id, language_code, engine):
+        chunks = iter(split_text_for_speech(text))
+        in_flight = deque()
+        try:
+            for chunk in itertools.islice(chunks, self.max_in_flight):
+                in_flight.append(self.executor.submit(self.open_speech, chunk, voice_id, language_code, engine))
+            while in_flight:
+                audio_blocks = in_flight.popleft().result()
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    in_flight.append(self.executor.submit(self.open_speech, chunk, voice_id, language_code, engine))
+                try:
+                    for block in audio_blocks:
+                        yield block
+                finally:
+                    _close_blocks(audio_blocks)
+        finally:
+            # The consumer stopped early or a chunk failed, don't synthesize what won't be played,
+            # and release the responses of what was synthesized already, or is being synthesized
+            for future in in_flight:
+                if not future.cancel():
+                    future.add_done_callback(_close_audio)
+
+    def __init__(self, open_speech=open_speech, max_in_flight=SPEECH_MAX_IN_FLIGHT,
+                 max_workers=POLLY_MAX_POOL_CONNECTIONS):
+        # open_speech(text, voice_id, language_code, engine) starts synthesizing text
+        # and returns an iterator over its audio
+        self.open_speech = open_speech
+        self.max_in_flight = max_in_flight
+        # Shared by all sessions, so at most max_workers Polly requests run at once
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tts-worker")
+
+
+def _close_blocks(audio_blocks):
+    close = getattr(audio_blocks, "close", None)
+    if close:
+        close()
+
+
+def _close_audio(future):
+    if future.exception() is None:
+        _close_blocks(future.result())
+
+
+class SpeechStreams:
+    """Registry of replies whose audio is streamed to the browser, e.g. by an HTTP endpoint
+    that returns the blocks of open(stream_id) as a chunked response. The audio isn't synthesized
+    until it is requested, and can be requested again, from the cache, until the entry expires.
+    """
+
+    def register(self, text, voice_id, language_code, engine):
+        """Return the id under which the audio of text can be opened."""
+        stream_id = uuid.uuid4().hex
+        now = time.monotonic()
+        with self.lock:
+            self.entries[stream_id] = (now, (text, voice_id, language_code, engine))
+            # Entries are in registration order, so the expired ones are at the front
+            while self.entries:
+                oldest_id, (registered, _) = next(iter(self.entries.items()))
+                if now - registered <= self.ttl_seconds:
+                    break
+                del self.entries[oldest_id]
+        return stream_id
+
+    def open(self, stream_id):
+        """Return an iterator over the audio blocks of the reply, or None if the id is unknown or expired."""
+        with self.lock:
+            entry = self.entries.get(stream_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+            return None
+        return self.speaker.iter_audio(*entry[1])
+
+    def __init__(self, speaker, ttl_seconds=SPEECH_STREAM_TTL_SECONDS):
+        self.speaker = speaker
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        # stream_id -> (registration time, (text, voice_id, language_code, engine))
+        self.entries = OrderedDict()
+
+
+class TTSCache(DiskLRUCache):
+    """Size-bounded, least recently used on-disk cache of synthesized speech."""
+
+    @staticmethod
+    def key(text, voice_id, language_code, engine):
+        data = "\0".join([text, voice_id, language_code, engine])
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, text, voice_id, language_code, engine):
+        """Return the path of the cached audio, or None if it isn't cached."""
+        return self.get_path(self.key(text, voice_id, language_code, engine))
+
+    def put(self, text, voice_id, language_code, engine, audio):
+        """Store the audio bytes and return the path of the cached file."""
+        return self.put_bytes(self.key(text, voice_id, language_code, engine), audio)
+
+    def __init__(self, cache_dir=TTS_CACHE_DIR, max_bytes=TTS_CACHE_MAX_BYTES):
+        super().__init__(cache_dir, max_bytes, AUDIO_FILE_EXTENSION, "TTS cache")
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import tempfile
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        tts_cache = TTSCache(cache_dir, max_bytes=3 * 1024)
+        fake_audio = b"\xff\xfb" * 512  # 1 KB
+
+        for phrase in ["Hello!", "What's on your mind?", "Hello!", "Goodbye!", "Hello!", "Thanks!", "Goodbye!"]:
+            if tts_cache.get(phrase, "Matthew", "en-US", "neural") is None:
+                tts_cache.put(phrase, "Matthew", "en-US", "neural", fake_audio)
+                print(f"miss  {phrase}")
+            else:
+                print(f"hit   {phrase}")
+
+        print(tts_cache.metrics, f"hit_ratio={tts_cache.hit_ratio():.2f}", f"size={tts_cache.size}")
+
+        # A new instance picks up what is on disk
+        print("reloaded entries:", len(TTSCache(cache_dir, max_bytes=3 * 1024).entries))
+
+    # Per-call overhead of a new boto3 Session and Polly client per utterance, compared with
+    # the shared pooled client, measured against a local stand-in for the Polly endpoint
+    class StubPollyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("x-amzn-RequestCharacters", "6")
+            self.send_header("Content-Length", str(len(fake_audio)))
+            self.end_headers()
+            self.wfile.write(fake_audio)
+
+        def do_GET(self):
+            # DescribeVoices, used by probe_polly
+            body = b'{"Voices": []}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "stub")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "stub")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPollyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f"http://127.0.0.1:{server.server_port}"
+
+    def synthesize(polly_client):
+        response = polly_client.synthesize_speech(Text="Hello!", OutputFormat='mp3', VoiceId="Matthew",
+                                                  LanguageCode="en-US", Engine="neural")
+        with closing(response["AudioStream"]) as stream:
+            return stream.read()
+
+    num_calls = 50
+
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        synthesize(boto3.Session(
+            aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+            aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+            region_name=os.environ["AWS_DEFAULT_REGION"]
+        ).client('polly', endpoint_url=stub_url))
+    per_call_session = (time.perf_counter() - start) / num_calls
+
+    pooled_client = create_polly_client(endpoint_url=stub_url)
+    synthesize(pooled_client)  # the first call opens the connection
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        synthesize(pooled_client)
+    per_call_pooled = (time.perf_counter() - start) / num_calls
+
+    # First spoken reply after startup, without and with the warmup
+    with tempfile.TemporaryDirectory() as cache_dir:
+        start = time.perf_counter()
+        _polly_client = create_polly_client(endpoint_url=stub_url)
+        synthesize_speech("What's on your mind?", "Maxim", "ru-RU", "standard", TTSCache(cache_dir))
+        cold_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        tts_cache = TTSCache(cache_dir)
+        _polly_client = create_polly_client(endpoint_url=stub_url)
+        start_speech_warmup([(("Maxim", "ru-RU", "standard"), ["What's on your mind?"])], tts_cache).join()
+        start = time.perf_counter()
+        synthesize_speech("What's on your mind?", "Maxim", "ru-RU", "standard", tts_cache)
+        warm_phrase_time = time.perf_counter() - start
+        start = time.perf_counter()
+        synthesize_speech("Hello!", "Maxim", "ru-RU", "standard", tts_cache)
+        warm_other_time = time.perf_counter() - start
+
+    server.shutdown()
+    print(f"new Session per call: {per_call_session * 1000:.2f} ms/call, "
+          f"pooled client: {per_call_pooled * 1000:.2f} ms/call, "
+          f"overhead removed: {(per_call_session - per_call_pooled) * 1000:.2f} ms/call "
+          f"(plain HTTP, TLS handshakes to the real endpoint add more)")
+    print(f"first reply: cold {cold_time * 1000:.2f} ms, after warmup {warm_phrase_time * 1000:.2f} ms "
+          f"for a warmed up phrase and {warm_other_time * 1000:.2f} ms for another one")
+
+    # Time to first audio for a long reply, whole text in one request versus pipelined chunks,
+    # against a stubbed Polly whose latency grows with the length of the text
+    def stub_open_speech(text, voice_id, language_code, engine):
+        time.sleep(0.1 + 0.0005 * len(text))
+        return [fake_audio]
+
+    sentences = ["Canada is the second largest country in the world by total area.",
+                 "Its population is about 38 million people, most of whom live near the southern border.",
+                 "Ottawa is the capital, while Toronto, Montreal and Vancouver are the largest cities.",
+                 "The country has two official languages, English and French."]
+    long_reply = " ".join(sentences[i % len(sentences)] for i in range(40))
+    print(f"{len(long_reply)} characters, {len(split_text_for_speech(long_reply))} chunks")
+
+    start = time.perf_counter()
+    stub_open_speech(long_reply, "Matthew", "en-US", "neural")
+    whole_text_time = time.perf_counter() - start
+    print(f"one request:  first audio {whole_text_time * 1000:6.0f} ms, all audio {whole_text_time * 1000:6.0f} ms")
+
+    speaker = PipelinedSpeaker(stub_open_speech)
+    start = time.perf_counter()
+    first_audio_time = None
+    for _ in speaker.iter_audio(long_reply, "Matthew", "en-US", "neural"):
+        if first_audio_time is None:
+            first_audio_time = time.perf_counter() - start
+    all_audio_time = time.perf_counter() - start
+    print(f"pipelined:    first audio {first_audio_time * 1000:6.0f} ms, all audio {all_audio_time * 1000:6.0f} ms")
@@ -0,0 +1,236 @@
+# This module transcribes speech with the serverless faster-whisper endpoint on RunPod without
+# blocking a thread per clip. RunPodWhisperClient submits a clip to the endpoint's run route,
+# which queues a job and returns at once, then polls the job's status with a growing interval
+# until it is done, fails or takes too long, and cancels the job if the caller gives up on it.
+# All of this runs on an asyncio event loop, e.g. Gradio's, so that many clips can be in flight
+# at once. The text of all the transcription's segments is returned, not just the first one's.
+# Short recordings are sent to the endpoint in the job's input, longer ones are uploaded first.
+
+import asyncio
+import base64
+import os
+
+import aiohttp
+
+from http_utils import fetch_json
+
+RUNPOD_WHISPER_URL = "https://api.runpod.ai/v2/faster-whisper"
+
+# Recordings up to this size are sent in the job's input as base64 instead of being uploaded,
+# which saves the upload and the endpoint's download. A job's input can be up to 10 MB
+WHISPER_INLINE_MAX_BYTES = int(os.environ.get("WHISPER_INLINE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Statuses of a job that is still queued or running, and of one that ended without output
+RUNPOD_PENDING_STATUSES = {"IN_QUEUE", "IN_PROGRESS"}
+RUNPOD_FAILED_STATUSES = {"FAILED", "CANCELLED", "TIMED_OUT"}
+
+# The status is polled after 0.25 s, then 1.5 times as long after each poll, at most every 2 s
+WHISPER_POLL_INITIAL_SECONDS = 0.25
+WHISPER_POLL_BACKOFF = 1.5
+WHISPER_POLL_MAX_SECONDS = 2
+# A job that isn't done after this long, including its time in the queue, is cancelled
+WHISPER_TIMEOUT_SECONDS = 180
+# Timeout of each request to the endpoint
+WHISPER_REQUEST_TIMEOUT_SECONDS = 30
+
+
+class WhisperJobError(Exception):
+    """A transcription job failed, was cancelled or timed out on the endpoint's side."""
+
+
+def is_transient(error):
+    """Whether a request to the endpoint that failed with error may succeed when made again,
+    unlike e.g. one with a bad key (401) or an unknown job id (404).
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def inline_audio(path, max_bytes=WHISPER_INLINE_MAX_BYTES):
+    """Return the audio of a job's input with the file at path in it, or None if the file is
+    larger than max_bytes and has to be uploaded.
+    """
+    if os.path.getsize(path) > max_bytes:
+        return None
+    with open(path, "rb") as f:
+        return {"audio_base64": base64.b64encode(f.read()).decode("ascii")}
+
+
+def join_segments(output):
+    """Return the text of all segments of a faster-whisper transcription output."""
+    segments = output.get("segments")
+    if segments:
+        return " ".join(segment["text"].strip() for segment in segments if segment["text"].strip())
+    return output.get("transcription", "").strip()
+
+
+class RunPodWhisperClient:
+    """Asynchronous client of a RunPod serverless faster-whisper endpoint."""
+
+    async def transcribe(self, audio, **options):
+        """Transcribe audio and return its text. audio is either {"audio": url} or inline_audio's
+        result, options are added to the job's input, e.g. language. Raises WhisperJobError if the job fails, and asyncio.TimeoutError if
+        it isn't done within timeout_seconds, in which case it is cancelled.
+        """
+        job_id = await self.submit({**audio, **options})
+        try:
+            output = await asyncio.wait_for(self.wait(job_id), self.timeout_seconds)
+        except BaseException:
+            # Timed out, or the caller was cancelled, e.g. because the user left the page.
+            # Shielded, so that the job is cancelled even if this task is being cancelled
+            await asyncio.shield(self.cancel(job_id))
+            raise
+        return join_segments(output)
+
+    async def submit(self, job_input):
+        """Queue a job and return its id."""
+        data = await self._request("POST", "/run", json={"input": job_input})
+        print(f"Whisper job {data['id']} {data['status']}")
+        return data["id"]
+
+    async def wait(self, job_id):
+        """Poll the status of a job until it is done, and return its output."""
+        delay = WHISPER_POLL_INITIAL_SECONDS
+        while True:
+            await asyncio.sleep(delay)
+            delay = min(delay * WHISPER_POLL_BACKOFF, WHISPER_POLL_MAX_SECONDS)
+            try:
+                data = await self._request("GET", f"/status/{job_id}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not is_transient(e):
+                    raise
+                # The job goes on, so polling does too until the timeout
+                print(f"Whisper job {job_id} status failed: {e!r}")
+                continue
+            status = data.get("status")
+            if status == "COMPLETED":
+                return data["output"]
+            if status in RUNPOD_FAILED_STATUSES:
+                raise WhisperJobError(f"Whisper job {job_id} {status}: {data.get('error', '')}")
+
+    async def cancel(self, job_id):
+        try:
+            await self._request("POST", f"/cancel/{job_id}")
+            print(f"Whisper job {job_id} cancelled")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not is_transient(e):
+                raise
+            print(f"Whisper job {job_id} cancel failed: {e!r}")
+
+    async def _request(self, method, path, json=None):
+        return await fetch_json(method, self.url + path, json=json, headers=self.headers,
+                                timeout=aiohttp.ClientTimeout(total=self.request_timeout_seconds))
+
+    def __init__(self, api_key, url=RUNPOD_WHISPER_URL, timeout_seconds=WHISPER_TIMEOUT_SECONDS,
+                 request_timeout_seconds=WHISPER_REQUEST_TIMEOUT_SECONDS):
+        self.url = url
+        self.headers = {"accept": "application/json", "Authorization": "Bearer " + api_key}
+        self.timeout_seconds = timeout_seconds
+        self.request_timeout_seconds = request_timeout_seconds
+
+
+# Run from the command-line
+if __name__ == '__main__':
+    import threading
+    import time
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+    from aiohttp import web
+
+    from http_utils import close_async_session
+
+    # Stands in for the endpoint: jobs wait in a queue for one of 8 workers, take 1 s to run, and
+    # are transcribed as 3 segments. runsync blocks until its job is done
+    NUM_WORKERS, JOB_SECONDS = 8, 1.0
+    jobs = {}
+
+    async def run_job(job_id, workers):
+        async with workers:
+            if jobs[job_id]["status"] == "CANCELLED":
+                return
+            jobs[job_id]["status"] = "IN_PROGRESS"
+            await asyncio.sleep(JOB_SECONDS)
+        if jobs[job_id]["status"] == "IN_PROGRESS":
+            jobs[job_id].update(status="COMPLETED", output={"segments": [
+                {"text": " Hello,"}, {"text": " how are you?"}, {"text": " Fine, thanks."}]})
+
+    async def handle_run(request):
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = {"id": job_id, "status": "IN_QUEUE"}
+        request.app["tasks"].add(asyncio.create_task(run_job(job_id, request.app["workers"])))
+        return web.json_response(jobs[job_id])
+
+    async def handle_runsync(request):
+        job_id = uuid.uuid4().hex
+        jobs[job_id] = {"id": job_id, "status": "IN_QUEUE"}
+        await run_job(job_id, request.app["workers"])
+        return web.json_response(jobs[job_id])
+
+    async def handle_status(request):
+        return web.json_response(jobs[request.match_info["job_id"]])
+
+    async def handle_cancel(request):
+        job = jobs[request.match_info["job_id"]]
+        if job["status"] in RUNPOD_PENDING_STATUSES:
+            job["status"] = "CANCELLED"
+        return web.json_response(job)
+
+    def serve(ready):
+        async def main():
+            app = web.Application()
+            app["workers"], app["tasks"] = asyncio.Semaphore(NUM_WORKERS), set()
+            app.add_routes([web.post("/run", handle_run), web.post("/runsync", handle_runsync),
+                            web.get("/status/{job_id}", handle_status),
+                            web.post("/cancel/{job_id}", handle_cancel)])
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            ready.append(site._server.sockets[0].getsockname()[1])
+            await asyncio.Event().wait()
+        asyncio.run(main())
+
+    ready = []
+    threading.Thread(target=serve, args=(ready,), daemon=True).start()
+    while not ready:
+        time.sleep(0.01)
+    url = f"http://127.0.0.1:{ready[0]}"
+
+    # 32 clips, transcribed by 4 threads blocked on runsync, as the previous transcribe did, and
+    # all at once by one client on one thread
+    NUM_CLIPS = 32
+    headers = {"Authorization": "Bearer test"}
+
+    def transcribe_sync(i):
+        data = requests.post(url + "/runsync", json={"input": {"audio": f"clip{i}.mp3"}}, headers=headers).json()
+        return data["output"]["segments"][0]["text"]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(4) as executor:
+        texts = list(executor.map(transcribe_sync, range(NUM_CLIPS)))
+    print(f"runsync, 4 threads: {NUM_CLIPS} clips in {time.perf_counter() - start:.1f} s, {texts[0]!r}")
+
+    async def main():
+        client = RunPodWhisperClient("test", url=url)
+        start = time.perf_counter()
+        texts = await asyncio.gather(*[client.transcribe({"audio": f"clip{i}.mp3"}, language="en")
+                                       for i in range(NUM_CLIPS)])
+        print(f"run and status, 1 thread: {NUM_CLIPS} clips in {time.perf_counter() - start:.1f} s, {texts[0]!r}")
+
+        # A clip whose caller gives up while it is queued behind others, and one that times out
+        tasks = [asyncio.create_task(client.transcribe({"audio": f"clip{i}.mp3"})) for i in range(NUM_WORKERS + 1)]
+        await asyncio.sleep(0.5)
+        tasks[-1].cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        client.timeout_seconds = JOB_SECONDS / 2
+        try:
+            await client.transcribe({"audio": "long.mp3"})
+        except asyncio.TimeoutError:
+            print("timed out")
+        print("statuses:", sorted({job["status"] for job in jobs.values()}))
+        await close_async_session()
+
+    asyncio.run(main())